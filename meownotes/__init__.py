@@ -11,8 +11,15 @@ ROOT = os.path.dirname(os.path.realpath(__file__))
 # add the project directory to the sys.path
 if ROOT not in sys.path:
     sys.path = [ROOT] + sys.path
-from config import Config
+from config import Config, load_deployment_config
 from dbquery import init_app
+import assets
+import backup
+import cache
+import metrics
+import passwords
+import shards
+import suggest
 
 # Load if port is set in the environment
 PORT = os.getenv("MEOWNOTES_PORT", None)
@@ -25,10 +32,22 @@ def create_app():
     app = Flask(__name__)
     # Load the config
     app.config.from_object("config.Config")
+    # and the shared settings of the workers (session key, db path) from the environment
+    load_deployment_config(app.config)
     from pawprint import MEOW_BP
+    from api import API_BP
     # Register the main meownotes blueprint
     app.register_blueprint(MEOW_BP)
+    # and the JSON API (/api/v1)
+    app.register_blueprint(API_BP)
     init_app(app)
+    assets.init_app(app)
+    backup.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
+    passwords.init_app(app)
+    shards.init_app(app)
+    suggest.init_app(app)
     return app
 
 if __name__ == "__main__":
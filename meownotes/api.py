@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+JSON API Blueprint for the MeowNotes Flask app (version 1)
+list, get, create, update (or patch), and delete the notes of the logged in user
+each note has a strong ETag from its version, so clients can ask
+If-None-Match (304 if unchanged) or If-Match (412 if changed since)
+"""
+import os
+import sys
+from flask import request, g, Blueprint, jsonify, current_app, url_for
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from dbquery import get_notes_page, get_note_by_id, get_note_version, add_note, save_note, \
+    remove_note, patch_note, process_note_results, process_note_summaries
+from suggest import get_suggestions
+
+API_BP = Blueprint("api", __name__, url_prefix="/api/v1")
+
+def note_etag(note_id, version):
+    """
+    Returns the (strong) ETag of a version of a note
+    Example output: "3-2"
+    """
+    return "%s-%s" % (note_id, version)
+
+def note_json(note):
+    """
+    Returns the fields of a parsed note (or note summary) sent by the API
+    """
+    result = {
+        "id": note["note_id"],
+        "title": note["title"],
+        "tags": note["tags"],
+        "date_created": note["date_created"],
+        "created_ts": note["created_ts"]
+    }
+    for field in ("content", "version", "preview"):
+        if note.get(field) is not None:
+            result[field] = note[field]
+    return result
+
+def api_error(status, message):
+    """
+    Returns a JSON error response
+    """
+    return jsonify({"error": message}), status
+
+def read_note_input():
+    """
+    Returns the title, tags, and content of the note sent as JSON in the request
+    or None if they are missing
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("title"), str) \
+            or not data["title"] or not isinstance(data.get("content", ""), str):
+        return None
+    tags = data.get("tags") or ""
+    tags = [str(tag) for tag in tags] if isinstance(tags, list) else str(tags)
+    return {"title": data["title"], "tags": tags, "content": data.get("content", "")}
+
+def note_response(uid, note_id, status=200):
+    """
+    Returns the note as JSON with its ETag (404 if there is no such note)
+    """
+    note_data = process_note_results(get_note_by_id(uid, note_id))
+    if not note_data:
+        return api_error(404, "note not found")
+    response = jsonify(note_json(note_data[0]))
+    response.status_code = status
+    response.set_etag(note_etag(note_id, note_data[0]["version"]))
+    return response
+
+@API_BP.before_request
+def check_api_user():
+    """
+    The API is only available to a logged in user (session cookie)
+    """
+    if not g.uid:
+        return api_error(401, "login required")
+    return None
+
+@API_BP.route("/notes", methods=("GET",))
+def list_notes():
+    """
+    One page of note summaries, oldest first (?after= cursor of the next page, ?limit=)
+    """
+    limit = request.args.get("limit", type=int) or current_app.config["DASHBOARD_PAGE_SIZE"]
+    limit = max(1, min(limit, current_app.config["API_MAX_PAGE_SIZE"]))
+    db_notes, next_page, _ = get_notes_page(g.uid, request.args.get("after"), limit,
+                                            current_app.config["NOTE_PREVIEW_LENGTH"])
+    return jsonify({"notes": [note_json(note) for note in process_note_summaries(db_notes)],
+                    "next": next_page})
+
+@API_BP.route("/notes", methods=("POST",))
+def create_api_note():
+    """
+    Create a note from JSON {"title": ..., "tags": [...], "content": ...}
+    """
+    note = read_note_input()
+    if note is None:
+        return api_error(400, "a note needs a title and text content")
+    note_id = add_note(g.uid, note["title"], note["tags"], note["content"])
+    response = note_response(g.uid, note_id, 201)
+    response.headers["Location"] = url_for("api.get_api_note", note_id=note_id)
+    return response
+
+@API_BP.route("/notes/<int:note_id>", methods=("GET",))
+def get_api_note(note_id):
+    """
+    A note with its content, 304 if the If-None-Match ETag is still its current version
+    (checked from the index, without reading the note)
+    """
+    if request.if_none_match:
+        version = get_note_version(g.uid, note_id)
+        if version is None:
+            return api_error(404, "note not found")
+        if request.if_none_match.contains(note_etag(note_id, version)):
+            response = current_app.response_class(status=304)
+            response.set_etag(note_etag(note_id, version))
+            return response
+    return note_response(g.uid, note_id)
+
+def expected_version(note_id):
+    """
+    Returns the version required by the If-Match header of the request
+    None if any version is fine, -1 if the ETag is not one of this note
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for etag in request.if_match.as_set():
+        if etag.startswith("%s-" % note_id) and etag.split("-", 1)[1].isdigit():
+            return int(etag.split("-", 1)[1])
+    return -1
+
+@API_BP.route("/notes/<int:note_id>", methods=("PUT",))
+def update_api_note(note_id):
+    """
+    Replace the title, tags, and content of a note
+    412 if the If-Match ETag is not its current version (changed by someone else)
+    """
+    note = read_note_input()
+    if note is None:
+        return api_error(400, "a note needs a title and text content")
+    version = expected_version(note_id)
+    if not save_note(g.uid, note_id, note, version):
+        if get_note_version(g.uid, note_id) is None:
+            return api_error(404, "note not found")
+        return api_error(412, "the note was changed since this version")
+    return note_response(g.uid, note_id)
+
+def read_patch_input():
+    """
+    Returns the base version, the text changes, and the title and/or tags
+    sent as JSON in a PATCH request, or None if they are missing
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("version"), int) \
+            or not isinstance(data.get("changes", []), list):
+        return None
+    fields = {}
+    if "title" in data:
+        if not isinstance(data["title"], str) or not data["title"]:
+            return None
+        fields["title"] = data["title"]
+    if "tags" in data:
+        tags = data["tags"] or ""
+        fields["tags"] = [str(tag) for tag in tags] if isinstance(tags, list) else str(tags)
+    return data["version"], data.get("changes", []), fields
+
+@API_BP.route("/notes/<int:note_id>", methods=("PATCH",))
+def patch_api_note(note_id):
+    """
+    Autosave: apply text changes to the content of a note (and replace its title or tags)
+    from JSON {"version": ..., "changes": [{"start": ..., "end": ..., "text": ...}], ...}
+    the version is the one the changes were made to, 409 if the note is at another one
+    answers with the id and the version of the note only, not the note
+    """
+    patch = read_patch_input()
+    if patch is None:
+        return api_error(400, "a patch needs the version of the note and a list of changes")
+    try:
+        result, version = patch_note(g.uid, note_id, patch[0], patch[1], patch[2])
+    except ValueError as expt:
+        return api_error(400, str(expt))
+    if result == "missing" or version is None:
+        return api_error(404, "note not found")
+    if result == "conflict":
+        response = jsonify({"error": "the note was changed since this version",
+                            "version": version})
+        response.status_code = 409
+    else:
+        response = jsonify({"id": note_id, "version": version, "saved": result == "saved"})
+    response.set_etag(note_etag(note_id, version))
+    return response
+
+@API_BP.route("/notes/<int:note_id>", methods=("DELETE",))
+def delete_api_note(note_id):
+    """
+    Delete a note, 412 if the If-Match ETag is not its current version
+    """
+    if not remove_note(g.uid, note_id, expected_version(note_id)):
+        if get_note_version(g.uid, note_id) is None:
+            return api_error(404, "note not found")
+        return api_error(412, "the note was changed since this version")
+    return "", 204
+
+@API_BP.route("/suggest")
+def suggest_terms():
+    """
+    Titles, words of titles, and tags of the notes starting with ?q= (for the search box)
+    """
+    return jsonify({"suggestions": get_suggestions(g.uid, request.args.get("q", ""),
+                                                   current_app.config["SUGGEST_LIMIT"])})
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+MeowNotes static assets: build step (flask assets) and serving of the built files
+the build copies the assets used by the templates to static/dist with the hash of
+their content in the file name, so they can be cached by browsers forever
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+import click
+from flask import Blueprint, current_app, request, send_from_directory
+from flask.cli import with_appcontext
+# optional: brotli (.br variants, WOFF2 fonts) and fontTools (WOFF2 fonts)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from fontTools import subset as font_subset
+except ImportError:
+    font_subset = None
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+STATIC_DIR = os.path.join(ROOT, "static")
+TEMPLATES_DIR = os.path.join(ROOT, "templates")
+MANIFEST = "manifest.json"
+
+# assets loaded by the templates, e.g., url_for('static', filename='css/main.css')
+TEMPLATE_ASSET = re.compile(r"url_for\('static', filename='([^']+)'\)")
+# files referenced by a stylesheet, e.g., url("../fonts/Montserrat-Regular.otf")
+CSS_URL = re.compile(r"""url\(["']?(?!data:)([^"')]+)["']?\)""")
+FONT_FACE = re.compile(r"@font-face\s*{[^}]*}\s*")
+FONT_WEIGHT = re.compile(r"font-weight:\s*(\d+)")
+# the source maps are not part of the build
+SOURCE_MAP = re.compile(rb"\s*(/\*# sourceMappingURL=[^*]*\*/|//# sourceMappingURL=\S*)\s*$")
+# already compressed formats are not compressed again
+COMPRESSED = (".png", ".jpg", ".gif", ".woff2")
+# characters kept in the WOFF2 fonts (Basic Latin, Latin-1, punctuation, euro sign)
+FONT_UNICODES = list(range(0x20, 0x7f)) + list(range(0xa0, 0x100)) + \
+    list(range(0x2010, 0x2027)) + [0x20ac]
+# built files never change (a new version has a new name)
+CACHE_FOREVER = "public, max-age=31536000, immutable"
+
+ASSETS_BP = Blueprint("assets", __name__)
+
+############ Build ############
+
+def find_template_assets(templates_dir=TEMPLATES_DIR):
+    """
+    Returns the (sorted) paths of the static files the templates load
+    """
+    assets = set()
+    for file_name in os.listdir(templates_dir):
+        with open(os.path.join(templates_dir, file_name), encoding="utf8") as template:
+            assets.update(TEMPLATE_ASSET.findall(template.read()))
+    return sorted(assets)
+
+def hashed_name(path, data):
+    """
+    Returns the path with the hash of the content before the extension
+    Example use: hashed_name("css/main.css", b"...")
+    Example output: "css/main.3f8a9c1d2e4b.css"
+    """
+    stem, extension = posixpath.splitext(path)
+    return "%s.%s%s" % (stem, hashlib.sha256(data).hexdigest()[:12], extension)
+
+def convert_font(data):
+    """
+    Returns the font as WOFF2 with only the characters of FONT_UNICODES
+    (None if fontTools or brotli are not installed)
+    """
+    if font_subset is None or brotli is None:
+        return None
+    options = font_subset.Options()
+    options.flavor = "woff2"
+    font = font_subset.load_font(font_subset.BytesIO(data), options)
+    subsetter = font_subset.Subsetter(options)
+    subsetter.populate(unicodes=FONT_UNICODES)
+    subsetter.subset(font)
+    output = font_subset.BytesIO()
+    font_subset.save_font(font, output, options)
+    return output.getvalue()
+
+def keep_font_faces(css, font_weights):
+    """
+    Removes the @font-face rules of the font weights that are not used
+    """
+    def keep(match):
+        weight = FONT_WEIGHT.search(match.group(0))
+        if weight is None or int(weight.group(1)) in font_weights:
+            return match.group(0)
+        return ""
+    return FONT_FACE.sub(keep, css)
+
+class AssetBuild():
+    """
+    One build of the assets into dist_dir, manifest maps each asset to its built file
+    Example use:
+    build = AssetBuild("static", "static/dist", [400, 700])
+    build.add("css/main.css")
+    build.write_manifest()
+    """
+    def __init__(self, static_dir, dist_dir, font_weights):
+        self.static_dir = static_dir
+        self.dist_dir = dist_dir
+        self.font_weights = font_weights
+        self.manifest = {}
+
+    def add(self, path):
+        """
+        Build an asset (and the files it references), returns the path of the built file
+        """
+        if path in self.manifest:
+            return self.manifest[path]
+        with open(os.path.join(self.static_dir, path), "rb") as asset_file:
+            data = asset_file.read()
+        built_path = path
+        if path.endswith(".css"):
+            data = self.build_css(path, data)
+        if path.endswith((".css", ".js")):
+            data = SOURCE_MAP.sub(b"\n", data)
+        if path.endswith(".otf"):
+            woff2 = convert_font(data)
+            if woff2 is not None:
+                data = woff2
+                built_path = posixpath.splitext(path)[0] + ".woff2"
+        built_path = hashed_name(built_path, data)
+        self.write(built_path, data)
+        self.manifest[path] = built_path
+        return built_path
+
+    def build_css(self, path, data):
+        """
+        Point the url() of a stylesheet at the built files (built first)
+        """
+        css = keep_font_faces(data.decode("utf8"), self.font_weights)
+        css_dir = posixpath.dirname(path)
+        def built_url(match):
+            url = match.group(1)
+            referenced = posixpath.normpath(posixpath.join(css_dir, url))
+            built = posixpath.relpath(self.add(referenced), css_dir)
+            return match.group(0).replace(url, built)
+        return CSS_URL.sub(built_url, css).encode("utf8")
+
+    def write(self, built_path, data):
+        """
+        Write a built file and its precompressed variants (.gz and, if available, .br)
+        variants that are not smaller are left out
+        """
+        target = os.path.join(self.dist_dir, built_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as built_file:
+            built_file.write(data)
+        if built_path.endswith(COMPRESSED):
+            return
+        variants = [(".gz", gzip.compress(data, 9, mtime=0))]
+        if brotli is not None:
+            variants.append((".br", brotli.compress(data)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(data):
+                with open(target + suffix, "wb") as compressed_file:
+                    compressed_file.write(compressed)
+
+    def write_manifest(self):
+        """
+        Save which built file replaces which asset
+        """
+        with open(os.path.join(self.dist_dir, MANIFEST), "w", encoding="utf8") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1, sort_keys=True)
+
+def build_assets(dist_dir, font_weights, static_dir=STATIC_DIR):
+    """
+    (Re)build the assets loaded by the templates into dist_dir, returns the manifest
+    """
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    os.makedirs(dist_dir)
+    build = AssetBuild(static_dir, dist_dir, font_weights)
+    for path in find_template_assets():
+        build.add(path)
+    build.write_manifest()
+    return build.manifest
+
+def load_manifest(dist_dir):
+    """
+    Returns the manifest of the last build ({} if the assets were not built)
+    """
+    try:
+        with open(os.path.join(dist_dir, MANIFEST), encoding="utf8") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+# build the fingerprinted and compressed assets using the command line
+# flask assets
+@click.command("assets")
+@with_appcontext
+def build_assets_command():
+    """
+    Call the (re)build of the static assets
+    """
+    manifest = build_assets(current_app.config["ASSETS_DIST_DIR"],
+                            current_app.config["ASSET_FONT_WEIGHTS"])
+    if brotli is None or font_subset is None:
+        click.echo(">>> WARNING: brotli/fontTools not installed, no .br files or WOFF2 fonts.")
+    click.echo(">>> INFO: Built %d assets into %s." % (len(manifest),
+                                                       current_app.config["ASSETS_DIST_DIR"]))
+
+############ Serving ############
+
+def use_built_asset(endpoint, values):
+    """
+    Makes url_for('static', filename=...) point at the built file of the asset
+    (the templates keep the names of the original files)
+    """
+    if endpoint == "static":
+        built = current_app.extensions["meownotes_assets"].get(values.get("filename"))
+        if built is not None:
+            values["filename"] = "dist/" + built
+
+@ASSETS_BP.route("/static/dist/<path:filename>")
+def built_asset(filename):
+    """
+    Send a built file, precompressed if the browser accepts it, to be cached forever
+    """
+    dist_dir = current_app.config["ASSETS_DIST_DIR"]
+    mimetype = mimetypes.guess_type(filename)[0]
+    response = None
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[encoding] and \
+                os.path.isfile(os.path.join(dist_dir, filename + suffix)):
+            response = send_from_directory(dist_dir, filename + suffix, mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+            break
+    if response is None:
+        response = send_from_directory(dist_dir, filename, mimetype=mimetype)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = CACHE_FOREVER
+    return response
+
+def init_app(app):
+    """
+    Make the assets cmd available for the app and use the built assets (if built)
+    """
+    app.cli.add_command(build_assets_command)
+    app.register_blueprint(ASSETS_BP)
+    manifest = {}
+    if app.config["USE_BUILT_ASSETS"]:
+        manifest = load_manifest(app.config["ASSETS_DIST_DIR"])
+    app.extensions["meownotes_assets"] = manifest
+    app.url_defaults(use_built_asset)
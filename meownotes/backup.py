@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+MeowNotes online backups of the db files (the directory and the shards) and their restore
+a backup is copied with the SQLite backup API a few pages at a time, the db is only locked
+while a step copies its pages, so the requests keep being served in between
+a full backup is the db file (gzip compressed or not), an incremental backup has only
+the pages changed since the previous backup; the manifest of each db file lists the backups
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from shards import all_databases
+
+# bytes of the hash of each page kept in the manifest to find the changed pages
+PAGE_HASH_BYTES = 16
+
+class BackupProgress():
+    """
+    Progress callback of Connection.backup: sleeps between the steps and
+    measures how long each step (holding the lock of the source db) took
+    Example use:
+    progress = BackupProgress(0.05, 10)
+    source.backup(target, pages=256, progress=progress)
+    progress.counters["lock_max"]
+    """
+    def __init__(self, sleep, max_restarts):
+        self.sleep = sleep
+        self.max_restarts = max_restarts
+        # remaining: pages left after the last step, restarts: times the source was changed
+        # by another connection and the copy started over
+        self.counters = {"steps": 0, "lock_total": 0.0, "lock_max": 0.0, "restarts": 0,
+                         "remaining": None}
+        self._step_started = time.perf_counter()
+
+    def __call__(self, status, remaining, total):
+        # pylint: disable=unused-argument
+        held = time.perf_counter() - self._step_started
+        counters = self.counters
+        counters["steps"] += 1
+        counters["lock_total"] += held
+        counters["lock_max"] = max(counters["lock_max"], held)
+        if counters["remaining"] is not None and remaining > counters["remaining"]:
+            counters["restarts"] += 1
+            if counters["restarts"] > self.max_restarts:
+                # raising stops the backup (Connection.backup raises it again)
+                raise RuntimeError("the db was changed during the backup %d times, try again "
+                                   "with more pages per step" % counters["restarts"])
+        counters["remaining"] = remaining
+        if remaining and self.sleep:
+            time.sleep(self.sleep)
+        self._step_started = time.perf_counter()
+
+def copy_database(database, snapshot_path, pages, sleep, max_restarts):
+    """
+    Copy a (live) db file into snapshot_path with the SQLite backup API,
+    pages at a time with sleep seconds between the steps
+    returns the BackupProgress with the counters of the copy
+    """
+    progress = BackupProgress(sleep, max_restarts)
+    source = sqlite3.connect(database)
+    snapshot = sqlite3.connect(snapshot_path)
+    try:
+        source.backup(snapshot, pages=pages, progress=progress)
+    finally:
+        snapshot.close()
+        source.close()
+    return progress
+
+def page_hashes(snapshot_path):
+    """
+    Returns the page size of a db file and the hashes (hex) of its pages
+    """
+    connection = sqlite3.connect(snapshot_path)
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    connection.close()
+    hashes = []
+    with open(snapshot_path, "rb") as snapshot:
+        for page in iter(lambda: snapshot.read(page_size), b""):
+            hashes.append(hashlib.blake2b(page, digest_size=PAGE_HASH_BYTES).hexdigest())
+    return page_size, hashes
+
+def open_backup(path, mode):
+    """
+    Open a backup file, gzip compressed if its name ends with .gz
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def manifest_path(directory, database):
+    """
+    Returns the path of the manifest of the backups of a db file
+    Example use: manifest_path("backups", ".../meownotes-shard-2.db")
+    Example output: "backups/meownotes-shard-2.manifest.json"
+    """
+    stem = os.path.splitext(os.path.basename(database))[0]
+    return os.path.join(directory, stem + ".manifest.json")
+
+def read_manifest(directory, database):
+    """
+    Returns the manifest of the backups of a db file, None if it has no backups yet
+    """
+    path = manifest_path(directory, database)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf8") as manifest_file:
+        return json.load(manifest_file)
+
+def write_backup(snapshot_path, backup_path, manifest, page_size, hashes):
+    """
+    Write the backup of a snapshot: the whole db file, or with the manifest of the previous
+    backups only the pages changed since then (see restore_snapshot)
+    returns the number of pages written
+    """
+    if manifest is None:
+        with open(snapshot_path, "rb") as snapshot, open_backup(backup_path, "wb") as backup:
+            shutil.copyfileobj(snapshot, backup)
+        return len(hashes)
+    previous = manifest["hashes"]
+    changed = [index for index, page_hash in enumerate(hashes)
+               if index >= len(previous) or previous[index] != page_hash]
+    header = {"page_size": page_size, "pages": len(hashes), "changed": changed}
+    with open(snapshot_path, "rb") as snapshot, open_backup(backup_path, "wb") as backup:
+        backup.write(json.dumps(header).encode("utf8") + b"\n")
+        for index in changed:
+            snapshot.seek(index * page_size)
+            backup.write(snapshot.read(page_size))
+    return len(changed)
+
+def backup_database(database, directory, incremental, compress):
+    """
+    Back up a db file into directory and add the backup to its manifest
+    returns the file written, the bytes of the db, the pages written, and the BackupProgress
+    """
+    manifest = read_manifest(directory, database) if incremental else None
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    stem = os.path.splitext(os.path.basename(database))[0]
+    snapshot_path = os.path.join(directory, "%s-%s.snapshot" % (stem, stamp))
+    try:
+        progress = copy_database(database, snapshot_path, current_app.config["BACKUP_PAGES"],
+                                 current_app.config["BACKUP_SLEEP"],
+                                 current_app.config["BACKUP_MAX_RESTARTS"])
+        page_size, hashes = page_hashes(snapshot_path)
+        if manifest is None or manifest["page_size"] != page_size:
+            manifest = None
+            backup_name = "%s-%s.db" % (stem, stamp)
+        else:
+            backup_name = "%s-%s.pages" % (stem, stamp)
+        backup_name += ".gz" if compress else ""
+        written = write_backup(snapshot_path, os.path.join(directory, backup_name), manifest,
+                               page_size, hashes)
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+    chain = manifest["chain"] if manifest is not None else []
+    chain.append({"file": backup_name, "stamp": stamp})
+    with open(manifest_path(directory, database), "w", encoding="utf8") as manifest_file:
+        json.dump({"page_size": page_size, "hashes": hashes, "chain": chain}, manifest_file)
+    return backup_name, len(hashes) * page_size, written, progress
+
+def restore_snapshot(directory, chain, snapshot_path):
+    """
+    Write the db file of a chain of backups (a full backup and its incremental backups)
+    """
+    with open(snapshot_path, "wb") as snapshot:
+        for entry in chain:
+            with open_backup(os.path.join(directory, entry["file"]), "rb") as backup:
+                if ".pages" not in entry["file"]:
+                    snapshot.seek(0)
+                    snapshot.truncate()
+                    shutil.copyfileobj(backup, snapshot)
+                    continue
+                header = json.loads(backup.readline())
+                for index in header["changed"]:
+                    snapshot.seek(index * header["page_size"])
+                    snapshot.write(backup.read(header["page_size"]))
+                snapshot.truncate(header["pages"] * header["page_size"])
+
+def restore_database(database, directory, until=None):
+    """
+    Replace the content of a db file with its latest backup (or the latest made until
+    the given stamp), returns the stamp of the backup restored (None if there is none)
+    """
+    manifest = read_manifest(directory, database)
+    chain = [entry for entry in (manifest or {}).get("chain", [])
+             if until is None or entry["stamp"] <= until]
+    if not chain:
+        return None
+    snapshot_path = os.path.join(directory, "restore-%s.snapshot" % chain[-1]["stamp"])
+    try:
+        restore_snapshot(directory, chain, snapshot_path)
+        snapshot = sqlite3.connect(snapshot_path)
+        target = sqlite3.connect(database)
+        try:
+            if snapshot.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+                raise click.ClickException("the backup %s is damaged" % chain[-1]["file"])
+            # one step, the db is locked until it has all pages of the backup
+            snapshot.backup(target)
+        finally:
+            target.close()
+            snapshot.close()
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+    return chain[-1]["stamp"]
+
+# back up the db files while MeowNotes is running using the command line
+# flask backup --incremental
+@click.command("backup")
+@click.option("--dest", default=None, help="Directory of the backups (default BACKUP_DIR).")
+@click.option("--incremental", is_flag=True,
+              help="Only store the pages changed since the previous backup.")
+@click.option("--gzip/--no-gzip", "compress", default=True, help="Compress the backups.")
+@with_appcontext
+def backup_command(dest, incremental, compress):
+    """
+    Back up every db file of the app (the directory and the shards)
+    """
+    directory = dest or current_app.config["BACKUP_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    for database in all_databases(current_app.config):
+        started = time.perf_counter()
+        try:
+            backup_name, size, written, progress = backup_database(database, directory,
+                                                                   incremental, compress)
+        except (sqlite3.Error, RuntimeError) as expt:
+            raise click.ClickException("backup of %s failed: %s" % (database, expt)) from expt
+        seconds = time.perf_counter() - started
+        counters = progress.counters
+        megabytes = size / 1024 / 1024
+        click.echo(">>> INFO: Backed up %s to %s: %.1f MiB (%d pages written) in %.2f s "
+                   "(%.1f MiB/s)." % (database, backup_name, megabytes, written, seconds,
+                                      megabytes / max(seconds, 1e-6)))
+        click.echo(">>> INFO: The db was locked for %.1f ms at most (%.1f ms in %d steps, "
+                   "%d restarts)." % (counters["lock_max"] * 1000, counters["lock_total"] * 1000,
+                                      counters["steps"], counters["restarts"]))
+
+# replace the db files with their backups using the command line (MeowNotes stopped)
+# flask restore --until 20190505-143000-000000
+@click.command("restore")
+@click.option("--dest", default=None, help="Directory of the backups (default BACKUP_DIR).")
+@click.option("--until", default=None, help="Restore the latest backup made until this stamp.")
+@click.confirmation_option(prompt="This replaces the data of the MeowNotes database, continue?")
+@with_appcontext
+def restore_command(dest, until):
+    """
+    Restore every db file of the app from its latest backup
+    """
+    directory = dest or current_app.config["BACKUP_DIR"]
+    for database in all_databases(current_app.config):
+        started = time.perf_counter()
+        stamp = restore_database(database, directory, until)
+        if stamp is None:
+            click.echo(">>> WARNING: There is no backup of %s in %s." % (database, directory))
+            continue
+        click.echo(">>> INFO: Restored %s from the backup of %s in %.2f s." %
+                   (database, stamp, time.perf_counter() - started))
+    click.echo(">>> INFO: Restart MeowNotes, the workers cache the data they read before.")
+
+def init_app(app):
+    """
+    Make the backup and restore cmds available for the app
+    """
+    app.cli.add_command(backup_command)
+    app.cli.add_command(restore_command)
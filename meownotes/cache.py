@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+MeowNotes cache of rendered page fragments (e.g., the notes of the dashboard)
+and of search results (so filtering the last search does not search again)
+both are cached per user and version of the notes of the user,
+so any change of a note makes the next request render or search again
+"""
+import collections
+import os
+import sys
+import threading
+from flask import current_app
+from markupsafe import Markup
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from dbquery import get_data_version, get_search_notes, get_search_note_ids, SEARCH_FIELDS
+
+# rough bytes of memory used by each note (summary row) and each note id of a search result
+SEARCH_NOTE_BYTES = 400
+SEARCH_ID_BYTES = 60
+
+class FragmentCache():
+    """
+    Keeps the most recently used fragments (HTML) up to max_bytes in total
+    other values can be cached with their (estimated) size given to put
+    Example use:
+    fragments = FragmentCache(8 * 1024 * 1024)
+    fragments.put(("view", 1, 4, "2"), html)
+    fragments.get(("view", 1, 4, "2"))
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # key -> (fragment, size), least recently used first
+        self._fragments = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"bytes": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        """
+        Returns the cached fragment (None if it is not cached)
+        """
+        with self._lock:
+            cached = self._fragments.get(key)
+            if cached is None:
+                self.counters["misses"] += 1
+                return None
+            self._fragments.move_to_end(key)
+            self.counters["hits"] += 1
+            return cached[0]
+
+    def put(self, key, fragment, size=None):
+        """
+        Cache a fragment, the least recently used ones are removed to stay within max_bytes
+        (caching a key again replaces it, e.g., with its new size)
+        """
+        if size is None:
+            size = len(fragment.encode("utf8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._fragments:
+                self.counters["bytes"] -= self._fragments.pop(key)[1]
+            self._fragments[key] = (fragment, size)
+            self.counters["bytes"] += size
+            while self.counters["bytes"] > self.max_bytes:
+                self.counters["bytes"] -= self._fragments.popitem(last=False)[1][1]
+                self.counters["evictions"] += 1
+
+    def clear(self):
+        """
+        Remove all fragments (the counters are kept)
+        """
+        with self._lock:
+            self._fragments.clear()
+            self.counters["bytes"] = 0
+
+    def stats(self):
+        """
+        Returns the cache counters as a dict
+        """
+        with self._lock:
+            stats = {"fragments": len(self._fragments), "max_bytes": self.max_bytes}
+            stats.update(self.counters)
+        return stats
+
+def get_fragment_cache():
+    """
+    Returns the fragment cache of the app (of this worker process)
+    """
+    return current_app.extensions["meownotes_fragments"]
+
+def cached_fragment(uid, key, render):
+    """
+    Returns the fragment for the given user and key (tuple) as Markup, from the cache
+    if the notes of the user did not change since it was rendered, otherwise render()
+    is called and its result cached (unless it is None, e.g., the note was not found)
+    Example use: cached_fragment(1, ("view", "2"), lambda: render_template(...))
+    """
+    fragments = get_fragment_cache()
+    full_key = (uid, get_data_version(uid)) + key
+    fragment = fragments.get(full_key)
+    if fragment is None:
+        fragment = render()
+        if fragment is None:
+            return None
+        fragments.put(full_key, fragment)
+    return Markup(fragment)
+
+class SearchResult():
+    """
+    The note summaries matching a search in any field (best matches first)
+    and the ids of the notes matching each word of the search in each field,
+    found when first needed to filter the result
+    Example use:
+    result = SearchResult(["uni", "note"], get_search_notes(1, "uni note"))
+    result.filter(1, ["title"])
+    """
+    def __init__(self, words, notes):
+        self.words = words
+        self.notes = notes
+        # (word, field) -> ids of the notes with the word in the field
+        self.matches = {}
+
+    def size(self):
+        """
+        Returns the (rough) bytes of memory used by the result
+        """
+        return len(self.notes) * SEARCH_NOTE_BYTES + \
+            sum(len(ids) for ids in self.matches.values()) * SEARCH_ID_BYTES
+
+    def filter(self, uid, search_fields):
+        """
+        Returns the notes of the result matching every word in one of the given fields,
+        in the order of the result (like searching these fields only)
+        returns whether matches had to be found as well (the size grew)
+        """
+        fields = [field for field in SEARCH_FIELDS if field in search_fields]
+        if not fields or not self.words:
+            return [], False
+        if len(fields) == len(SEARCH_FIELDS):
+            return self.notes, False
+        missing = [(word, field) for word in self.words for field in fields
+                   if (word, field) not in self.matches]
+        for word, field in missing:
+            self.matches[(word, field)] = get_search_note_ids(uid, word, [field])
+        note_ids = None
+        for word in self.words:
+            word_ids = set().union(*(self.matches[(word, field)] for field in fields))
+            note_ids = word_ids if note_ids is None else note_ids & word_ids
+        return [note for note in self.notes if note["id"] in note_ids], bool(missing)
+
+def get_search_cache():
+    """
+    Returns the search result cache of the app (of this worker process)
+    """
+    return current_app.extensions["meownotes_searches"]
+
+def cached_search(uid, search_string, search_fields=None, preview_length=0):
+    """
+    Returns the note summaries of the user matching the search (see get_search_notes)
+    the search is done in all fields once per search string and version of the notes
+    of the user, any search fields are then a filter of the cached result
+    Example use: cached_search(1, "uni note", ["title"], 80)
+    """
+    searches = get_search_cache()
+    words = search_string.lower().split()
+    key = (uid, get_data_version(uid), " ".join(words), preview_length)
+    result = searches.get(key)
+    if result is None:
+        result = SearchResult(words, get_search_notes(uid, search_string, None, preview_length))
+        searches.put(key, result, result.size())
+    if search_fields is None:
+        return result.notes
+    notes, grew = result.filter(uid, search_fields)
+    if grew:
+        searches.put(key, result, result.size())
+    return notes
+
+def init_app(app):
+    """
+    Create the fragment and search result caches of the app
+    """
+    app.extensions["meownotes_fragments"] = FragmentCache(app.config["FRAGMENT_CACHE_BYTES"])
+    app.extensions["meownotes_searches"] = FragmentCache(app.config["SEARCH_CACHE_BYTES"])
@@ -13,8 +13,124 @@ class Config():
     Main config for MeowNotes
     """
     DATABASE = MEOWNOTES_DB
+    # key the session cookies are signed with, random per process unless set
+    # from the environment (see load_deployment_config)
     SECRET_KEY = os.urandom(24)
     SESSION_TYPE = "null"
     SESSION_COOKIE_NAME = "MeowNotes"
     SESSION_PERMANENT = True
     PERMANENT_SESSION_LIFETIME = timedelta(minutes=10)
+    # number of notes per page of the dashboard
+    DASHBOARD_PAGE_SIZE = 24
+    # characters of the content shown as a preview in lists of notes
+    # 0 disables the preview, then lists never read the content of the notes
+    NOTE_PREVIEW_LENGTH = 0
+    # most note summaries returned by the API at a time (?limit=)
+    API_MAX_PAGE_SIZE = 100
+    # notes read from the db at a time while streaming an export
+    EXPORT_CHUNK_SIZE = 100
+    # notes inserted per transaction when importing
+    IMPORT_BATCH_SIZE = 500
+    # notes with at least this many bytes of content are stored compressed (zlib)
+    # 0 stores all notes as written, flask compress-notes applies a change to existing notes
+    NOTE_COMPRESS_MIN_BYTES = 2048
+    # zlib compression level of the notes (1 fastest to 9 smallest)
+    NOTE_COMPRESS_LEVEL = 6
+    # bytes of rendered fragments (notes of the dashboard, view of a note) cached per worker
+    FRAGMENT_CACHE_BYTES = 8 * 1024 * 1024
+    # bytes of search results (notes and per-field matches of a search) cached per worker
+    SEARCH_CACHE_BYTES = 4 * 1024 * 1024
+    # bytes of suggestion indexes (titles and tags of the notes of a user) kept per worker
+    SUGGEST_CACHE_BYTES = 16 * 1024 * 1024
+    # most suggestions returned at a time
+    SUGGEST_LIMIT = 10
+    # apply missing migrations (flask migrate) when the app is created
+    MIGRATE_ON_STARTUP = True
+    # seconds a worker trusts that the user of a session exists before checking the db again
+    SESSION_USER_TTL = 60
+    # number of session users remembered per worker
+    SESSION_USER_CACHE_SIZE = 1024
+    # static assets built with flask assets (fingerprinted and precompressed)
+    # used instead of the original files if they were built
+    USE_BUILT_ASSETS = True
+    ASSETS_DIST_DIR = os.path.join(ROOT, "static", "dist")
+    # weights of the Montserrat font used by the css, the others are left out of the build
+    ASSET_FONT_WEIGHTS = [300, 400, 500, 700]
+    # algorithm and work factor of new password hashes (werkzeug method string)
+    # a stored hash made with another method is replaced at the next login of its user
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+    # processes per worker hashing passwords, 0 hashes in the request thread
+    PASSWORD_HASH_WORKERS = 2
+    # most passwords being hashed per worker, more logins are answered with 503
+    PASSWORD_HASH_MAX_PENDING = 16
+    # seconds a login waits for its hash before it is answered with 503
+    PASSWORD_HASH_TIMEOUT = 10.0
+    # SQLite connections are pooled per worker process and tuned with these settings
+    DB_POOL_SIZE = 8
+    # seconds a request waits for a free connection when all are busy
+    DB_POOL_TIMEOUT = 5.0
+    # page cache per connection, negative values are in KiB (16 MB)
+    DB_CACHE_SIZE = -16000
+    # bytes of the db file read through memory-mapped I/O
+    DB_MMAP_SIZE = 64 * 1024 * 1024
+    # milliseconds to wait for a lock held by another writer
+    DB_BUSY_TIMEOUT = 5000
+    # compiled statements cached per connection, the queries use placeholders so they repeat
+    DB_STATEMENT_CACHE = 256
+    # commit the note and user writes of all requests of a worker in batches (group commit)
+    # by one writer thread, instead of one commit per request
+    WRITE_QUEUE_ENABLED = False
+    # seconds the writer waits for more writes after the first one of a batch
+    WRITE_QUEUE_WINDOW = 0.002
+    # most writes committed in one transaction
+    WRITE_QUEUE_MAX_BATCH = 64
+    # seconds a request waits for its write to be committed
+    WRITE_QUEUE_TIMEOUT = 10.0
+    # number of db files the notes are split into by user (shards), each with its own
+    # write lock; 0 keeps all notes in DATABASE, run flask shard-db before setting it
+    SHARD_COUNT = 0
+    # db file of each shard (%d is the number of the shard), DATABASE keeps the users
+    SHARD_DATABASE = os.path.join(ROOT, "meownotes-shard-%d.db")
+    # users whose shard is remembered per worker
+    SHARD_USER_CACHE_SIZE = 4096
+    # directory of the backups of flask backup (and flask restore)
+    BACKUP_DIR = os.path.join(ROOT, "backups")
+    # pages copied per step of a backup, the db is locked while a step runs
+    BACKUP_PAGES = 256
+    # seconds slept between the steps of a backup, so the requests are served meanwhile
+    BACKUP_SLEEP = 0.05
+    # times a backup starts over because the db was written to, before it gives up
+    BACKUP_MAX_RESTARTS = 10
+    # serve the counters of the connection pools of the worker as JSON at /dbstats
+    DB_STATS_ENABLED = False
+    # record request, query, and rendering times of the worker, served at /metrics
+    METRICS_ENABLED = False
+    # log the totals of each request as a JSON line (logger meownotes.metrics)
+    METRICS_LOG_REQUESTS = False
+
+def load_deployment_config(config, environ=None):
+    """
+    Override the (Flask app) config for a deployment with several worker processes or nodes
+    first from a python config file like this one (path in MEOWNOTES_SETTINGS),
+    then from the environment: MEOWNOTES_SECRET_KEY (or a file with it in
+    MEOWNOTES_SECRET_KEY_FILE) and MEOWNOTES_DATABASE
+    every worker has to sign the sessions with the same key to serve any user, so with
+    MEOWNOTES_ENV=production a missing key raises RuntimeError instead of using a random one
+    Example use: load_deployment_config(app.config)
+    """
+    if environ is None:
+        environ = os.environ
+    if environ.get("MEOWNOTES_SETTINGS"):
+        config.from_pyfile(environ["MEOWNOTES_SETTINGS"])
+    secret_key = environ.get("MEOWNOTES_SECRET_KEY")
+    if not secret_key and environ.get("MEOWNOTES_SECRET_KEY_FILE"):
+        with open(environ["MEOWNOTES_SECRET_KEY_FILE"], encoding="utf8") as key_file:
+            secret_key = key_file.read().strip()
+    if secret_key:
+        config["SECRET_KEY"] = secret_key
+    elif environ.get("MEOWNOTES_ENV") == "production" and \
+            config["SECRET_KEY"] == Config.SECRET_KEY:
+        raise RuntimeError("MEOWNOTES_SECRET_KEY or MEOWNOTES_SECRET_KEY_FILE has to be set "
+                           "in production, the workers have to share the session key")
+    if environ.get("MEOWNOTES_DATABASE"):
+        config["DATABASE"] = environ["MEOWNOTES_DATABASE"]
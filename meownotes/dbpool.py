@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+MeowNotes pool of tuned SQLite connections,
+shared by the requests (threads) of one worker process
+"""
+import os
+import queue
+import sqlite3
+import sys
+import threading
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from notecodec import register_functions
+
+class ConnectionPool():
+    """
+    Keeps up to size open connections to one SQLite db file
+    Connections are handed out one request at a time (acquire) and given back after (release)
+    Example use:
+    pool = ConnectionPool("meownotes.db", size=4)
+    meownotes_db = pool.acquire()
+    ...
+    pool.release(meownotes_db)
+    """
+    def __init__(self, database, size=8, timeout=5.0, pragmas=None, cached_statements=256):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        # cached_statements: number of compiled statements kept per connection (by query string)
+        # pragmas: applied to every new connection, e.g., {"journal_mode": "WAL"}
+        self.settings = {"cached_statements": cached_statements, "pragmas": pragmas or {}}
+        # last in first out so the most recently used (warm) connections are reused
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        # opened: connections currently open (idle or in use)
+        # hits: idle connection reused, misses: new connection opened,
+        # waits: all connections were busy and the request had to wait for one
+        self.counters = {"opened": 0, "hits": 0, "misses": 0, "waits": 0, "timeouts": 0}
+
+    def connect(self):
+        """
+        Open a new connection to the db file configured for this pool
+        """
+        # connections are used by one thread at a time but not always the same thread
+        connection = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=self.settings["cached_statements"]
+        )
+        connection.row_factory = sqlite3.Row
+        # e.g., note_content() used by the triggers of the search index
+        register_functions(connection)
+        for pragma, value in self.settings["pragmas"].items():
+            # e.g., PRAGMA journal_mode=WAL returns the mode, so read the result
+            connection.execute("PRAGMA %s=%s" % (pragma, value)).fetchall()
+        return connection
+
+    def acquire(self):
+        """
+        Get a connection for the current request
+        reuses an idle one, opens a new one if the pool is not full yet
+        or waits (at most timeout seconds) for one to be released
+        """
+        try:
+            connection = self._idle.get_nowait()
+            with self._lock:
+                self.counters["hits"] += 1
+            return connection
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self.counters["opened"] < self.size
+            if can_open:
+                self.counters["opened"] += 1
+                self.counters["misses"] += 1
+            else:
+                self.counters["waits"] += 1
+        if can_open:
+            try:
+                return self.connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self.counters["opened"] -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty as expt:
+            with self._lock:
+                self.counters["timeouts"] += 1
+            raise sqlite3.OperationalError("timed out waiting for a free database connection") \
+                from expt
+
+    def release(self, connection):
+        """
+        Give the connection back to the pool
+        anything the request did not commit is rolled back
+        """
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+            self._idle.put_nowait(connection)
+        except (sqlite3.Error, queue.Full):
+            self._discard(connection)
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+    def stats(self):
+        """
+        Returns the pool counters as a dict
+        """
+        with self._lock:
+            stats = {
+                "database": self.database,
+                "size": self.size,
+                "idle": self._idle.qsize()
+            }
+            stats.update(self.counters)
+        return stats
+
+    def _discard(self, connection):
+        with self._lock:
+            self.counters["opened"] -= 1
+        connection.close()
+
+############ One pool per db file and worker process ############
+
+class PoolRegistry():
+    """
+    The pools of one worker process, one per db file
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.pools = {}
+
+    def get(self, config, database=None):
+        """
+        Returns the pool for the db configured in the given (Flask app) config
+        (or another db file, e.g., a shard) creating it on first use
+        """
+        database = database or config["DATABASE"]
+        with self.lock:
+            # connections must not be shared with a forked worker process (e.g., uWSGI)
+            if os.getpid() != self.pid:
+                self.pools = {}
+                self.pid = os.getpid()
+            pool = self.pools.get(database)
+            if pool is None:
+                pool = ConnectionPool(database,
+                                      size=config["DB_POOL_SIZE"],
+                                      timeout=config["DB_POOL_TIMEOUT"],
+                                      pragmas=get_pragmas(config),
+                                      cached_statements=config["DB_STATEMENT_CACHE"])
+                self.pools[database] = pool
+        return pool
+
+    def all(self):
+        """
+        Returns the pools of this worker process
+        """
+        with self.lock:
+            return list(self.pools.values())
+
+    def clear(self):
+        """
+        Forget all pools, returns them (e.g., to be closed)
+        """
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools = {}
+        return pools
+
+POOLS = PoolRegistry()
+
+def get_pool(config, database=None):
+    """
+    Returns the pool of this worker for the db configured in the given (Flask app) config
+    or for the given db file with the settings of the config
+    """
+    return POOLS.get(config, database)
+
+def get_pragmas(config):
+    """
+    SQLite settings applied to each pooled connection, taken from the config
+    WAL lets readers continue while a note is being written
+    """
+    return {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": config["DB_CACHE_SIZE"],
+        "mmap_size": config["DB_MMAP_SIZE"],
+        "busy_timeout": config["DB_BUSY_TIMEOUT"]
+    }
+
+def pool_stats():
+    """
+    Returns the counters of all pools of this worker process
+    """
+    return [pool.stats() for pool in POOLS.all()]
+
+def close_pools():
+    """
+    Close all idle connections of all pools and forget the pools
+    e.g., before removing a (test) db file
+    """
+    for pool in POOLS.clear():
+        pool.close()
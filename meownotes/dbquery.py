@@ -4,19 +4,29 @@ MeowNotes functions to interact with the database,
 create/delete users and notes, retrieve search results
 """
 import sqlite3
+import collections
 import datetime
-import operator
+import functools
+import threading
+import time
 import os
 import sys
-import dateutil.parser
 import click
-from flask import current_app, g
+from flask import current_app
 from flask.cli import with_appcontext
 ROOT = os.path.dirname(os.path.realpath(__file__))
 # add the project directory to the sys.path
 if ROOT not in sys.path:
     sys.path = [ROOT] + sys.path
-from utils import format_value_for_db, create_input_obj, fix_tags
+from utils import format_param_for_db, create_input_obj, fix_tags, apply_text_changes, \
+    encode_page_cursor, decode_page_cursor, get_ui_date, read_import_notes
+from writequeue import get_write_queue
+from metrics import get_metrics, record_query
+from shards import get_connection, release_connections, get_database, all_databases, \
+    prepare_database
+from notecodec import compress_content, decompress_content, recompress_notes
+from migrations import migrate, get_version, run_in_transaction, rebuild_search_index, \
+    backfill_created_ts
 
 # App config - determines if debug output is shown in the console
 DEBUG = os.environ.get("MEOWNOTES_DEBUG", False)
@@ -31,41 +41,65 @@ if DEBUG:
 
 # START section based on tutorial
 
-def get_db():
+def get_db(uid=None):
     """
-    Start the connection to the db using the db file configured
+    Get a connection to the db file configured from the pool of this worker
+    or, with SHARD_COUNT, to the shard with the notes of the given user (see shards.py)
+    the connection is kept for the rest of the app context
     """
     if DEBUG:
         print(">>> INFO: MeowNotes database configured is: %s" % current_app.config["DATABASE"])
-    # db not already loaded in the "global" app context g
-    if "db" not in g:
-        g.db = sqlite3.connect(
-            current_app.config["DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
-    return g.db
+    return get_connection(get_database(uid))
 
 def close_db(db_error=None):
     """
-    Remove db from the "global" app context g
-    and close the connection
+    Give the connections of the app context back to their pools (for the next request)
     """
-    meownotes_db = g.pop("db", None)
-    if meownotes_db is not None:
-        # close the db connection
-        meownotes_db.close()
+    release_connections()
     if db_error is not None and DEBUG:
         print(db_error)
 
 def init_db():
     """
-    Based on the defined schema drop existing tables and recreate
+    Based on the defined schema drop existing tables and recreate (also of the shards)
     DANGER: this deletes existing data!
     """
-    meownotes_db = get_db()
     with current_app.open_resource("meownotes-schema.sql") as schema_file:
-        meownotes_db.executescript(schema_file.read().decode("utf8"))
+        schema = schema_file.read().decode("utf8")
+    for database in all_databases(current_app.config):
+        meownotes_db = get_connection(database)
+        meownotes_db.executescript(schema)
+        # the fresh tables are at version 0, bring them up to date
+        meownotes_db.execute("PRAGMA user_version = 0")
+        migrate(meownotes_db)
+
+def upgrade_db():
+    """
+    Apply the migrations the configured db is missing (e.g., on startup)
+    a db without tables is left as is, it is created with flask initdb
+    (missing shards are created, see shards.py)
+    """
+    meownotes_db = get_db()
+    db_notes_table = meownotes_db.execute("SELECT name from sqlite_master "
+                                          "WHERE type='table' AND name='notes'").fetchone()
+    if db_notes_table is None:
+        return []
+    for database in all_databases(current_app.config)[1:]:
+        prepare_database(get_connection(database))
+    return migrate(meownotes_db)
+
+def build_search_index():
+    """
+    Create the full-text search index (and the triggers keeping it in sync)
+    if missing, then (re)build it from the existing notes
+    Safe to run on a db with data, nothing is deleted (done for each shard too)
+    """
+    for meownotes_db in map(get_connection, all_databases(current_app.config)):
+        if get_version(meownotes_db) == 0:
+            # the index is the first migration, apply it so that the version is recorded
+            migrate(meownotes_db, target=1)
+        else:
+            run_in_transaction(meownotes_db, rebuild_search_index)
 
 # can now create a fresh db using the command line
 # flask initdb
@@ -78,98 +112,244 @@ def init_db_command():
     init_db()
     click.echo(">>> INFO: (Re)initialized the MeowNotes database.")
 
+# upgrade an existing db (keeping its data) using the command line
+# flask migrate
+@click.command("migrate")
+@with_appcontext
+def migrate_db_command():
+    """
+    Apply the migrations the db is missing
+    """
+    meownotes_db = get_db()
+    click.echo(">>> INFO: MeowNotes database is at version %d." % get_version(meownotes_db))
+    for version, name in migrate(meownotes_db):
+        click.echo(">>> INFO: Applied migration %d (%s)." % (version, name))
+    for database in all_databases(current_app.config)[1:]:
+        for version, name in prepare_database(get_connection(database)):
+            click.echo(">>> INFO: Applied migration %d (%s) to %s." % (version, name, database))
+    click.echo(">>> INFO: MeowNotes database is up to date (version %d)." %
+               get_version(meownotes_db))
+
+# fill the numeric creation time of notes missing it using the command line
+# flask backfill-dates
+@click.command("backfill-dates")
+@with_appcontext
+def backfill_dates_command():
+    """
+    Call the backfill of created_ts from date_created
+    """
+    updated = 0
+    for meownotes_db in map(get_connection, all_databases(current_app.config)):
+        updated += backfill_created_ts(meownotes_db)
+        meownotes_db.commit()
+    click.echo(">>> INFO: Filled the creation time of %d notes." % updated)
+
+# build the search index for an existing db using the command line
+# flask buildindex
+@click.command("buildindex")
+@with_appcontext
+def build_search_index_command():
+    """
+    Call the (re)build of the full-text search index
+    """
+    build_search_index()
+    click.echo(">>> INFO: (Re)built the MeowNotes search index.")
+
+# import the notes of a file (JSONL or ZIP from /export) for a user using the command line
+# flask import-notes kroshka notes.zip
+@click.command("import-notes")
+@click.argument("username")
+@click.argument("import_file", type=click.File("rb"))
+@click.option("--batch-size", default=None, type=int,
+              help="Notes inserted per transaction (default IMPORT_BATCH_SIZE).")
+@with_appcontext
+def import_notes_command(username, import_file, batch_size):
+    """
+    Call the import of the notes of a file for the given user
+    """
+    db_res = get_user_by_name(username.lower())
+    if not db_res:
+        raise click.ClickException("there is no user '%s'" % username)
+    if batch_size is None:
+        batch_size = current_app.config["IMPORT_BATCH_SIZE"]
+    def report(imported, errors):
+        click.echo(">>> INFO: Imported %d notes (%d skipped)." % (imported, len(errors)))
+    imported, errors = import_notes(parse_user(db_res[0])["uid"], read_import_notes(import_file),
+                                    batch_size, report)
+    for source, error in errors:
+        click.echo(">>> WARNING: Skipped %s: %s" % (source, error))
+    click.echo(">>> INFO: Imported %d notes for %s." % (imported, username))
+
+# store the existing notes with the current compression settings using the command line
+# flask compress-notes
+@click.command("compress-notes")
+@click.option("--batch-size", default=500, type=int, help="Notes updated per transaction.")
+@click.option("--vacuum", is_flag=True, help="Shrink the db file afterwards.")
+@with_appcontext
+def compress_notes_command(batch_size, vacuum):
+    """
+    Call the recompression of the existing notes and report the space saved
+    """
+    changed, before, after = 0, 0, 0
+    for database in all_databases(current_app.config):
+        counts = recompress_notes(get_connection(database), store_content, batch_size)
+        changed, before, after = changed + counts[0], before + counts[1], after + counts[2]
+        if vacuum:
+            get_connection(database).execute("VACUUM")
+    click.echo(">>> INFO: Stored %d notes again, their content went from %d to %d bytes "
+               "(%d bytes saved)." % (changed, before, after, before - after))
+    if vacuum:
+        click.echo(">>> INFO: Vacuumed the MeowNotes database.")
+
 def init_app(app):
     """
-    Make the initdb cmd available for the app
+    Make the initdb, migrate, backfill-dates, buildindex, import-notes,
+    and compress-notes cmds
+    available for the app
     """
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(backfill_dates_command)
+    app.cli.add_command(build_search_index_command)
+    app.cli.add_command(import_notes_command)
+    app.cli.add_command(compress_notes_command)
+    # bring an existing db up to date, the queries rely on the latest schema
+    if app.config["MIGRATE_ON_STARTUP"]:
+        with app.app_context():
+            upgrade_db()
 
 # END section based on tutorial
 
 ############ Functions to interact with the MeowNotes SQLite database ############
 
-def execute_select(query):
+def execute_select(query, params=(), uid=None):
     """
     Interacts with the db for SELECT
-    """
-    meownotes_db = get_db()
-    result = meownotes_db.execute(query).fetchall()
+    (the shard of the given user for queries of notes, see get_db)
+    """
+    meownotes_db = get_db(uid)
+    metrics = get_metrics()
+    if metrics is None:
+        return meownotes_db.execute(query, params).fetchall()
+    started = time.perf_counter()
+    result = meownotes_db.execute(query, params).fetchall()
+    record_query(metrics, query, time.perf_counter() - started, len(result))
     return result
 
-def execute_and_commit(query):
+def execute_and_commit(query, params=(), uid=None):
     """
-    Interacts with the db and commits
+    Interacts with the db and commits (the shard of the given user, see get_db)
     e.g., for INSERT, UPDATE, DELETE
-    """
-    meownotes_db = get_db()
-    meownotes_db.execute(query)
-    meownotes_db.commit()
+    returns the cursor (e.g., for its lastrowid or rowcount)
+    with WRITE_QUEUE_ENABLED the write is committed together with the writes of
+    other requests by the writer thread (see writequeue.py), then a WriteResult is returned
+    """
+    metrics = get_metrics()
+    started = time.perf_counter() if metrics is not None else None
+    if current_app.config["WRITE_QUEUE_ENABLED"]:
+        cursor = get_write_queue(current_app.config, get_database(uid)).write(
+            query, params, current_app.config["WRITE_QUEUE_TIMEOUT"])
+    else:
+        meownotes_db = get_db(uid)
+        cursor = meownotes_db.execute(query, params)
+        meownotes_db.commit()
+    if metrics is not None:
+        record_query(metrics, query, time.perf_counter() - started)
+    return cursor
 
 ############ SQL query templates where "PARAMETERS" will be replaced ############
 
 # basic queries structure
 GET_ALL = "SELECT * from TABLE"
-# e.g., SELECT * from users WHERE username='kroshka' AND uid=1
+# e.g., SELECT * from users WHERE username=? AND uid=?
 GET_CONDITIONAL = "SELECT * from TABLE WHERE CONDITIONS"
-# e.g., INSERT INTO users (username, uid) VALUES ('kroshka', 1)
+# e.g., INSERT INTO users (username, uid) VALUES (?, ?)
 INSERT = "INSERT INTO TABLE (COLS) VALUES (VALS)"
 DELETE_ALL = "DELETE FROM TABLE"
-# e.g., DELETE from users WHERE username='kroshka' AND uid=1
+# e.g., DELETE from users WHERE username=? AND uid=?
 DELETE_CONDITIONAL = "DELETE from TABLE WHERE CONDITIONS"
-# e.g., UPDATE table SET column1 = value1, column2 = value2, ... WHERE condition;
+# e.g., UPDATE table SET column1=?, column2=?, ... WHERE condition;
 UPDATE_CONDITIONAL = "UPDATE TABLE SET PARAMETERS WHERE CONDITIONS"
 
+QUERY_TEMPLATES = {
+    "GET_ALL": GET_ALL,
+    "GET_CONDITIONAL": GET_CONDITIONAL,
+    "INSERT": INSERT,
+    "DELETE_ALL": DELETE_ALL,
+    "DELETE_CONDITIONAL": DELETE_CONDITIONAL,
+    "UPDATE_CONDITIONAL": UPDATE_CONDITIONAL
+}
+
 def prepare_query(template, table, query_input_items=None):
     """
-    Forms the proper query using the given template and replacement values
+    Forms the proper query using the given template with a placeholder for each value
+    returns the query and the values to bind to the placeholders
     Expected form of query_input_items is:
     [{"val": "", "cols": [], "type": None, "condition": False}]
     Example use:
     prepare_query("GET_CONDITIONAL", "users",
         [{"val": "kroshka", "cols": ["username"], "type": "exact", "condition": True},
         {"val": 1, "cols": ["uid"], "type": "exact", "condition": True}])
+    Example output: ("SELECT * from users WHERE username=? AND uid=?", ("kroshka", 1))
     """
     if query_input_items is None:
         query_input_items = []
+    # the query only depends on the columns and types, not the values
+    # so the same query string is reused (and SQLite can reuse the compiled statement)
+    shape = tuple((tuple(item["cols"]), item["type"], item["condition"])
+                  for item in query_input_items)
+    query = build_query(template, table, shape)
+    # data values are bound first (COLS/PARAMETERS), then the conditions
+    values = [item["val"] for item in query_input_items if item["condition"] is False]
+    if "CONDITIONS" in QUERY_TEMPLATES[template]:
+        values += [format_param_for_db(item["val"], item["type"])
+                   for item in query_input_items if item["condition"] is True]
+    params = tuple(values)
+    if DEBUG:
+        print(query, params)
+    return query, params
+
+@functools.lru_cache(maxsize=256)
+def build_query(template, table, shape):
+    """
+    Forms the query string for the given template, table
+    and shape of the inputs (tuples of columns, type, and condition)
+    Example use: build_query("GET_CONDITIONAL", "notes", ((("uid",), "exact", True),))
+    Example output: "SELECT * from notes WHERE uid=?"
+    """
     # get the desired SQl string template
-    query = eval(template)
+    query = QUERY_TEMPLATES[template]
     # replace with the desired table
     query = query.replace("TABLE", table)
-    # parse the inputs to extract columns and values
+    # parse the inputs to extract columns
     columns = []
-    values = []
     # parameters are combos of columns and values that are not conditions
     parameters = []
     # conditions are conditions that must be fulfilled,
     # possible types (affect string form): exact, multi, contains
     conditions = []
-    for item in query_input_items:
-        # reformat the value if needed
-        value = format_value_for_db(item["val"], item["cols"], item["type"])
-        # add to the list of columns and values
+    for cols, input_type, condition in shape:
+        # add to the list of columns
         # if the cols and values are not conditions but data
-        if item["condition"] is False:
-            values.append(value)
-            columns.append(item["cols"][0])
-            parameters.append(item["cols"][0] + "=" + value)
+        if condition is False:
+            columns.append(cols[0])
+            parameters.append(cols[0] + "=?")
         # handle conditions
-        elif "CONDITIONS" in query and item["condition"] is True:
-            if item["type"] == "multi":
-                conditions.append(value + " in " + "(" + ",".join(item["cols"]) + ")")
-            elif item["type"] == "contains":
-                conditions.append("(" + ",".join(item["cols"]) + ") LIKE " + value)
+        elif "CONDITIONS" in query and condition is True:
+            if input_type == "multi":
+                conditions.append("? in " + "(" + ",".join(cols) + ")")
+            elif input_type == "contains":
+                conditions.append("(" + ",".join(cols) + ") LIKE ? ESCAPE '\\'")
             else:
-                conditions.append(item["cols"][0] + "=" + value)
+                conditions.append(cols[0] + "=?")
     if "CONDITIONS" in query:
         query = query.replace("CONDITIONS", " AND ".join(conditions))
     if "COLS" in query and "VALS" in query:
         query = query.replace("COLS", ", ".join(columns))
-        query = query.replace("VALS", ", ".join(values))
+        query = query.replace("VALS", ", ".join(["?"] * len(columns)))
     if "PARAMETERS" in query:
         query = query.replace("PARAMETERS", ", ".join(parameters))
-    if DEBUG:
-        print(query)
     return query
 
 ############ MeowNotes-specific functions for DB interaction ############
@@ -180,12 +360,13 @@ def get_all(table, uid=None):
     if UID is given, will limit to that user
     """
     if uid is None:
-        query = prepare_query("GET_ALL", table)
-        results = execute_select(query)
+        query, params = prepare_query("GET_ALL", table)
+        results = execute_select(query, params)
     else:
         query_input_items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True}]
-        query = prepare_query("GET_CONDITIONAL", table, query_input_items)
-        results = execute_select(query)
+        query, params = prepare_query("GET_CONDITIONAL", table, query_input_items)
+        # the users are in the directory, the rest in the shard of the user (see shards.py)
+        results = execute_select(query, params, uid if table != "users" else None)
     return results
 
 def delete_all(table, uid=None):
@@ -194,12 +375,13 @@ def delete_all(table, uid=None):
     if UID is given, will limit to that user
     """
     if uid is None:
-        query = prepare_query("DELETE_ALL", table)
+        query, params = prepare_query("DELETE_ALL", table)
     else:
         query_input_items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True}]
-        query = prepare_query("DELETE_CONDITIONAL", table, query_input_items)
+        query, params = prepare_query("DELETE_CONDITIONAL", table, query_input_items)
     try:
-        execute_and_commit(query)
+        execute_and_commit(query, params, uid if table != "users" else None)
+        msg = "All entries of '%s' were deleted." % table
     except Exception as expt:
         msg = "Notes were unable to be deleted! Error: " + str(expt)
     if DEBUG:
@@ -214,8 +396,8 @@ def get_user_by_name(username):
     """
     query_input_items = [{"val": username, "cols": ["username"],
                           "type": "exact", "condition": True}]
-    query = prepare_query("GET_CONDITIONAL", "users", query_input_items)
-    results = execute_select(query)
+    query, params = prepare_query("GET_CONDITIONAL", "users", query_input_items)
+    results = execute_select(query, params)
     return results
 
 def get_user_by_id(uid):
@@ -223,8 +405,8 @@ def get_user_by_id(uid):
     Retrieves all info of the given user given their uid
     """
     query_input_items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True}]
-    query = prepare_query("GET_CONDITIONAL", "users", query_input_items)
-    results = execute_select(query)
+    query, params = prepare_query("GET_CONDITIONAL", "users", query_input_items)
+    results = execute_select(query, params)
     return results
 
 def get_id_by_user(username):
@@ -236,14 +418,65 @@ def get_id_by_user(username):
     uid = db_user["uid"]
     return uid
 
+GET_DATA_VERSION = "SELECT version from user_data_versions WHERE uid=?"
+
+def get_data_version(uid):
+    """
+    Returns the version of the notes of the given user
+    it changes with every note created, updated, or deleted (see add_user_data_version)
+    """
+    results = execute_select(GET_DATA_VERSION, (uid,), uid)
+    if not results:
+        return 0
+    return results[0]["version"]
+
+# uid -> (username, time checked) of the users of recent sessions, most recent last
+# lets most requests trust the uid stored in the session without a db lookup
+KNOWN_USERS = collections.OrderedDict()
+KNOWN_USERS_LOCK = threading.Lock()
+
+def check_session_user(uid, username):
+    """
+    Returns True if the user stored in a session still exists (with this uid and username)
+    a positive answer is remembered for SESSION_USER_TTL seconds by this worker
+    Example use: check_session_user(session["uid"], session["username"])
+    """
+    now = time.monotonic()
+    with KNOWN_USERS_LOCK:
+        known = KNOWN_USERS.get(uid)
+        if known is not None and known[0] == username and \
+                now - known[1] < current_app.config["SESSION_USER_TTL"]:
+            KNOWN_USERS.move_to_end(uid)
+            return True
+    db_res = get_user_by_id(uid)
+    # a deleted uid can be given to the next new user, so the username has to match too
+    if len(db_res) != 1 or parse_user(db_res[0])["username"] != username:
+        forget_session_user(uid)
+        return False
+    with KNOWN_USERS_LOCK:
+        KNOWN_USERS[uid] = (username, now)
+        KNOWN_USERS.move_to_end(uid)
+        while len(KNOWN_USERS) > current_app.config["SESSION_USER_CACHE_SIZE"]:
+            KNOWN_USERS.popitem(last=False)
+    return True
+
+def forget_session_user(uid):
+    """
+    Remove a user from the users known to exist, e.g., when it is deleted
+    """
+    with KNOWN_USERS_LOCK:
+        KNOWN_USERS.pop(uid, None)
+
 def delete_user_by_id(uid):
     """
     Deletes a given user
     """
     query_input_items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True}]
-    query = prepare_query("DELETE_CONDITIONAL", "users", query_input_items)
+    query, params = prepare_query("DELETE_CONDITIONAL", "users", query_input_items)
     try:
-        execute_and_commit(query)
+        execute_and_commit(query, params)
+        # sessions of this user are logged out on their next request
+        forget_session_user(uid)
         msg = "User with id '%s' was deleted." % str(uid)
     except Exception as expt:
         msg = "User was unable to be deleted! Error: " + str(expt)
@@ -263,10 +496,10 @@ def create_user(username, password):
                           "type": "exact", "condition": False},
                          {"val": password, "cols": ["password"],
                           "type": "exact", "condition": False}]
-    query = prepare_query("INSERT", "users", query_input_items)
+    query, params = prepare_query("INSERT", "users", query_input_items)
     # if the user already exists, return a warning message
     try:
-        execute_and_commit(query)
+        execute_and_commit(query, params)
         msg = "Welcome! An account for %s was created!" % username
     except sqlite3.IntegrityError:
         msg = "Oh no! That username already exists! Choose another (or enter the correct password)."
@@ -274,36 +507,173 @@ def create_user(username, password):
         print(msg)
     return msg
 
+def set_user_password(uid, password):
+    """
+    Replace the (hashed) password of a user, e.g., with a hash made with a new method
+    Example use: set_user_password(1, "scrypt:32768:8:1$...")
+    """
+    query_input_items = [{"val": password, "cols": ["password"],
+                          "type": "exact", "condition": False},
+                         {"val": uid, "cols": ["uid"], "type": "exact", "condition": True}]
+    query, params = prepare_query("UPDATE_CONDITIONAL", "users", query_input_items)
+    execute_and_commit(query, params)
+
 # NOTE-specific functions
 
+# functions called as listener(uid, change, note_id, note) after this worker changed notes
+# change is "insert", "update", "delete" (one note), or "import" (many notes, no note_id)
+# note is a dict with the title and tags of the note (None if deleted)
+NOTE_CHANGE_LISTENERS = []
+
+def notify_note_change(uid, change, note_id=None, note=None):
+    """
+    Tell the listeners (e.g., the suggestion indexes) about a committed change of notes
+    """
+    for listener in NOTE_CHANGE_LISTENERS:
+        listener(uid, change, note_id, note)
+
+# columns of a note needed to list it (e.g., dashboard, search results)
+# the content is left out so that it is not read from disk for lists
+NOTE_SUMMARY = "notes.id, notes.uid, notes.date_created, notes.created_ts, " \
+               "notes.title, notes.tags"
+
+def prepare_summary_query(query, preview_length=0):
+    """
+    Replaces SUMMARY in the query with the summary columns of a note
+    and a preview column with the first preview_length characters of the content
+    (NULL if preview_length is 0, then the content is not read at all)
+    returns the query and the parameters to bind before the others
+    Example use: prepare_summary_query("SELECT SUMMARY from notes WHERE uid=?", 80)
+    Example output: ("SELECT notes.id, ..., substr(notes.content, 1, ?) AS preview
+    from notes WHERE uid=?", (80,))
+    """
+    if preview_length:
+        # only a compressed content is decompressed (see notecodec.py)
+        columns = NOTE_SUMMARY + ", substr(iif(notes.codec, note_content(notes.content, " \
+            "notes.codec), notes.content), 1, ?) AS preview"
+        return query.replace("SUMMARY", columns), (preview_length,)
+    return query.replace("SUMMARY", NOTE_SUMMARY + ", NULL AS preview"), ()
+
 def get_notes_by_user(uid):
     """
     Retrieves all notes for the given user
     """
     query_input_items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True}]
-    query = prepare_query("GET_CONDITIONAL", "notes", query_input_items)
-    results = execute_select(query)
+    query, params = prepare_query("GET_CONDITIONAL", "notes", query_input_items)
+    results = execute_select(query, params, uid)
     return results
 
+# one page of the notes of a user, oldest first
+# pages are found by the (created_ts, id) of the last note of the previous page (keyset)
+# so that every page is read from the index the same way as the first one
+GET_NOTES_PAGE = "SELECT SUMMARY from notes WHERE uid=? " \
+                 "ORDER BY created_ts, id LIMIT ?"
+GET_NOTES_PAGE_AFTER = "SELECT SUMMARY from notes WHERE uid=? AND (created_ts, id) > (?, ?) " \
+                       "ORDER BY created_ts, id LIMIT ?"
+# the previous page is read backwards from the first note of the current page
+GET_NOTES_PAGE_BEFORE = "SELECT SUMMARY from notes WHERE uid=? AND (created_ts, id) < (?, ?) " \
+                        "ORDER BY created_ts DESC, id DESC LIMIT ?"
+
+def get_notes_page(uid, after=None, limit=24, preview_length=0, before=None):
+    """
+    Retrieves one page of note summaries (see prepare_summary_query) of a user, oldest first
+    after (or before) is the cursor of the page to show (None for the first page)
+    returns the notes and the cursors of the next and previous pages (None if no such page)
+    Example use: get_notes_page(1, "1557065714_3", 24)
+    """
+    position = decode_page_cursor(before)
+    if position is not None:
+        query, params = prepare_summary_query(GET_NOTES_PAGE_BEFORE, preview_length)
+        results = execute_select(query, params + (uid,) + position + (limit + 1,), uid)
+        # read one more note than shown to know if there is a previous page
+        has_previous = len(results) > limit
+        results = results[:limit][::-1]
+        has_next = True
+    else:
+        position = decode_page_cursor(after)
+        # read one more note than shown to know if there is a next page
+        if position is None:
+            query, params = prepare_summary_query(GET_NOTES_PAGE, preview_length)
+            results = execute_select(query, params + (uid, limit + 1), uid)
+        else:
+            query, params = prepare_summary_query(GET_NOTES_PAGE_AFTER, preview_length)
+            results = execute_select(query, params + (uid,) + position + (limit + 1,), uid)
+        has_previous = position is not None
+        has_next = len(results) > limit
+        results = results[:limit]
+    if not results:
+        return results, None, None
+    next_cursor = encode_page_cursor(results[-1]["created_ts"], results[-1]["id"]) \
+        if has_next else None
+    previous_cursor = encode_page_cursor(results[0]["created_ts"], results[0]["id"]) \
+        if has_previous else None
+    return results, next_cursor, previous_cursor
+
+GET_NOTES_EXPORT = "SELECT * from notes WHERE uid=? ORDER BY created_ts, id"
+
+def iter_notes_by_user(uid, chunk_size=100):
+    """
+    Yields all notes of the given user (parsed, oldest first) without reading them all at once
+    the rows are fetched from one cursor chunk_size at a time
+    Example use: for note in iter_notes_by_user(1): ...
+    """
+    cursor = get_db(uid).execute(GET_NOTES_EXPORT, (uid,))
+    try:
+        while True:
+            db_notes = cursor.fetchmany(chunk_size)
+            if not db_notes:
+                return
+            for db_note in db_notes:
+                yield parse_note(db_note)
+    finally:
+        cursor.close()
+
 def get_note_by_id(uid, note_id):
     """
     Retrieves a note given a uid and note id
     """
     query_input_items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True},
                          {"val": note_id, "cols": ["id"], "type": "exact", "condition": True}]
-    query = prepare_query("GET_CONDITIONAL", "notes", query_input_items)
-    results = execute_select(query)
+    query, params = prepare_query("GET_CONDITIONAL", "notes", query_input_items)
+    results = execute_select(query, params, uid)
     return results
 
-def delete_note_by_id(uid, note_id):
+# the version of a note is read from the (uid, id, version) index, without reading the note
+# (the version column comes after the content, reading it from the table reads the content too)
+GET_NOTE_VERSION = "SELECT version from notes INDEXED BY notes_uid_id_version " \
+                   "WHERE uid=? AND id=?"
+
+def get_note_version(uid, note_id):
     """
-    Deletes a note given a ui and note id
+    Returns the version of a note given a uid and note id (None if there is no such note)
+    """
+    results = execute_select(GET_NOTE_VERSION, (uid, note_id), uid)
+    if not results:
+        return None
+    return results[0]["version"]
+
+def remove_note(uid, note_id, expected_version=None):
+    """
+    Deletes a note given a uid and note id
+    only if it is still at expected_version (if given)
+    returns the number of notes deleted (0 or 1)
     """
     query_input_items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True},
                          {"val": note_id, "cols": ["id"], "type": "exact", "condition": True}]
-    query = prepare_query("DELETE_CONDITIONAL", "notes", query_input_items)
+    if expected_version is not None:
+        query_input_items.append(create_input_obj(expected_version, ["version"], "exact", True))
+    query, params = prepare_query("DELETE_CONDITIONAL", "notes", query_input_items)
+    deleted = execute_and_commit(query, params, uid).rowcount
+    if deleted:
+        notify_note_change(uid, "delete", note_id)
+    return deleted
+
+def delete_note_by_id(uid, note_id):
+    """
+    Deletes a note given a ui and note id
+    """
     try:
-        execute_and_commit(query)
+        remove_note(uid, note_id)
         msg = "Note with id '%s' was deleted." % str(note_id)
     except Exception as expt:
         msg = "Note was unable to be deleted! Error: " + str(expt)
@@ -311,23 +681,50 @@ def delete_note_by_id(uid, note_id):
         print(msg)
     return msg
 
-def create_note(uid, title, tags, content):
+def store_content(content):
     """
-    Create a new note given a title, tags, and content
-    Example use: create_note(1, "Test Title", "uni,se", "Content of the note about uni")
+    Returns the value to store for the content of a note and its codec
+    (compressed from NOTE_COMPRESS_MIN_BYTES on, see notecodec.py)
+    """
+    return compress_content(content, current_app.config["NOTE_COMPRESS_MIN_BYTES"],
+                            current_app.config["NOTE_COMPRESS_LEVEL"])
+
+def prepare_note_insert(uid, note):
+    """
+    Forms the INSERT of a note (dict with title, tags, content, date_created, and created_ts)
+    returns the query and the values to bind (the query is the same for all notes)
     """
-    timestamp = datetime.datetime.now().isoformat()
     # check if the tags are an array, if yes make them a comma-separated string
-    tags = fix_tags(tags)
+    tags = fix_tags(note["tags"])
+    content, codec = store_content(note["content"])
     query_input_items = []
-    inputs = [(uid, ["uid"]), (timestamp, ["date_created"]),
-              (title, ["title"]), (tags, ["tags"]), (content, ["content"])]
+    inputs = [(uid, ["uid"]), (note["date_created"], ["date_created"]),
+              (note["created_ts"], ["created_ts"]), (note["title"], ["title"]),
+              (tags, ["tags"]), (content, ["content"]), (codec, ["codec"])]
     for item in inputs:
         query_input_items.append(create_input_obj(item[0], item[1]))
-    query = prepare_query("INSERT", "notes", query_input_items)
+    return prepare_query("INSERT", "notes", query_input_items)
+
+def add_note(uid, title, tags, content):
+    """
+    Insert a new note given a title, tags, and content, returns the id of the note
+    """
+    now = datetime.datetime.now()
+    query, params = prepare_note_insert(uid, {"title": title, "tags": tags, "content": content,
+                                              "date_created": now.isoformat(),
+                                              "created_ts": int(now.timestamp())})
+    note_id = execute_and_commit(query, params, uid).lastrowid
+    notify_note_change(uid, "insert", note_id, {"title": title, "tags": fix_tags(tags)})
+    return note_id
+
+def create_note(uid, title, tags, content):
+    """
+    Create a new note given a title, tags, and content
+    Example use: create_note(1, "Test Title", "uni,se", "Content of the note about uni")
+    """
     # try to insert
     try:
-        execute_and_commit(query)
+        add_note(uid, title, tags, content)
         msg = "Note with title '%s' was created." % title
     except Exception as expt:
         msg = "Note was unable to be created! Error: " + str(expt)
@@ -335,23 +732,121 @@ def create_note(uid, title, tags, content):
         print(msg)
     return msg
 
-def update_note(uid, note_id, title, tags, content):
+def import_notes(uid, import_notes_read, batch_size=500, progress=None):
+    """
+    Insert the notes read from an import file (see utils.read_import_notes) for the given user
+    batch_size notes at a time, each batch in one transaction (then progress(imported, errors))
+    notes that can not be read or inserted are reported and skipped, the import continues
+    returns the number of notes imported and the list of (source, error) of the skipped notes
+    Example use: import_notes(1, read_import_notes(open("notes.jsonl", "rb")), 1000)
+    """
+    meownotes_db = get_db(uid)
+    imported = 0
+    errors = []
+    batch = []
+    for source, note, error in import_notes_read:
+        if note is None:
+            errors.append((source, error))
+            continue
+        batch.append((source, prepare_note_insert(uid, note)))
+        if len(batch) >= batch_size:
+            imported += insert_note_batch(meownotes_db, batch, errors)
+            batch = []
+            if progress is not None:
+                progress(imported, errors)
+    if batch:
+        imported += insert_note_batch(meownotes_db, batch, errors)
+        if progress is not None:
+            progress(imported, errors)
+    if imported:
+        notify_note_change(uid, "import")
+    return imported, errors
+
+def insert_note_batch(meownotes_db, batch, errors):
+    """
+    Insert a batch of notes [(source, (query, params))] in one transaction
+    if the batch fails, its notes are inserted one at a time to skip only the failing ones
+    (added to errors), returns the number of notes inserted
+    """
+    # all notes are inserted with the same query
+    query = batch[0][1][0]
+    try:
+        run_in_transaction(meownotes_db, lambda db: db.executemany(
+            query, [params for _, (_, params) in batch]))
+        return len(batch)
+    except sqlite3.Error:
+        pass
+    inserted = 0
+    meownotes_db.execute("BEGIN IMMEDIATE")
+    for source, (_, params) in batch:
+        meownotes_db.execute("SAVEPOINT import_note")
+        try:
+            meownotes_db.execute(query, params)
+            inserted += 1
+        except sqlite3.Error as expt:
+            meownotes_db.execute("ROLLBACK TO import_note")
+            errors.append((source, str(expt)))
+        meownotes_db.execute("RELEASE import_note")
+    meownotes_db.commit()
+    return inserted
+
+def save_note(uid, note_id, note, expected_version=None):
     """
-    Update an existing note by the uid and note id
-    Example use: update_note(1,1, "New note title", "", "This is a note with content")
+    Update the title, tags, and content (dict) of an existing note by the uid and note id
+    only if it is still at expected_version (if given), the version is increased by a trigger
+    returns the number of notes updated (0 or 1)
+    Example use: save_note(1, 1, {"title": "Title", "tags": "", "content": "Note"}, 3)
     """
     # check if the tags are an array, if yes make them a comma-separated string
-    tags = fix_tags(tags)
+    tags = fix_tags(note["tags"])
+    content, codec = store_content(note["content"])
     query_input_items = []
     inputs = [(uid, ["uid"], "exact", True), (note_id, ["id"], "exact", True),
-              (title, ["title"], None, False), (tags, ["tags"], None, False),
-              (content, ["content"], None, False)]
+              (note["title"], ["title"], None, False), (tags, ["tags"], None, False),
+              (content, ["content"], None, False), (codec, ["codec"], None, False)]
+    if expected_version is not None:
+        inputs.append((expected_version, ["version"], "exact", True))
     for item in inputs:
         query_input_items.append(create_input_obj(item[0], item[1], item[2], item[3]))
-    query = prepare_query("UPDATE_CONDITIONAL", "notes", query_input_items)
+    query, params = prepare_query("UPDATE_CONDITIONAL", "notes", query_input_items)
+    updated = execute_and_commit(query, params, uid).rowcount
+    if updated:
+        notify_note_change(uid, "update", note_id, {"title": note["title"], "tags": tags})
+    return updated
+
+def patch_note(uid, note_id, base_version, changes, fields=None):
+    """
+    Apply text changes (see utils.apply_text_changes) to the content of a note still at
+    base_version and replace the title and/or tags given in fields, written only if changed
+    returns "saved", "unchanged", "conflict" (at another version), or "missing" and the
+    version of the note after, raises ValueError if the changes do not fit the content
+    Example use: patch_note(1, 4, 2, [{"start": 0, "end": 3, "text": "Dog"}])
+    """
+    db_notes = get_note_by_id(uid, note_id)
+    if not db_notes:
+        return "missing", None
+    current = parse_note(db_notes[0])
+    if current["version"] != base_version:
+        return "conflict", current["version"]
+    note = {"title": current["title"], "tags": current["tags"],
+            "content": apply_text_changes(current["content"], changes)}
+    note.update(fields or {})
+    # the note was just read, so comparing it is cheaper than writing the same row again
+    if (note["title"], fix_tags(note["tags"]), note["content"]) == \
+            (current["title"], fix_tags(current["tags"]), current["content"]):
+        return "unchanged", base_version
+    if not save_note(uid, note_id, note, base_version):
+        return "conflict", get_note_version(uid, note_id)
+    return "saved", base_version + 1
+
+def update_note(uid, note_id, title, tags, content):
+    """
+    Update an existing note by the uid and note id
+    Example use: update_note(1,1, "New note title", "", "This is a note with content")
+    """
     # try to modify
     try:
-        execute_and_commit(query)
+        save_note(uid, note_id, {"title": title, "tags": tags, "content": content})
         msg = "Note with title '%s' was modified." % title
     except Exception as expt:
         msg = "Note was unable to be modified! Error: " + str(expt)
@@ -359,49 +854,91 @@ def update_note(uid, note_id, title, tags, content):
         print(msg)
     return msg
 
-def get_search_notes(uid, search_string, search_fields=None):
+# TAG-specific functions, answered from the note_tags table (see add_note_tags)
+
+# number of notes of a user with each tag, read from the primary key of note_tags
+GET_TAG_COUNTS = "SELECT tag, count(*) AS notes from note_tags WHERE uid=? " \
+                 "GROUP BY tag ORDER BY tag"
+# the notes of a user with a tag, oldest first
+# the tag is trimmed and lowercase like the tags stored in note_tags
+GET_TAG_NOTES = "SELECT SUMMARY from note_tags JOIN notes ON notes.id = note_tags.note_id " \
+                "WHERE note_tags.uid=? AND note_tags.tag=lower(trim(?, ' ' || char(9, 10, 13))) " \
+                "ORDER BY notes.created_ts, notes.id"
+
+def get_tag_counts(uid):
+    """
+    Retrieves the tags of the given user and the number of notes with each tag
+    Example output: [("se", 1), ("uni", 2)]
+    """
+    return [(row["tag"], row["notes"]) for row in execute_select(GET_TAG_COUNTS, (uid,), uid)]
+
+def get_notes_by_tag(uid, tag, preview_length=0):
+    """
+    Retrieves the note summaries (see prepare_summary_query) of the given user with a tag
+    (case and surrounding spaces of the tag do not matter)
+    Example use: get_notes_by_tag(1, "uni")
+    """
+    query, params = prepare_summary_query(GET_TAG_NOTES, preview_length)
+    return execute_select(query, params + (uid, tag), uid)
+
+# full-text search of the notes, ranked by relevance (BM25, see meownotes-fts.sql)
+# the MATCH expression includes the owner of the notes, see prepare_search_match
+SEARCH_NOTES = "SELECT SUMMARY from notes_fts JOIN notes ON notes.id = notes_fts.rowid " \
+               "WHERE notes_fts MATCH ? AND notes.uid = ? ORDER BY notes_fts.rank"
+
+# columns of the notes that can be searched
+SEARCH_FIELDS = ["title", "tags", "content"]
+
+def prepare_search_match(uid, search_string, search_fields=None):
+    """
+    Forms the FTS5 MATCH expression for the given search string in the notes of a user
+    each word of the search string has to match the start of a word in the note
+    limited to the given search fields (all searchable columns if None)
+    returns None if nothing can match
+    Example use: prepare_search_match(1, "uni note", ["title"])
+    Example output: 'owner : "u1" AND {title} : ("uni"* "note"*)'
+    """
+    if search_fields is None:
+        search_fields = SEARCH_FIELDS
+    columns = [field for field in SEARCH_FIELDS if field in search_fields]
+    # quote every word so that FTS5 syntax in the input is treated as plain text
+    words = ['"' + word.replace('"', '""') + '"*' for word in search_string.split()]
+    if not columns or not words:
+        return None
+    match = 'owner : "u%d" AND {%s} : (%s)' % (int(uid), " ".join(columns), " ".join(words))
+    if DEBUG:
+        print(match)
+    return match
+
+def get_search_notes(uid, search_string, search_fields=None, preview_length=0):
     """
     Retrieve all notes for the current user that match the search
     searches the "title", "tags", and "content" columns based on what's given in search fields
-    returns a list of notes
+    returns a list of note summaries (see prepare_summary_query), best matches first
     Example output: [(1, 1, '2019-05-05T16:15:14.429235',
-    'My First Note', 'uni', 'This is the text of the note.')]
-    """
-    # search for matches in the TITLE for this user
-    title_query = prepare_query("GET_CONDITIONAL", "notes",
-                                [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True},
-                                 {"val": search_string, "cols": ["title"],
-                                  "type": "contains", "condition": True}])
-    title_results = execute_select(title_query)
-    # search for matches in the TAGS for this user
-    tags_query = prepare_query("GET_CONDITIONAL", "notes",
-                               [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True},
-                                {"val": search_string, "cols": ["tags"],
-                                 "type": "contains", "condition": True}])
-    tags_results = execute_select(tags_query)
-    # search for matches in the CONTENT for this user
-    contents_query = prepare_query("GET_CONDITIONAL", "notes",
-                                   [{"val": uid, "cols": ["uid"],
-                                     "type": "exact", "condition": True},
-                                    {"val": search_string, "cols": ["content"],
-                                     "type": "contains", "condition": True}])
-    contents_results = execute_select(contents_query)
-    # combine the three result lists
-    results = []
-    if search_fields is not None:
-        if "title" in search_fields:
-            results += title_results
-        if "tags" in search_fields:
-            results += tags_results
-        if "content" in search_fields:
-            results += contents_results
-    else:
-        results = title_results + tags_results + contents_results
-    # convert into a set in order to remove duplicate results
-    # then convert back into a list
-    results = list(set(results))
+    'My First Note', 'uni', None)]
+    """
+    match = prepare_search_match(uid, search_string, search_fields)
+    if match is None:
+        return []
+    query, params = prepare_summary_query(SEARCH_NOTES, preview_length)
+    results = execute_select(query, params + (match, uid), uid)
     return results
 
+# ids of the notes matching a search (no ranking, no columns of the notes table are read)
+SEARCH_NOTE_IDS = "SELECT rowid from notes_fts WHERE notes_fts MATCH ?"
+
+def get_search_note_ids(uid, search_string, search_fields=None):
+    """
+    Retrieve the ids of the notes of the user that match the search (see get_search_notes)
+    Example use: get_search_note_ids(1, "uni", ["tags"])
+    Example output: {1, 4}
+    """
+    match = prepare_search_match(uid, search_string, search_fields)
+    if match is None:
+        return set()
+    return {row[0] for row in execute_select(SEARCH_NOTE_IDS, (match,), uid)}
+
 ############ Functions to parse db results and return as objects ############
 
 def parse_user(db_result):
@@ -415,31 +952,49 @@ def parse_user(db_result):
     }
     return result
 
-def parse_note(db_note):
+def parse_note_fields(db_note):
     """
-    Breaks down a note db result into a dict with keys
+    Breaks down the fields shared by note and note summary db results into a dict with keys
     """
-    # include a datetime that can be output directly in the ui
-    real_date = dateutil.parser.parse(db_note[2])
     result = {
-        "note_id": db_note[0],
-        "uid": db_note[1],
-        "date_created": db_note[2],
-        "ui_date": real_date.strftime('%b %d, %H:%m'),
-        "title": db_note[3],
-        "tags": db_note[4].split(","),
-        "content": db_note[5],
+        "note_id": db_note["id"],
+        "uid": db_note["uid"],
+        "date_created": db_note["date_created"],
+        "created_ts": db_note["created_ts"],
+        # include a date that can be output directly in the ui
+        "ui_date": get_ui_date(db_note["created_ts"], db_note["date_created"]),
+        "title": db_note["title"],
+        "tags": db_note["tags"].split(","),
     }
     return result
 
+def parse_note(db_note):
+    """
+    Breaks down a note db result into a dict with keys
+    """
+    result = parse_note_fields(db_note)
+    result["content"] = decompress_content(db_note["content"], db_note["codec"])
+    result["version"] = db_note["version"]
+    return result
+
+def parse_note_summary(db_note):
+    """
+    Breaks down a note summary db result (no content) into a dict with keys
+    """
+    result = parse_note_fields(db_note)
+    result["preview"] = db_note["preview"]
+    return result
+
+def process_note_summaries(db_notes):
+    """
+    Takes a list of DB note summary results and puts them into a list of objects
+    (in the order they were retrieved)
+    """
+    return [parse_note_summary(db_note) for db_note in db_notes]
+
 def process_note_results(db_notes):
     """
     Takes a list of DB note results and puts them into a parsable list of objects
+    (in the order they were retrieved, queries order them in SQL)
     """
-    parsed_notes = []
-    # Make a list of note objects
-    for db_note in db_notes:
-        parsed_notes.append(parse_note(db_note))
-    # Sort the list by date
-    parsed_notes.sort(key=operator.itemgetter('date_created'))
-    return parsed_notes
+    return [parse_note(db_note) for db_note in db_notes]
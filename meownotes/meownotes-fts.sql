@@ -0,0 +1,34 @@
+-- what the search index reads: the searchable columns of the notes and who owns them
+-- the owner ('u' followed by the uid) is part of the match so a search only reads that user's notes
+CREATE VIEW IF NOT EXISTS "notes_fts_source" AS
+ SELECT "id", 'u' || "uid" AS "owner", "title", "tags", "content" FROM "notes";
+
+CREATE VIRTUAL TABLE IF NOT EXISTS "notes_fts" USING fts5(
+ "owner",
+ "title",
+ "tags",
+ "content",
+ content="notes_fts_source",
+ content_rowid="id",
+ tokenize="unicode61 remove_diacritics 2"
+);
+
+-- rank by BM25 of the searched columns, the owner matches every note of the user equally
+INSERT INTO "notes_fts" ("notes_fts", "rank") VALUES ('rank', 'bm25(0.0, 1.0, 1.0, 1.0)');
+
+CREATE TRIGGER IF NOT EXISTS "notes_fts_insert" AFTER INSERT ON "notes" BEGIN
+ INSERT INTO "notes_fts" ("rowid", "owner", "title", "tags", "content")
+ VALUES (new."id", 'u' || new."uid", new."title", new."tags", new."content");
+END;
+
+CREATE TRIGGER IF NOT EXISTS "notes_fts_delete" AFTER DELETE ON "notes" BEGIN
+ INSERT INTO "notes_fts" ("notes_fts", "rowid", "owner", "title", "tags", "content")
+ VALUES ('delete', old."id", 'u' || old."uid", old."title", old."tags", old."content");
+END;
+
+CREATE TRIGGER IF NOT EXISTS "notes_fts_update" AFTER UPDATE OF "uid", "title", "tags", "content" ON "notes" BEGIN
+ INSERT INTO "notes_fts" ("notes_fts", "rowid", "owner", "title", "tags", "content")
+ VALUES ('delete', old."id", 'u' || old."uid", old."title", old."tags", old."content");
+ INSERT INTO "notes_fts" ("rowid", "owner", "title", "tags", "content")
+ VALUES (new."id", 'u' || new."uid", new."title", new."tags", new."content");
+END;
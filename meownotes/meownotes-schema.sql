@@ -1,3 +1,8 @@
+drop view if exists "notes_fts_source";
+drop table if exists "notes_fts";
+drop table if exists "user_data_versions";
+drop table if exists "note_tags";
+drop table if exists "user_shards";
 drop table if exists "notes";
 CREATE TABLE "notes" (
  "id" INTEGER UNIQUE,
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+MeowNotes metrics of this worker process: request latency, SQL queries,
+db connection waits, and template rendering, served in the Prometheus text format
+at /metrics and/or logged as one JSON line per request
+nothing is recorded unless METRICS_ENABLED or METRICS_LOG_REQUESTS is set in the config
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from flask import Blueprint, Response, current_app, request, g, abort, \
+    before_render_template, template_rendered
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from dbpool import pool_stats
+from writequeue import write_queue_stats
+
+# upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# name -> (type, help) of the metrics, in the order they are served
+METRIC_INFO = {
+    "meownotes_request_seconds": ("histogram", "Time to handle a request (streamed bodies "
+                                               "not included)"),
+    "meownotes_query_seconds": ("histogram", "Time to execute an SQL query"),
+    "meownotes_query_rows_total": ("counter", "Rows returned by an SQL query"),
+    "meownotes_db_acquire_seconds": ("histogram", "Time to get a connection from the pool"),
+    "meownotes_template_render_seconds": ("histogram", "Time to render a template"),
+    "meownotes_db_pool_connections": ("gauge", "Connections of a pool (open or idle)"),
+    "meownotes_db_pool_acquires_total": ("counter", "Connections handed out by a pool "
+                                                    "(hit, miss) or waited for (wait, timeout)"),
+    "meownotes_write_queue_writes_total": ("counter", "Writes committed or rolled back by the "
+                                                      "writer thread (WRITE_QUEUE_ENABLED)"),
+    "meownotes_write_queue_batches_total": ("counter", "Transactions of the writer thread"),
+    "meownotes_fragment_cache_bytes": ("gauge", "Bytes of cached fragments"),
+    "meownotes_fragment_cache_lookups_total": ("counter", "Lookups of cached fragments"),
+    "meownotes_fragment_cache_evictions_total": ("counter", "Fragments removed to make space")
+}
+# per-request totals written as a JSON line to this logger
+REQUEST_LOG = logging.getLogger("meownotes.metrics")
+
+METRICS_BP = Blueprint("metrics", __name__)
+
+class Metrics():
+    """
+    Histograms and counters by name and labels (a tuple of (label, value) pairs)
+    Example use:
+    metrics = Metrics()
+    metrics.observe("meownotes_query_seconds", (("query", "SELECT 1"),), 0.0002)
+    metrics.increase("meownotes_query_rows_total", (("query", "SELECT 1"),), 1)
+    metrics.render()
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # name -> labels -> [count of each bucket..., sum, count]
+        self.histograms = {}
+        # name -> labels -> value
+        self.counters = {}
+
+    def observe(self, name, labels, seconds):
+        """
+        Add a duration to a histogram
+        """
+        with self._lock:
+            series = self.histograms.setdefault(name, {}).get(labels)
+            if series is None:
+                series = [0] * (len(self.buckets) + 2)
+                self.histograms[name][labels] = series
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[position] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def increase(self, name, labels, amount=1):
+        """
+        Add to a counter
+        """
+        with self._lock:
+            values = self.counters.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + amount
+
+    def samples(self, gauges=None):
+        """
+        Returns name -> list of (sample name, labels, value) of all metrics
+        gauges (name -> labels -> value) are read at this time, e.g., the pool counters
+        """
+        samples = {}
+        with self._lock:
+            for name, series in self.histograms.items():
+                for labels, values in series.items():
+                    lines = samples.setdefault(name, [])
+                    for bound, count in zip(self.buckets, values):
+                        lines.append((name + "_bucket", labels + (("le", str(bound)),), count))
+                    lines.append((name + "_bucket", labels + (("le", "+Inf"),), values[-1]))
+                    lines.append((name + "_sum", labels, values[-2]))
+                    lines.append((name + "_count", labels, values[-1]))
+            for name, series in list(self.counters.items()) + list((gauges or {}).items()):
+                for labels, value in series.items():
+                    samples.setdefault(name, []).append((name, labels, value))
+        return samples
+
+    def render(self, gauges=None):
+        """
+        Returns all metrics in the Prometheus text format
+        """
+        samples = self.samples(gauges)
+        lines = []
+        for name, (metric_type, help_text) in METRIC_INFO.items():
+            if name not in samples:
+                continue
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for sample_name, labels, value in samples[name]:
+                lines.append("%s%s %s" % (sample_name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    """
+    Returns the labels as written in the Prometheus text format
+    Example use: format_labels((("method", "GET"), ("status", "200")))
+    Example output: '{method="GET",status="200"}'
+    """
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (label, str(value).replace("\\", "\\\\")
+                                          .replace('"', '\\"').replace("\n", "\\n"))
+                             for label, value in labels)
+
+############ Recording ############
+
+def get_metrics():
+    """
+    Returns the metrics of the app, None if they are disabled (nothing is recorded then)
+    """
+    config = current_app.config
+    if not (config["METRICS_ENABLED"] or config["METRICS_LOG_REQUESTS"]):
+        return None
+    return current_app.extensions["meownotes_metrics"]
+
+def add_to_request(key, seconds):
+    """
+    Add to the totals of the current request (if it is being measured)
+    """
+    totals = g.get("metrics_request")
+    if totals is not None:
+        totals[key] += seconds
+
+def record_query(metrics, query, seconds, rows=None):
+    """
+    Record the execution of a query (the query string is the label, values are placeholders)
+    """
+    labels = (("query", " ".join(query.split())),)
+    metrics.observe("meownotes_query_seconds", labels, seconds)
+    add_to_request("queries", 1)
+    add_to_request("query_seconds", seconds)
+    if rows is not None:
+        metrics.increase("meownotes_query_rows_total", labels, rows)
+        add_to_request("rows", rows)
+
+def record_acquire(metrics, seconds):
+    """
+    Record the time waited for a db connection
+    """
+    metrics.observe("meownotes_db_acquire_seconds", (), seconds)
+    add_to_request("acquire_seconds", seconds)
+
+def start_request():
+    """
+    Start measuring the current request
+    """
+    if get_metrics() is not None:
+        g.metrics_request = {"started": time.perf_counter(), "queries": 0, "query_seconds": 0.0,
+                             "rows": 0, "acquire_seconds": 0.0, "render_seconds": 0.0}
+
+def finish_request(response):
+    """
+    Record the duration of the current request and log its totals (if enabled)
+    """
+    totals = g.pop("metrics_request", None)
+    if totals is None:
+        return response
+    seconds = time.perf_counter() - totals["started"]
+    endpoint = request.endpoint or "none"
+    config = current_app.config
+    if config["METRICS_ENABLED"]:
+        current_app.extensions["meownotes_metrics"].observe(
+            "meownotes_request_seconds",
+            (("endpoint", endpoint), ("method", request.method),
+             ("status", str(response.status_code))), seconds)
+    if config["METRICS_LOG_REQUESTS"]:
+        REQUEST_LOG.info(json.dumps({
+            "ts": round(time.time(), 3), "method": request.method, "path": request.path,
+            "endpoint": endpoint, "status": response.status_code,
+            "duration_ms": round(seconds * 1000, 3), "queries": totals["queries"],
+            "query_ms": round(totals["query_seconds"] * 1000, 3), "rows": totals["rows"],
+            "acquire_ms": round(totals["acquire_seconds"] * 1000, 3),
+            "render_ms": round(totals["render_seconds"] * 1000, 3)
+        }))
+    return response
+
+def start_render(sender, template, context, **extra):
+    """
+    Start measuring the rendering of a template (before_render_template signal)
+    """
+    # pylint: disable=unused-argument
+    if get_metrics() is not None:
+        g.setdefault("metrics_renders", []).append((template.name, time.perf_counter()))
+
+def finish_render(sender, template, context, **extra):
+    """
+    Record the rendering of a template (template_rendered signal)
+    """
+    # pylint: disable=unused-argument
+    renders = g.get("metrics_renders")
+    if not renders:
+        return
+    name, started = renders.pop()
+    seconds = time.perf_counter() - started
+    metrics = current_app.extensions["meownotes_metrics"]
+    metrics.observe("meownotes_template_render_seconds", (("template", name),), seconds)
+    add_to_request("render_seconds", seconds)
+
+############ Serving ############
+
+def current_gauges():
+    """
+    Returns the counters of the connection pools, write queues, and fragment cache as metrics
+    """
+    gauges = {"meownotes_db_pool_connections": {}, "meownotes_db_pool_acquires_total": {}}
+    for stats in pool_stats():
+        database = ("database", stats["database"])
+        for state in ("opened", "idle"):
+            gauges["meownotes_db_pool_connections"][(database, ("state", state))] = stats[state]
+        for result in ("hits", "misses", "waits", "timeouts"):
+            gauges["meownotes_db_pool_acquires_total"][(database, ("result", result))] = \
+                stats[result]
+    gauges["meownotes_write_queue_writes_total"] = {}
+    gauges["meownotes_write_queue_batches_total"] = {}
+    for database, stats in write_queue_stats().items():
+        for result in ("writes", "failed"):
+            gauges["meownotes_write_queue_writes_total"][
+                (("database", database), ("result", result))] = stats[result]
+        gauges["meownotes_write_queue_batches_total"][(("database", database),)] = \
+            stats["batches"]
+    fragments = current_app.extensions["meownotes_fragments"].stats()
+    gauges["meownotes_fragment_cache_bytes"] = {(): fragments["bytes"]}
+    gauges["meownotes_fragment_cache_lookups_total"] = {
+        (("result", "hit"),): fragments["hits"], (("result", "miss"),): fragments["misses"]}
+    gauges["meownotes_fragment_cache_evictions_total"] = {(): fragments["evictions"]}
+    return gauges
+
+@METRICS_BP.route("/metrics")
+def metrics_text():
+    """
+    Metrics of this worker in the Prometheus text format
+    only served when METRICS_ENABLED is set in the config
+    """
+    if not current_app.config["METRICS_ENABLED"]:
+        abort(404)
+    return Response(current_app.extensions["meownotes_metrics"].render(current_gauges()),
+                    mimetype="text/plain; version=0.0.4")
+
+def init_app(app):
+    """
+    Create the metrics of the app and measure its requests and templates
+    """
+    app.extensions["meownotes_metrics"] = Metrics()
+    app.register_blueprint(METRICS_BP)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+    if not REQUEST_LOG.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        REQUEST_LOG.addHandler(handler)
+        REQUEST_LOG.setLevel(logging.INFO)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+MeowNotes schema migrations to upgrade an existing database in place
+the version of a database is stored in its PRAGMA user_version
+"""
+import os
+import sys
+import sqlite3
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from utils import to_timestamp
+
+############ Helpers ############
+
+def run_script(meownotes_db, script):
+    """
+    Execute each statement of an SQL script in the current transaction
+    (executescript would commit first)
+    """
+    statement = ""
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            meownotes_db.execute(statement)
+            statement = ""
+
+def run_script_file(meownotes_db, file_name):
+    """
+    Execute each statement of an SQL file from the app directory
+    """
+    with open(os.path.join(ROOT, file_name), encoding="utf8") as script_file:
+        run_script(meownotes_db, script_file.read())
+
+def backfill_created_ts(meownotes_db, batch_size=1000):
+    """
+    Fill created_ts from date_created for the notes that do not have it yet
+    returns the number of notes updated
+    """
+    updated = 0
+    last_id = -1
+    while True:
+        db_notes = meownotes_db.execute("SELECT id, date_created from notes "
+                                        "WHERE created_ts IS NULL AND id > ? ORDER BY id LIMIT ?",
+                                        (last_id, batch_size)).fetchall()
+        if not db_notes:
+            return updated
+        meownotes_db.executemany("UPDATE notes SET created_ts=? WHERE id=?",
+                                 [(to_timestamp(db_note[1]), db_note[0]) for db_note in db_notes])
+        updated += len(db_notes)
+        last_id = db_notes[-1][0]
+
+############ Migrations, applied in the order listed in MIGRATIONS ############
+
+def add_search_index(meownotes_db):
+    """
+    Full-text search index of the notes, kept in sync by triggers
+    """
+    run_script_file(meownotes_db, "meownotes-fts.sql")
+    meownotes_db.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+def add_user_note_indexes(meownotes_db):
+    """
+    Indexes for reading the notes of one user (by date or by id)
+    """
+    run_script(meownotes_db, """
+        CREATE INDEX IF NOT EXISTS "notes_uid_date_created" ON "notes" ("uid", "date_created");
+        CREATE INDEX IF NOT EXISTS "notes_uid_id" ON "notes" ("uid", "id");
+        ANALYZE;
+    """)
+
+def add_created_ts(meownotes_db):
+    """
+    Creation time of the notes as epoch seconds, sortable and shown without parsing dates
+    the notes of one user are read in this order, so it replaces the date_created index
+    the table is rebuilt to place the column before the content, ADD COLUMN would put it
+    after the content and reading it would then read the (long) content from disk too
+    """
+    run_script(meownotes_db, """
+        CREATE TABLE "notes_rebuilt" (
+         "id" INTEGER UNIQUE,
+         "uid" INTEGER NOT NULL,
+         "date_created" TEXT NOT NULL,
+         "created_ts" INTEGER,
+         "title" TEXT NOT NULL,
+         "tags" TEXT,
+         "content" BLOB NOT NULL,
+         PRIMARY KEY("id")
+        );
+        INSERT INTO "notes_rebuilt" ("id", "uid", "date_created", "title", "tags", "content")
+        SELECT "id", "uid", "date_created", "title", "tags", "content" from "notes";
+        DROP VIEW IF EXISTS "notes_fts_source";
+        DROP TABLE "notes";
+        ALTER TABLE "notes_rebuilt" RENAME TO "notes";
+        CREATE INDEX IF NOT EXISTS "notes_uid_id" ON "notes" ("uid", "id");
+        CREATE INDEX IF NOT EXISTS "notes_uid_created_ts" ON "notes" ("uid", "created_ts");
+    """)
+    # the triggers (and source) of the search index were dropped with the old table
+    # (the ids are kept, so the index itself is still valid)
+    run_script_file(meownotes_db, "meownotes-fts.sql")
+    backfill_created_ts(meownotes_db)
+    meownotes_db.execute("ANALYZE")
+
+def scope_search_index_by_user(meownotes_db):
+    """
+    Recreate the search index with the owner of each note as a searchable column
+    so that a search matches only the notes of one user instead of all notes
+    """
+    run_script(meownotes_db, """
+        DROP TRIGGER IF EXISTS "notes_fts_insert";
+        DROP TRIGGER IF EXISTS "notes_fts_delete";
+        DROP TRIGGER IF EXISTS "notes_fts_update";
+        DROP TABLE IF EXISTS "notes_fts";
+        DROP VIEW IF EXISTS "notes_fts_source";
+    """)
+    add_search_index(meownotes_db)
+
+def add_note_version(meownotes_db):
+    """
+    Version of each note, increased by a trigger on every change of the note
+    (used as the ETag of the note in the API)
+    the index replaces the (uid, id) one and also holds the version,
+    so the version of a note is read from the index without reading its content
+    """
+    run_script(meownotes_db, """
+        ALTER TABLE "notes" ADD COLUMN "version" INTEGER NOT NULL DEFAULT 1;
+        DROP INDEX IF EXISTS "notes_uid_id";
+        CREATE INDEX IF NOT EXISTS "notes_uid_id_version" ON "notes" ("uid", "id", "version");
+        CREATE TRIGGER IF NOT EXISTS "notes_version_update"
+        AFTER UPDATE OF "uid", "title", "tags", "content" ON "notes" BEGIN
+          UPDATE "notes" SET "version" = OLD."version" + 1 WHERE "id" = NEW."id";
+        END;
+    """)
+
+def add_user_data_version(meownotes_db):
+    """
+    Version of the notes of each user, increased by triggers on every change of a note
+    (key of the cached pages of the user, see cache.py)
+    """
+    run_script(meownotes_db, """
+        CREATE TABLE IF NOT EXISTS "user_data_versions" (
+         "uid" INTEGER NOT NULL,
+         "version" INTEGER NOT NULL,
+         PRIMARY KEY("uid")
+        );
+        CREATE TRIGGER IF NOT EXISTS "notes_data_version_insert" AFTER INSERT ON "notes" BEGIN
+          INSERT INTO "user_data_versions" ("uid", "version") VALUES (NEW."uid", 1)
+          ON CONFLICT ("uid") DO UPDATE SET "version" = "version" + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS "notes_data_version_update"
+        AFTER UPDATE OF "uid", "title", "tags", "content" ON "notes" BEGIN
+          INSERT INTO "user_data_versions" ("uid", "version") VALUES (OLD."uid", 1)
+          ON CONFLICT ("uid") DO UPDATE SET "version" = "version" + 1;
+          INSERT INTO "user_data_versions" ("uid", "version") VALUES (NEW."uid", 1)
+          ON CONFLICT ("uid") DO UPDATE SET "version" = "version" + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS "notes_data_version_delete" AFTER DELETE ON "notes" BEGIN
+          INSERT INTO "user_data_versions" ("uid", "version") VALUES (OLD."uid", 1)
+          ON CONFLICT ("uid") DO UPDATE SET "version" = "version" + 1;
+        END;
+    """)
+
+# the tags of a note row (e.g., NEW in a trigger) as a JSON array, to be split with json_each
+# the tags are comma-separated, json_quote escapes them and no escape contains a comma
+NOTE_TAGS_JSON = """'[' || replace(json_quote(%s."tags"), ',', '","') || ']'"""
+# a tag of the array as stored in note_tags: trimmed and lowercase (empty tags are left out)
+NOTE_TAG = """lower(trim("value", ' ' || char(9, 10, 13)))"""
+
+def add_note_tags(meownotes_db):
+    """
+    Tags of the notes, one row per user, tag, and note (the primary key is the index),
+    kept in sync with notes.tags by triggers and filled from the existing notes
+    """
+    tags = {"new": NOTE_TAGS_JSON % "NEW", "old": NOTE_TAGS_JSON % "OLD", "tag": NOTE_TAG}
+    run_script(meownotes_db, """
+        CREATE TABLE IF NOT EXISTS "note_tags" (
+         "uid" INTEGER NOT NULL,
+         "tag" TEXT NOT NULL,
+         "note_id" INTEGER NOT NULL,
+         PRIMARY KEY("uid", "tag", "note_id")
+        ) WITHOUT ROWID;
+        CREATE TRIGGER IF NOT EXISTS "note_tags_insert" AFTER INSERT ON "notes" BEGIN
+          INSERT OR IGNORE INTO "note_tags" ("uid", "tag", "note_id")
+          SELECT NEW."uid", %(tag)s, NEW."id" FROM json_each(%(new)s) WHERE %(tag)s != '';
+        END;
+        CREATE TRIGGER IF NOT EXISTS "note_tags_update" AFTER UPDATE OF "uid", "tags" ON "notes"
+        BEGIN
+          DELETE FROM "note_tags" WHERE "uid" = OLD."uid" AND "note_id" = OLD."id"
+          AND "tag" IN (SELECT %(tag)s FROM json_each(%(old)s));
+          INSERT OR IGNORE INTO "note_tags" ("uid", "tag", "note_id")
+          SELECT NEW."uid", %(tag)s, NEW."id" FROM json_each(%(new)s) WHERE %(tag)s != '';
+        END;
+        CREATE TRIGGER IF NOT EXISTS "note_tags_delete" AFTER DELETE ON "notes" BEGIN
+          DELETE FROM "note_tags" WHERE "uid" = OLD."uid" AND "note_id" = OLD."id"
+          AND "tag" IN (SELECT %(tag)s FROM json_each(%(old)s));
+        END;
+    """ % tags)
+    meownotes_db.execute("""
+        INSERT OR IGNORE INTO "note_tags" ("uid", "tag", "note_id")
+        SELECT "notes"."uid", %s, "notes"."id" FROM "notes", json_each(%s) WHERE %s != ''
+    """ % (NOTE_TAG, NOTE_TAGS_JSON % '"notes"', NOTE_TAG))
+    meownotes_db.execute("ANALYZE")
+
+def index_note_content(meownotes_db):
+    """
+    (Re)create the view and triggers of the search index to read the text of the notes
+    through note_content() (see notecodec.py) instead of the stored content
+    """
+    run_script(meownotes_db, """
+        DROP TRIGGER IF EXISTS "notes_fts_insert";
+        DROP TRIGGER IF EXISTS "notes_fts_delete";
+        DROP TRIGGER IF EXISTS "notes_fts_update";
+        DROP VIEW IF EXISTS "notes_fts_source";
+        CREATE VIEW "notes_fts_source" AS
+         SELECT "id", 'u' || "uid" AS "owner", "title", "tags",
+         note_content("content", "codec") AS "content" FROM "notes";
+        CREATE TRIGGER "notes_fts_insert" AFTER INSERT ON "notes" BEGIN
+         INSERT INTO "notes_fts" ("rowid", "owner", "title", "tags", "content")
+         VALUES (new."id", 'u' || new."uid", new."title", new."tags",
+         note_content(new."content", new."codec"));
+        END;
+        CREATE TRIGGER "notes_fts_delete" AFTER DELETE ON "notes" BEGIN
+         INSERT INTO "notes_fts" ("notes_fts", "rowid", "owner", "title", "tags", "content")
+         VALUES ('delete', old."id", 'u' || old."uid", old."title", old."tags",
+         note_content(old."content", old."codec"));
+        END;
+        CREATE TRIGGER "notes_fts_update"
+        AFTER UPDATE OF "uid", "title", "tags", "content", "codec" ON "notes" BEGIN
+         INSERT INTO "notes_fts" ("notes_fts", "rowid", "owner", "title", "tags", "content")
+         VALUES ('delete', old."id", 'u' || old."uid", old."title", old."tags",
+         note_content(old."content", old."codec"));
+         INSERT INTO "notes_fts" ("rowid", "owner", "title", "tags", "content")
+         VALUES (new."id", 'u' || new."uid", new."title", new."tags",
+         note_content(new."content", new."codec"));
+        END;
+    """)
+
+def add_note_codec(meownotes_db):
+    """
+    Codec of the content of each note (see notecodec.py), long notes are compressed
+    the search index then reads the text through note_content() (the indexed text of the
+    existing notes, all plain, stays the same so the index is not rebuilt)
+    the column comes after the content, it is only read together with the content
+    """
+    meownotes_db.execute('ALTER TABLE "notes" ADD COLUMN "codec" INTEGER NOT NULL DEFAULT 0')
+    index_note_content(meownotes_db)
+
+def add_user_shards(meownotes_db):
+    """
+    Shard of each user, the db file with the notes of the user (see shards.py)
+    only used in the directory db, with SHARD_COUNT set
+    """
+    meownotes_db.execute("""
+        CREATE TABLE IF NOT EXISTS "user_shards" (
+         "uid" INTEGER NOT NULL,
+         "shard" INTEGER NOT NULL,
+         PRIMARY KEY("uid")
+        )
+    """)
+
+# never reorder or remove entries, only append new migrations
+# the version of a migration is its position in the list (starting at 1)
+MIGRATIONS = [
+    add_search_index,
+    add_user_note_indexes,
+    add_created_ts,
+    scope_search_index_by_user,
+    add_note_version,
+    add_user_data_version,
+    add_note_tags,
+    add_note_codec,
+    add_user_shards
+]
+
+############ Runner ############
+
+def get_version(meownotes_db):
+    """
+    Returns the schema version of the database
+    """
+    return meownotes_db.execute("PRAGMA user_version").fetchone()[0]
+
+def rebuild_search_index(meownotes_db):
+    """
+    Create the search index (and the triggers keeping it in sync) if missing,
+    as of the version of the database, then rebuild it from the notes
+    """
+    if get_version(meownotes_db) >= MIGRATIONS.index(add_note_codec) + 1:
+        index_note_content(meownotes_db)
+    add_search_index(meownotes_db)
+
+def run_in_transaction(meownotes_db, work):
+    """
+    Run work(meownotes_db) in one transaction, rolled back if it fails
+    """
+    if meownotes_db.in_transaction:
+        meownotes_db.commit()
+    try:
+        meownotes_db.execute("BEGIN IMMEDIATE")
+        work(meownotes_db)
+        meownotes_db.commit()
+    except sqlite3.Error:
+        meownotes_db.rollback()
+        raise
+
+def migrate(meownotes_db, target=None):
+    """
+    Apply all migrations newer than the version of the database (up to target)
+    each migration runs in its own transaction together with the version update
+    returns the list of (version, name) applied
+    """
+    if target is None:
+        target = len(MIGRATIONS)
+    applied = []
+    current = get_version(meownotes_db)
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current or version > target:
+            continue
+        if meownotes_db.in_transaction:
+            meownotes_db.commit()
+        try:
+            # take the write lock first, another worker may be migrating the same db
+            meownotes_db.execute("BEGIN IMMEDIATE")
+            if get_version(meownotes_db) >= version:
+                meownotes_db.rollback()
+                continue
+            migration(meownotes_db)
+            meownotes_db.execute("PRAGMA user_version = %d" % version)
+            meownotes_db.commit()
+        except sqlite3.Error:
+            meownotes_db.rollback()
+            raise
+        applied.append((version, migration.__name__))
+    return applied
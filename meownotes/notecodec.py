@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+MeowNotes compression of the content of long notes
+the codec of each note is stored next to its content (notes.codec), so compressed and
+plain notes live side by side and notes are only compressed when they are written
+"""
+import os
+import sys
+import zlib
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from migrations import run_in_transaction
+
+# codecs of notes.content: text as written, or the zlib compressed UTF-8 text (a BLOB)
+CODEC_PLAIN = 0
+CODEC_ZLIB = 1
+
+def compress_content(content, min_bytes, level=6):
+    """
+    Returns the value to store for the content of a note and its codec
+    the content is compressed if it has at least min_bytes (UTF-8) and gets smaller,
+    min_bytes = 0 stores every note as it is
+    Example use: compress_content("meow " * 1000, 1024)
+    Example output: (b"x\\x9c...", 1)
+    """
+    if not min_bytes:
+        return content, CODEC_PLAIN
+    encoded = content.encode("utf8")
+    if len(encoded) < min_bytes:
+        return content, CODEC_PLAIN
+    compressed = zlib.compress(encoded, level)
+    if len(compressed) >= len(encoded):
+        return content, CODEC_PLAIN
+    return compressed, CODEC_ZLIB
+
+def decompress_content(value, codec):
+    """
+    Returns the text of the content of a note as stored with the given codec
+    Example use: decompress_content(b"x\\x9c...", 1)
+    Example output: "meow meow ..."
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(value).decode("utf8")
+    return value
+
+def stored_size(value):
+    """
+    Returns the bytes a stored content takes up (text as UTF-8)
+    """
+    if isinstance(value, str):
+        return len(value.encode("utf8"))
+    return len(value)
+
+def register_functions(connection):
+    """
+    Make note_content(content, codec) available to the SQL of a connection
+    it is used by the search index (triggers, see add_note_codec) and the previews,
+    so every connection writing notes needs it
+    """
+    connection.create_function("note_content", 2, decompress_content, deterministic=True)
+
+GET_NOTE_CONTENTS = "SELECT id, content, codec from notes WHERE id > ? ORDER BY id LIMIT ?"
+SET_NOTE_CONTENT = "UPDATE notes SET content=?, codec=? WHERE id=?"
+
+def recompress_notes(meownotes_db, store, batch_size=500):
+    """
+    Store the content of all notes again as store(text) returns it (value, codec),
+    e.g., after the compression settings were changed
+    batch_size notes are read and updated at a time, each batch in one transaction
+    returns the number of notes stored again and the bytes of their content before and after
+    """
+    changed, before, after = 0, 0, 0
+    last_id = -1
+    while True:
+        db_notes = meownotes_db.execute(GET_NOTE_CONTENTS, (last_id, batch_size)).fetchall()
+        if not db_notes:
+            return changed, before, after
+        updates = []
+        for note_id, value, codec in db_notes:
+            new_value, new_codec = store(decompress_content(value, codec))
+            if new_codec != codec or new_value != value:
+                updates.append((new_value, new_codec, note_id))
+                before += stored_size(value)
+                after += stored_size(new_value)
+        if updates:
+            run_in_transaction(meownotes_db, lambda db, rows=updates:
+                               db.executemany(SET_NOTE_CONTENT, rows))
+            changed += len(updates)
+        last_id = db_notes[-1][0]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+MeowNotes password hashing in a pool of processes of each worker
+hashing is slow on purpose and holds the GIL, done in a request thread it would
+stall the other requests of the worker for as long as it takes
+"""
+import concurrent.futures
+import os
+import threading
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+class HashingBusy(Exception):
+    """
+    Raised when too many passwords are being hashed already (or it took too long)
+    """
+
+############ Run in the processes of the pool ############
+
+def hash_password(password, method):
+    """
+    Returns the hash of a password, method sets the algorithm and its work factor
+    Example use: hash_password("love", "scrypt:32768:8:1")
+    Example output: "scrypt:32768:8:1$<salt>$<hash>"
+    """
+    return generate_password_hash(password, method=method)
+
+def needs_rehash(password_hash, method):
+    """
+    Returns True if a stored hash was made with another method or work factor
+    Example use: needs_rehash("pbkdf2:sha256:1000$<salt>$<hash>", "scrypt:32768:8:1")
+    Example output: True
+    """
+    return password_hash.split("$", 1)[0] != method
+
+def verify_password(password_hash, password, method):
+    """
+    Checks a password against its stored hash
+    returns whether it is right and, if the hash is outdated (see needs_rehash),
+    a new hash of the password made with method (else None)
+    """
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if needs_rehash(password_hash, method):
+        return True, hash_password(password, method)
+    return True, None
+
+############ Pool of each worker process ############
+
+class HashPool():
+    """
+    Runs the hashing in up to workers processes, at most max_pending hashes at a time
+    (running or queued), more are refused with HashingBusy
+    Example use:
+    hashes = HashPool(2)
+    hashes.run(hash_password, ("love", "scrypt:32768:8:1"), max_pending=16, timeout=10)
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        # pending: hashes running or queued, done: hashes finished (or failed),
+        # refused: hashes not started because max_pending were pending
+        self.counters = {"pending": 0, "done": 0, "refused": 0}
+
+    def executor(self):
+        """
+        Returns the process pool, started on first use (and again in a forked worker process)
+        """
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def run(self, function, args, max_pending, timeout):
+        """
+        Returns function(*args) computed in a process of the pool
+        raises HashingBusy if max_pending hashes are pending already or it takes over timeout
+        (a hash that timed out stays pending until its process is done with it)
+        """
+        with self._lock:
+            if self.counters["pending"] >= max_pending:
+                self.counters["refused"] += 1
+                raise HashingBusy("%d passwords are being hashed already" % max_pending)
+            self.counters["pending"] += 1
+        try:
+            future = self.executor().submit(function, *args)
+        except RuntimeError:
+            # e.g., a process of the pool died (BrokenProcessPool)
+            self._done(None)
+            with self._lock:
+                self._executor = None
+            raise
+        future.add_done_callback(self._done)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError as expt:
+            raise HashingBusy("hashing took over %s seconds" % timeout) from expt
+
+    def _done(self, future):
+        # pylint: disable=unused-argument
+        with self._lock:
+            self.counters["pending"] -= 1
+            self.counters["done"] += 1
+
+    def close(self):
+        """
+        Stop the processes of the pool
+        """
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+
+def run_hashing(function, *args):
+    """
+    Returns function(*args) computed by the hash pool of the app (see HashPool.run)
+    with PASSWORD_HASH_WORKERS = 0 there is no pool and it is computed in the request thread
+    """
+    hashes = current_app.extensions["meownotes_passwords"]
+    if hashes is None:
+        return function(*args)
+    return hashes.run(function, args, current_app.config["PASSWORD_HASH_MAX_PENDING"],
+                      current_app.config["PASSWORD_HASH_TIMEOUT"])
+
+def new_password_hash(password):
+    """
+    Returns the hash of a new password made with PASSWORD_HASH_METHOD
+    """
+    return run_hashing(hash_password, password, current_app.config["PASSWORD_HASH_METHOD"])
+
+def check_password(password_hash, password):
+    """
+    Checks a password against its stored hash (see verify_password)
+    returns whether it is right and the new hash to store if the method was changed
+    """
+    return run_hashing(verify_password, password_hash, password,
+                       current_app.config["PASSWORD_HASH_METHOD"])
+
+def init_app(app):
+    """
+    Create the hash pool of the app (its processes are started on first use)
+    """
+    workers = app.config["PASSWORD_HASH_WORKERS"]
+    app.extensions["meownotes_passwords"] = HashPool(workers) if workers else None
@@ -5,16 +5,21 @@ Main Blueprint for the MeowNotes Flask app
 import random
 import os
 import sys
-from flask import request, redirect, render_template, session, Response, g, Blueprint, flash
-from werkzeug.security import check_password_hash, generate_password_hash
+from flask import request, redirect, render_template, session, Response, g, Blueprint, flash, \
+    current_app, abort, jsonify, stream_with_context
 ROOT = os.path.dirname(os.path.realpath(__file__))
 # add the project directory to the sys.path
 if ROOT not in sys.path:
     sys.path = [ROOT] + sys.path
 from dbquery import get_user_by_name, get_id_by_user, parse_user, create_user, \
-    get_note_by_id, get_notes_by_user, get_search_notes, process_note_results, \
-    update_note, delete_note_by_id, create_note
-from utils import create_welcome_message, reformat_for_export
+    get_note_by_id, get_notes_page, process_note_results, \
+    process_note_summaries, update_note, delete_note_by_id, create_note, check_session_user, \
+    iter_notes_by_user, import_notes, set_user_password, get_tag_counts, get_notes_by_tag
+from utils import create_welcome_message, reformat_for_export, stream_export_zip, \
+    read_import_notes
+from dbpool import pool_stats
+from cache import cached_fragment, cached_search
+from passwords import new_password_hash, check_password, HashingBusy
 
 MEOW_BP = Blueprint("pawprint", __name__)
 
@@ -62,27 +67,44 @@ def login():
             return render_template("landing.html", msg=msg)
         # check the db for existing users with the input username
         db_res = get_user_by_name(input_username)
-        # if the user already exists, if the password is right then user logs in
-        if len(db_res) == 1:
-            db_user = parse_user(db_res[0])
-            # if the password is right then user logs in
-            if check_password_hash(db_user["password"], input_password):
-                # store the current user for the session
-                session["username"] = input_username.lower()
-                # clear any notifications if there were any
-                session.pop("_flashes", None)
-                return redirect("/dashboard")
-            # if the password is wrong, prompt to try again
-            else:
-                msg = "To make a new account, please enter a different username."
-                flash("wrong password", "error")
-                return render_template("landing.html", msg=msg)
-        else:
-            # create the new user
-            create_user(input_username, generate_password_hash(input_password))
-            # store the new user for the session
+        try:
+            return login_user(db_res, input_username, input_password)
+        except HashingBusy:
+            # the passwords are hashed by a bounded pool, see passwords.py
+            msg = "Too many cats are logging in right now, please try again in a moment."
+            return render_template("landing.html", msg=msg), 503, {"Retry-After": "1"}
+
+def login_user(db_res, input_username, input_password):
+    """
+    Logs in the user found (db_res) if the password is right or signs up a new one
+    """
+    # if the user already exists, if the password is right then user logs in
+    if len(db_res) == 1:
+        db_user = parse_user(db_res[0])
+        password_ok, new_hash = check_password(db_user["password"], input_password)
+        # if the password is right then user logs in
+        if password_ok:
+            # the hash was made with another method/work factor than configured
+            if new_hash is not None:
+                set_user_password(db_user["uid"], new_hash)
+            # store the current user for the session
             session["username"] = input_username.lower()
+            session["uid"] = db_user["uid"]
+            # clear any notifications if there were any
+            session.pop("_flashes", None)
             return redirect("/dashboard")
+        # if the password is wrong, prompt to try again
+        else:
+            msg = "To make a new account, please enter a different username."
+            flash("wrong password", "error")
+            return render_template("landing.html", msg=msg)
+    else:
+        # create the new user
+        create_user(input_username, new_password_hash(input_password))
+        # store the new user for the session
+        session["username"] = input_username.lower()
+        session["uid"] = get_id_by_user(session["username"])
+        return redirect("/dashboard")
 
 @MEOW_BP.route("/dashboard")
 def dashboard():
@@ -92,14 +114,31 @@ def dashboard():
     if g.uid:
         session_user = g.username
         uid = g.uid
-        # get the notes associated with the user
-        db_user_results = get_notes_by_user(uid)
-        note_data = process_note_results(db_user_results)
-        # create the welcome message
+        after = request.args.get("after")
+        before = request.args.get("before")
+        # the notes are only read and rendered again if they changed since the last time
+        notes_html = cached_fragment(uid, ("dashboard", after, before,
+                                           current_app.config["DASHBOARD_PAGE_SIZE"],
+                                           current_app.config["NOTE_PREVIEW_LENGTH"]),
+                                     lambda: render_dashboard_notes(uid, after, before))
+        # create the welcome message (not cached, it changes every time)
         msg = create_welcome_message(session_user)
-        return render_template("dashboard.html", msg=msg, menu_item="logout", data=note_data)
+        return render_template("dashboard.html", msg=msg, menu_item="logout",
+                               notes_html=notes_html)
     return redirect("/")
 
+def render_dashboard_notes(uid, after, before):
+    """
+    Renders the requested page of the notes of the user with the links to the other pages
+    """
+    # get the requested page of the notes associated with the user (already sorted)
+    page_size = current_app.config["DASHBOARD_PAGE_SIZE"]
+    db_user_results, next_page, previous_page = get_notes_page(
+        uid, after, page_size, current_app.config["NOTE_PREVIEW_LENGTH"], before=before)
+    note_data = process_note_summaries(db_user_results)
+    return render_template("dashboard-notes.html", data=note_data, next_page=next_page,
+                           previous_page=previous_page)
+
 @MEOW_BP.route("/logout")
 def logout():
     """
@@ -123,17 +162,28 @@ def view():
             session["last_note_id"] = request.args.get("id")
         # if the request didn't include a note id, check the last one
         requested_note_id = session.get("last_note_id")
-        # retrieve note from the database
-        db_note_results = get_note_by_id(uid, requested_note_id)
-        note_data = process_note_results(db_note_results)
-        # if the list is empty, redirect!
-        if not note_data:
+        # the note is only read and rendered again if a note of the user changed since
+        note_html = cached_fragment(uid, ("view", requested_note_id),
+                                    lambda: render_view_note(uid, requested_note_id))
+        # if there is no such note, redirect!
+        if note_html is None:
             # add warning in the menu bar
             flash("note not found", "error")
             return redirect("/dashboard")
-        return render_template("view.html", menu_item="logout", data=note_data[0])
+        return render_template("view.html", menu_item="logout", note_html=note_html)
     return redirect("/")
 
+def render_view_note(uid, note_id):
+    """
+    Renders the note for the single note view (None if there is no such note)
+    """
+    # retrieve note from the database
+    db_note_results = get_note_by_id(uid, note_id)
+    note_data = process_note_results(db_note_results)
+    if not note_data:
+        return None
+    return render_template("view-note.html", data=note_data[0])
+
 @MEOW_BP.route("/download")
 def download():
     """
@@ -153,6 +203,48 @@ def download():
                                  "attachment;filename=" + file_name})
     return redirect("/")
 
+@MEOW_BP.route("/export")
+def export():
+    """
+    Download all notes of the user as a ZIP of plain text files
+    (and as notes.jsonl with ?jsonl=1), sent while the notes are read
+    """
+    if g.uid:
+        uid = g.uid
+        chunk_size = current_app.config["EXPORT_CHUNK_SIZE"]
+        jsonl_notes = None
+        if request.args.get("jsonl"):
+            # read the notes a second time for the JSONL file, after the text files
+            jsonl_notes = iter_notes_by_user(uid, chunk_size)
+        archive = stream_export_zip(iter_notes_by_user(uid, chunk_size), jsonl_notes)
+        file_name = "meownotes_" + g.username + ".zip"
+        # keep the request (and its db connection) until the last note is sent
+        return Response(stream_with_context(archive),
+                        mimetype="application/zip",
+                        headers={"Content-Disposition":
+                                 "attachment;filename=" + file_name})
+    return redirect("/")
+
+@MEOW_BP.route("/import", methods=("GET", "POST"))
+def import_file():
+    """
+    Import the notes of an uploaded file (JSONL or a ZIP from /export)
+    then redirects to the dashboard
+    """
+    if request.method == "POST" and g.uid:
+        uploaded_file = request.files.get("import_file")
+        if not uploaded_file:
+            flash("no file to import", "error")
+            return redirect("/dashboard")
+        imported, errors = import_notes(g.uid, read_import_notes(uploaded_file.stream),
+                                        current_app.config["IMPORT_BATCH_SIZE"])
+        if errors:
+            flash("%d notes imported, %d skipped (first: %s: %s)" %
+                  (imported, len(errors), errors[0][0], errors[0][1]), "error")
+        else:
+            flash("%d notes imported" % imported, "info")
+    return redirect("/dashboard")
+
 @MEOW_BP.route("/update", methods=("GET", "POST"))
 def update():
     """
@@ -221,8 +313,9 @@ def search():
             # store the current search term
             session["search"] = input_term.lower()
             # retrieve notes from the database that match the search term
-            db_search_results = get_search_notes(uid, input_term)
-            note_data = process_note_results(db_search_results)
+            db_search_results = cached_search(uid, input_term, None,
+                                              current_app.config["NOTE_PREVIEW_LENGTH"])
+            note_data = process_note_summaries(db_search_results)
             num_results = len(note_data)
             # default filters
             def_filters = ["title", "tags", "content"]
@@ -256,9 +349,10 @@ def filter_search():
             if session.get("search") is not None:
                 last_search = session.get("search")
                 input_fields = request.form.getlist("fields")
-                # retrieve notes from the database that match the search term
-                db_search_results = get_search_notes(uid, last_search, input_fields)
-                note_data = process_note_results(db_search_results)
+                # filter the cached result of the search (searched again if notes changed)
+                db_search_results = cached_search(uid, last_search, input_fields,
+                                                  current_app.config["NOTE_PREVIEW_LENGTH"])
+                note_data = process_note_summaries(db_search_results)
                 num_results = len(note_data)
                 # show the checked fields
                 return render_template("search.html",
@@ -273,6 +367,27 @@ def filter_search():
             return redirect("/search")
     return redirect("/")
 
+@MEOW_BP.route("/tags")
+def tags():
+    """
+    Tags of the user with the number of notes of each (available only if logged in)
+    """
+    if g.uid:
+        return render_template("tags.html", menu_item="logout", tags=get_tag_counts(g.uid))
+    return redirect("/")
+
+@MEOW_BP.route("/tags/<tag>")
+def tag_notes(tag):
+    """
+    Notes of the user with the given tag (available only if logged in)
+    """
+    if g.uid:
+        db_notes = get_notes_by_tag(g.uid, tag, current_app.config["NOTE_PREVIEW_LENGTH"])
+        note_data = process_note_summaries(db_notes)
+        return render_template("tags.html", menu_item="logout", tag=tag, data=note_data,
+                               num=len(note_data))
+    return redirect("/")
+
 @MEOW_BP.route("/clear")
 def clear_messages():
     """
@@ -282,6 +397,16 @@ def clear_messages():
     session.pop("_flashes", None)
     return redirect(request.referrer)
 
+@MEOW_BP.route("/dbstats")
+def db_stats():
+    """
+    Counters of the db connection pools of this worker (hits, misses, waits, timeouts)
+    only served when DB_STATS_ENABLED is set in the config
+    """
+    if not current_app.config["DB_STATS_ENABLED"]:
+        abort(404)
+    return jsonify(pool_stats())
+
 @MEOW_BP.before_app_request
 def check_user_logged_in():
     """
@@ -290,6 +415,15 @@ def check_user_logged_in():
     """
     if session.get("username") is not None:
         g.username = session.get("username")
-        g.uid = get_id_by_user(session.get("username"))
+        # the uid is stored in the (signed) session at login so no db lookup is needed,
+        # sessions started before that get it looked up once
+        if session.get("uid") is None:
+            db_res = get_user_by_name(g.username)
+            session["uid"] = parse_user(db_res[0])["uid"] if db_res else None
+        g.uid = session.get("uid")
+        # the user may have been deleted since the login, then the session is ended
+        if g.uid is None or not check_session_user(g.uid, g.username):
+            session.clear()
+            g.uid = None
     else:
         g.uid = None
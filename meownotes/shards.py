@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+MeowNotes per-user shards of the notes (optional, SHARD_COUNT)
+the notes of each user are kept in one of several db files, so that the writes of users
+in different shards do not wait for each other's lock; the db configured in DATABASE
+is the directory: it has the users and the shard of each user (user_shards)
+"""
+import collections
+import os
+import sys
+import threading
+import time
+import click
+from flask import current_app, g
+from flask.cli import with_appcontext
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from dbpool import get_pool
+from metrics import get_metrics, record_acquire
+from migrations import migrate, run_in_transaction
+
+GET_USER_SHARD = "SELECT shard from user_shards WHERE uid=?"
+# a user gets a shard when first needed (new users) or when the db is split (flask shard-db)
+ASSIGN_USER_SHARD = "INSERT OR IGNORE INTO user_shards (uid, shard) VALUES (?, ?)"
+ASSIGN_ALL_USER_SHARDS = "INSERT OR IGNORE INTO user_shards (uid, shard) " \
+                         "SELECT uid, uid % ? from users"
+# the notes of the users of a shard, from the directory attached as "source"
+# users with notes in the shard already (a data version) were copied before
+COPY_SHARD_NOTES = """
+    INSERT INTO notes (id, uid, date_created, created_ts, title, tags, content, version, codec)
+    SELECT id, uid, date_created, created_ts, title, tags, content, version, codec
+    from source.notes WHERE uid IN (SELECT uid from source.user_shards WHERE shard=?)
+    AND uid NOT IN (SELECT uid from user_data_versions)
+"""
+
+# (directory db, uid) -> shard of recent users (a user stays in its shard), most recent last
+USER_SHARDS = collections.OrderedDict()
+USER_SHARDS_LOCK = threading.Lock()
+
+def shard_database(config, shard):
+    """
+    Returns the db file of a shard
+    Example use: shard_database(app.config, 2)
+    Example output: ".../meownotes-shard-2.db"
+    """
+    return config["SHARD_DATABASE"] % shard
+
+def all_databases(config):
+    """
+    Returns the db files of the app: the directory (DATABASE) first, then the shards
+    """
+    return [config["DATABASE"]] + [shard_database(config, shard)
+                                   for shard in range(config["SHARD_COUNT"])]
+
+def get_connection(database):
+    """
+    Get a connection to a db file from the pool of this worker
+    the connection is kept for the rest of the app context (one per db file)
+    """
+    connections = g.setdefault("db_connections", {})
+    if database not in connections:
+        pool = get_pool(current_app.config, database)
+        metrics = get_metrics()
+        if metrics is None:
+            connections[database] = (pool, pool.acquire())
+        else:
+            started = time.perf_counter()
+            connections[database] = (pool, pool.acquire())
+            record_acquire(metrics, time.perf_counter() - started)
+    return connections[database][1]
+
+def release_connections():
+    """
+    Give the connections of the app context back to their pools
+    """
+    for pool, connection in g.pop("db_connections", {}).values():
+        pool.release(connection)
+
+def get_user_shard(uid):
+    """
+    Returns the shard of a user, remembered by this worker
+    a user without one (e.g., a new user) is assigned uid % SHARD_COUNT in the directory
+    """
+    config = current_app.config
+    key = (config["DATABASE"], int(uid))
+    with USER_SHARDS_LOCK:
+        shard = USER_SHARDS.get(key)
+        if shard is not None:
+            USER_SHARDS.move_to_end(key)
+            return shard
+    directory = get_connection(config["DATABASE"])
+    db_res = directory.execute(GET_USER_SHARD, (key[1],)).fetchone()
+    if db_res is None:
+        directory.execute(ASSIGN_USER_SHARD, (key[1], key[1] % config["SHARD_COUNT"]))
+        directory.commit()
+        db_res = directory.execute(GET_USER_SHARD, (key[1],)).fetchone()
+    with USER_SHARDS_LOCK:
+        USER_SHARDS[key] = db_res[0]
+        while len(USER_SHARDS) > config["SHARD_USER_CACHE_SIZE"]:
+            USER_SHARDS.popitem(last=False)
+    return db_res[0]
+
+def get_database(uid=None):
+    """
+    Returns the db file with the notes of the given user
+    the directory (DATABASE) if there are no shards or no user is given
+    """
+    config = current_app.config
+    if uid is None or not config["SHARD_COUNT"]:
+        return config["DATABASE"]
+    return shard_database(config, get_user_shard(uid))
+
+def prepare_database(meownotes_db):
+    """
+    Create the tables in an empty db file (e.g., a new shard) or apply the missing migrations
+    returns the list of (version, name) migrations applied
+    """
+    db_notes_table = meownotes_db.execute("SELECT name from sqlite_master "
+                                          "WHERE type='table' AND name='notes'").fetchone()
+    if db_notes_table is None:
+        with current_app.open_resource("meownotes-schema.sql") as schema_file:
+            meownotes_db.executescript(schema_file.read().decode("utf8"))
+        meownotes_db.execute("PRAGMA user_version = 0")
+    return migrate(meownotes_db)
+
+def copy_shard_notes(shard_db, directory, shard):
+    """
+    Copy the notes of the users of a shard from the directory db file into the shard
+    (ids and versions are kept), returns the number of notes copied
+    """
+    copied = []
+    shard_db.execute("ATTACH DATABASE ? AS source", (directory,))
+    try:
+        run_in_transaction(shard_db, lambda db: copied.append(
+            db.execute(COPY_SHARD_NOTES, (shard,)).rowcount))
+    finally:
+        shard_db.execute("DETACH DATABASE source")
+    return copied[0]
+
+# split the notes of an existing db into shards using the command line
+# flask shard-db --shards 4
+@click.command("shard-db")
+@click.option("--shards", default=None, type=int,
+              help="Number of shards (default SHARD_COUNT).")
+@with_appcontext
+def shard_db_command(shards):
+    """
+    Assign every user of the db a shard and copy the notes of the users into their shards
+    """
+    config = current_app.config
+    shards = shards or config["SHARD_COUNT"]
+    if not shards:
+        raise click.ClickException("give the number of shards (--shards or SHARD_COUNT)")
+    directory = get_connection(config["DATABASE"])
+    prepare_database(directory)
+    run_in_transaction(directory, lambda db: db.execute(ASSIGN_ALL_USER_SHARDS, (shards,)))
+    users = dict(directory.execute("SELECT shard, count(*) from user_shards GROUP BY shard"))
+    for shard in range(shards):
+        database = shard_database(config, shard)
+        shard_db = get_connection(database)
+        prepare_database(shard_db)
+        copied = copy_shard_notes(shard_db, config["DATABASE"], shard)
+        click.echo(">>> INFO: Shard %d (%s): %d users, copied %d notes." %
+                   (shard, database, users.get(shard, 0), copied))
+    click.echo(">>> INFO: Set SHARD_COUNT = %d to use the shards, the notes in %s are "
+               "not read then." % (shards, config["DATABASE"]))
+
+def init_app(app):
+    """
+    Make the shard-db cmd available for the app
+    """
+    app.cli.add_command(shard_db_command)
@@ -1,4 +1,160 @@
 // initialize tooltips
 $(document).ready(function(){
     $('[data-toggle="tooltip"]').tooltip(); 
-});
\ No newline at end of file
+});
+
+// suggest titles and tags of the notes while typing in the search box
+$(document).ready(function(){
+    var search = document.getElementById("search");
+    if (!search || !window.fetch) {
+        return;
+    }
+    var suggestions = document.getElementById("search-suggestions");
+    search.addEventListener("input", function(){
+        var typed = search.value;
+        if (!typed.trim()) {
+            return;
+        }
+        fetch(search.dataset.suggestUrl + "?q=" + encodeURIComponent(typed), {credentials: "same-origin"})
+            .then(function(response){
+                return response.ok ? response.json() : {suggestions: []};
+            })
+            .then(function(data){
+                // answers to earlier keystrokes are ignored
+                if (typed !== search.value) {
+                    return;
+                }
+                suggestions.innerHTML = "";
+                data.suggestions.forEach(function(term){
+                    var option = document.createElement("option");
+                    option.value = term;
+                    suggestions.appendChild(option);
+                });
+            });
+    });
+});
+
+// save a note while it is edited, sending only the part of the content that changed
+$(document).ready(function(){
+    var form = document.getElementById("edit-form");
+    if (!form || !window.fetch) {
+        return;
+    }
+    var status = document.getElementById("autosave-status");
+    var version = parseInt(form.dataset.version, 10);
+    // what the db has, read from the API on the first edit
+    // (the textarea changes the line endings, so its first value is not the stored content)
+    var saved = null;
+    var loading = null;
+    var timer = null;
+    var busy = false;
+    var stopped = false;
+    var changedAny = false;
+
+    // the one change turning before into after: the text between their common start and end
+    function textChange(before, after) {
+        var start = 0;
+        while (start < before.length && start < after.length && before[start] === after[start]) {
+            start++;
+        }
+        var end = 0;
+        while (end < before.length - start && end < after.length - start &&
+               before[before.length - 1 - end] === after[after.length - 1 - end]) {
+            end++;
+        }
+        return {start: start, end: before.length - end, text: after.slice(start, after.length - end)};
+    }
+
+    function stop(message) {
+        stopped = true;
+        status.textContent = message;
+    }
+
+    function load() {
+        return fetch(form.dataset.noteUrl, {credentials: "same-origin"})
+            .then(function(response){
+                return response.ok ? response.json() : null;
+            })
+            .then(function(note){
+                if (!note || note.version !== version) {
+                    stop("changed elsewhere, reload to edit");
+                    return;
+                }
+                saved = {title: form.elements.title.value, tags: form.elements.tags.value,
+                         content: note.content};
+            });
+    }
+
+    function save() {
+        timer = null;
+        if (busy || stopped) {
+            return;
+        }
+        var current = {title: form.elements.title.value, tags: form.elements.tags.value,
+                       content: form.elements.content.value};
+        var patch = {version: version, changes: []};
+        if (current.content !== saved.content) {
+            patch.changes.push(textChange(saved.content, current.content));
+        }
+        if (current.title !== saved.title && current.title) {
+            patch.title = current.title;
+        }
+        if (current.tags !== saved.tags) {
+            patch.tags = current.tags;
+        }
+        if (!patch.changes.length && patch.title === undefined && patch.tags === undefined) {
+            return;
+        }
+        busy = true;
+        status.textContent = "saving...";
+        fetch(form.dataset.noteUrl, {method: "PATCH", credentials: "same-origin",
+                                     headers: {"Content-Type": "application/json"},
+                                     body: JSON.stringify(patch)})
+            .then(function(response){
+                return response.json().then(function(data){
+                    busy = false;
+                    if (response.status === 409) {
+                        stop("changed elsewhere, reload to edit");
+                    } else if (!response.ok) {
+                        stop("not saved: " + data.error);
+                    } else {
+                        version = data.version;
+                        saved = current;
+                        changedAny = changedAny || data.saved;
+                        status.textContent = "saved";
+                        // typed while saving
+                        schedule();
+                    }
+                });
+            })
+            .catch(function(){
+                busy = false;
+                status.textContent = "offline, not saved yet";
+            });
+    }
+
+    function schedule() {
+        if (stopped) {
+            return;
+        }
+        if (timer !== null) {
+            clearTimeout(timer);
+        }
+        timer = setTimeout(function(){
+            if (saved === null) {
+                loading = loading || load();
+                loading.then(save);
+            } else {
+                save();
+            }
+        }, 1000);
+    }
+
+    form.addEventListener("input", schedule);
+    // show the saved note once the editor is closed
+    $("#edit").on("hidden.bs.modal", function(){
+        if (changedAny) {
+            window.location.reload();
+        }
+    });
+});
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+MeowNotes suggestions for the search box: the titles, words of the titles, and tags
+of the notes of a user that start with what was typed so far
+each user has a sorted index in memory, built from the db when first needed,
+updated with the changes of notes made by this worker and rebuilt after other changes
+"""
+import bisect
+import collections
+import os
+import sys
+import threading
+from flask import current_app
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from dbquery import execute_select, get_data_version, NOTE_CHANGE_LISTENERS
+
+# the columns of the notes the suggestions are made of
+# (title and tags come before the content, so the content is not read)
+GET_SUGGEST_NOTES = "SELECT id, title, tags from notes WHERE uid=?"
+# how much a change of one note increases the data version of its user
+# (see the triggers of add_user_data_version, an update counts for the old and the new owner)
+VERSION_STEPS = {"insert": 1, "update": 2, "delete": 1}
+# rough bytes of memory used by each term and each note of an index
+TERM_BYTES = 120
+NOTE_BYTES = 200
+
+def note_terms(title, tags):
+    """
+    Returns the (lowercase) terms a note can be suggested by
+    Example use: note_terms("Cat food", "shop, Home")
+    Example output: {"cat food", "cat", "food", "shop", "home"}
+    """
+    title = " ".join(title.lower().split())
+    terms = set(title.split())
+    if title:
+        terms.add(title)
+    terms.update(tag.strip().lower() for tag in (tags or "").split(","))
+    terms.discard("")
+    return terms
+
+class SuggestIndex():
+    """
+    The terms of the notes of one user as a sorted list, searched by prefix with bisect
+    version is the data version of the user the index is up to date with
+    Example use:
+    index = SuggestIndex(3)
+    index.add_note(1, "Cat food", "shop")
+    index.suggest("ca", 10)
+    """
+    def __init__(self, version):
+        self.version = version
+        self.terms = []
+        # term -> number of notes with it, note id -> its terms
+        self.counts = {}
+        self.notes = {}
+        self.size = 0
+
+    def add_note(self, note_id, title, tags):
+        """
+        Add (or replace) the terms of a note
+        """
+        self.remove_note(note_id)
+        terms = note_terms(title, tags)
+        self.notes[note_id] = terms
+        for term in terms:
+            self.counts[term] = self.counts.get(term, 0) + 1
+            if self.counts[term] == 1:
+                bisect.insort(self.terms, term)
+                self.size += TERM_BYTES + len(term)
+        self.size += NOTE_BYTES
+
+    def load(self, db_notes):
+        """
+        Add the terms of many (id, title, tags) notes to an empty index
+        (the terms are sorted once instead of inserted one at a time)
+        """
+        for note_id, title, tags in db_notes:
+            terms = note_terms(title, tags)
+            self.notes[note_id] = terms
+            for term in terms:
+                self.counts[term] = self.counts.get(term, 0) + 1
+        self.terms = sorted(self.counts)
+        self.size = len(self.notes) * NOTE_BYTES + \
+            sum(TERM_BYTES + len(term) for term in self.terms)
+
+    def remove_note(self, note_id):
+        """
+        Remove the terms of a note (if it was added)
+        """
+        terms = self.notes.pop(note_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            self.counts[term] -= 1
+            if self.counts[term] == 0:
+                del self.counts[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+                self.size -= TERM_BYTES + len(term)
+        self.size -= NOTE_BYTES
+
+    def suggest(self, prefix, limit):
+        """
+        Returns up to limit terms starting with prefix (lowercase), in alphabetical order
+        """
+        start = bisect.bisect_left(self.terms, prefix)
+        found = self.terms[start:start + limit]
+        return [term for term in found if term.startswith(prefix)]
+
+class SuggestCache():
+    """
+    The indexes of the most recent users up to max_bytes in total (least recently used out)
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # uid -> index, least recently used first
+        self._indexes = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"bytes": 0, "builds": 0, "updates": 0, "evictions": 0}
+
+    def suggest(self, uid, prefix, limit, version):
+        """
+        Returns the suggestions from the index of the user
+        None if the index is not cached or not at the given version (it has to be built)
+        """
+        with self._lock:
+            index = self._indexes.get(uid)
+            if index is None or index.version != version:
+                return None
+            self._indexes.move_to_end(uid)
+            return index.suggest(prefix, limit)
+
+    def put(self, uid, index):
+        """
+        Cache the (new) index of a user
+        """
+        with self._lock:
+            old = self._indexes.pop(uid, None)
+            if old is not None:
+                self.counters["bytes"] -= old.size
+            self._indexes[uid] = index
+            self.counters["bytes"] += index.size
+            self.counters["builds"] += 1
+            self._evict()
+
+    def update(self, uid, change, version, step):
+        """
+        Apply change(index) to the index of the user (if cached), now at the given version
+        if the version did not increase by exactly step, other changes were made
+        (e.g., by another worker) and the index is dropped to be built again
+        """
+        with self._lock:
+            index = self._indexes.get(uid)
+            if index is None:
+                return
+            self.counters["bytes"] -= index.size
+            if version != index.version + step:
+                del self._indexes[uid]
+                return
+            change(index)
+            index.version = version
+            self.counters["bytes"] += index.size
+            self.counters["updates"] += 1
+            self._evict()
+
+    def drop(self, uid):
+        """
+        Forget the index of a user (it is built again when needed)
+        """
+        with self._lock:
+            index = self._indexes.pop(uid, None)
+            if index is not None:
+                self.counters["bytes"] -= index.size
+
+    def clear(self):
+        """
+        Forget all indexes (the counters are kept)
+        """
+        with self._lock:
+            self._indexes.clear()
+            self.counters["bytes"] = 0
+
+    def stats(self):
+        """
+        Returns the cache counters as a dict
+        """
+        with self._lock:
+            stats = {"users": len(self._indexes), "max_bytes": self.max_bytes}
+            stats.update(self.counters)
+        return stats
+
+    def _evict(self):
+        # the most recent index is kept even if it is over max_bytes on its own
+        while self.counters["bytes"] > self.max_bytes and len(self._indexes) > 1:
+            self.counters["bytes"] -= self._indexes.popitem(last=False)[1].size
+            self.counters["evictions"] += 1
+
+def get_suggest_cache():
+    """
+    Returns the suggestion indexes of the app (of this worker process)
+    """
+    return current_app.extensions["meownotes_suggest"]
+
+def build_index(uid, version):
+    """
+    Returns a new index of the notes of the user
+    """
+    index = SuggestIndex(version)
+    index.load(execute_select(GET_SUGGEST_NOTES, (uid,), uid))
+    return index
+
+def get_suggestions(uid, prefix, limit=10):
+    """
+    Returns up to limit terms of the notes of the user starting with prefix (any case)
+    Example use: get_suggestions(1, "ca")
+    Example output: ["cat", "cat food"]
+    """
+    prefix = " ".join(prefix.lower().split())
+    if not prefix:
+        return []
+    suggest_cache = get_suggest_cache()
+    # the version changes with every change of a note, also those made by other workers
+    version = get_data_version(uid)
+    suggestions = suggest_cache.suggest(uid, prefix, limit, version)
+    if suggestions is None:
+        index = build_index(uid, version)
+        suggest_cache.put(uid, index)
+        suggestions = index.suggest(prefix, limit)
+    return suggestions
+
+def note_changed(uid, change, note_id=None, note=None):
+    """
+    Update the index of the user with a change of a note made by this worker
+    (see dbquery.notify_note_change)
+    """
+    suggest_cache = get_suggest_cache()
+    # the id of a note from a form is a string, the index has the ids from the db
+    note_id = int(note_id) if note_id is not None else None
+    if change not in VERSION_STEPS:
+        suggest_cache.drop(uid)
+    elif change == "delete":
+        suggest_cache.update(uid, lambda index: index.remove_note(note_id),
+                             get_data_version(uid), VERSION_STEPS[change])
+    else:
+        suggest_cache.update(uid, lambda index: index.add_note(note_id, note["title"],
+                                                               note["tags"]),
+                             get_data_version(uid), VERSION_STEPS[change])
+
+def init_app(app):
+    """
+    Create the suggestion indexes of the app and follow the changes of notes
+    """
+    app.extensions["meownotes_suggest"] = SuggestCache(app.config["SUGGEST_CACHE_BYTES"])
+    if note_changed not in NOTE_CHANGE_LISTENERS:
+        NOTE_CHANGE_LISTENERS.append(note_changed)
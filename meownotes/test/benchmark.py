@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+MeowNotes benchmark: seeds a db with a deterministic dataset, then times the dbquery
+functions and every route of the pawprint blueprint (in process, Flask test client)
+reports p50/p95/p99 and ops/sec and writes them as JSON to compare later runs against
+Example use:
+python meownotes/test/benchmark.py --users 1000 --min-notes 1 --max-notes 10000 \
+    --output bench_results.json --compare bench_baseline.json
+"""
+import argparse
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from __init__ import create_app
+from dbquery import init_db, get_db, prepare_query, get_search_notes, get_note_by_id, \
+    process_note_results, add_note
+from dbpool import close_pools
+
+# words the titles, tags, and contents of the seeded notes are made of
+WORDS = ("cat kitten paw whisker purr meow milk fish mouse nap sun window box yarn "
+         "claw tail fur treat bowl sofa garden bird lunch dinner vet brush toy "
+         "uni lecture exam project notes idea plan list shop recipe travel book "
+         "film music code python flask sqlite query index cache server deploy").split()
+TAGS = WORDS[:12] + ["uni", "se", "todo", "home", "work", "ideas", "recipes", "travel"]
+BENCH_PASSWORD = "bench"
+
+############ Dataset ############
+
+def note_rows(rand, uid, count, start_ts):
+    """
+    Yields the rows of count notes of a user with realistic lengths:
+    short titles, up to 4 tags, contents mostly short with a long tail (log-normal)
+    """
+    for _ in range(count):
+        created = start_ts + rand.randint(0, 3 * 365 * 24 * 3600)
+        title = " ".join(rand.choice(WORDS) for _ in range(rand.randint(1, 8)))
+        tags = ",".join(rand.sample(TAGS, rand.randint(0, 4)))
+        words = min(int(rand.lognormvariate(4.0, 1.0)) + 1, 5000)
+        content = " ".join(rand.choice(WORDS) for _ in range(words))
+        date_created = datetime.datetime.fromtimestamp(created).isoformat()
+        yield uid, date_created, created, title.capitalize(), tags, content
+
+def seed_db(meownotes_db, args):
+    """
+    Fill the db with args.users users and args.min_notes to args.max_notes notes each
+    returns the uid of the user with the most notes (used for the route timings)
+    """
+    rand = random.Random(args.seed)
+    # hashing a password takes long on purpose, all seeded users share one
+    password = generate_password_hash(BENCH_PASSWORD, current_app.config["PASSWORD_HASH_METHOD"])
+    meownotes_db.executemany("INSERT INTO users (uid, username, password) VALUES (?, ?, ?)",
+                             [(uid, "user%05d" % uid, password)
+                              for uid in range(1, args.users + 1)])
+    start_ts = int(datetime.datetime(2017, 1, 1).timestamp())
+    counts = {}
+    for uid in range(1, args.users + 1):
+        counts[uid] = rand.randint(args.min_notes, args.max_notes)
+        meownotes_db.executemany("INSERT INTO notes (uid, date_created, created_ts, title, "
+                                 "tags, content) VALUES (?, ?, ?, ?, ?, ?)",
+                                 note_rows(rand, uid, counts[uid], start_ts))
+        meownotes_db.commit()
+    meownotes_db.execute("ANALYZE")
+    meownotes_db.commit()
+    return max(counts, key=counts.get)
+
+############ Timing ############
+
+def percentile(samples, percent):
+    """
+    Returns the nearest-rank percentile of sorted samples
+    """
+    return samples[max(0, math.ceil(percent / 100 * len(samples)) - 1)]
+
+def time_calls(name, call, iterations, results, after=None):
+    """
+    Time iterations calls of call(i) and add the summary to results (in ms)
+    after(i) is called after each call, without being timed
+    """
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        call(i)
+        samples.append(time.perf_counter() - start)
+        if after is not None:
+            after(i)
+    samples.sort()
+    results[name] = {
+        "iterations": iterations,
+        "p50_ms": round(percentile(samples, 50) * 1000, 4),
+        "p95_ms": round(percentile(samples, 95) * 1000, 4),
+        "p99_ms": round(percentile(samples, 99) * 1000, 4),
+        "ops_per_sec": round(iterations / sum(samples), 1)
+    }
+    print("%-32s p50 %9.3f ms  p95 %9.3f ms  p99 %9.3f ms  %10.1f ops/sec" % (
+        name, results[name]["p50_ms"], results[name]["p95_ms"], results[name]["p99_ms"],
+        results[name]["ops_per_sec"]))
+
+def bench_functions(app, uid, args, results):
+    """
+    Time the dbquery functions
+    """
+    with app.app_context():
+        note_ids = [row["id"] for row in get_db().execute(
+            "SELECT id from notes WHERE uid=? ORDER BY id", (uid,)).fetchall()]
+        items = [{"val": uid, "cols": ["uid"], "type": "exact", "condition": True},
+                 {"val": "cat", "cols": ["title", "tags"], "type": "contains",
+                  "condition": True}]
+        time_calls("prepare_query", lambda i: prepare_query("GET_CONDITIONAL", "notes", items),
+                   args.iterations * 10, results)
+        time_calls("get_search_notes", lambda i: get_search_notes(uid, WORDS[i % len(WORDS)]),
+                   args.iterations, results)
+        time_calls("get_search_notes (title)",
+                   lambda i: get_search_notes(uid, WORDS[i % len(WORDS)], ["title"]),
+                   args.iterations, results)
+        db_notes = [get_note_by_id(uid, note_id)[0] for note_id in note_ids[:100]]
+        time_calls("process_note_results", lambda i: process_note_results(db_notes),
+                   args.iterations, results)
+
+# requests timed for the routes of the pawprint blueprint (endpoint -> method, url, form)
+# {id} is replaced by a note of the user, {cursor} by the cursor of the second dashboard page
+ROUTES = {
+    "pawprint.landing": [("GET", "/", None)],
+    "pawprint.cat": [("GET", "/cat", None)],
+    "pawprint.dashboard": [("GET", "/dashboard", None), ("GET", "/dashboard?after={cursor}", None)],
+    "pawprint.view": [("GET", "/view?id={id}", None)],
+    "pawprint.download": [("GET", "/download?id={id}", None)],
+    "pawprint.export": [("GET", "/export", None)],
+    "pawprint.import_file": [("POST", "/import", "import")],
+    "pawprint.update": [("POST", "/update", "update")],
+    "pawprint.create": [("GET", "/create", None), ("POST", "/create", "create")],
+    "pawprint.delete": [("POST", "/delete", "delete")],
+    "pawprint.search": [("GET", "/search", None), ("POST", "/search", "search")],
+    "pawprint.filter_search": [("POST", "/filter", "filter")],
+    "pawprint.tags": [("GET", "/tags", None)],
+    "pawprint.tag_notes": [("GET", "/tags/cat", None)],
+    "pawprint.clear_messages": [("GET", "/clear", None)],
+    "pawprint.db_stats": [("GET", "/dbstats", None)],
+    "pawprint.login": [("POST", "/login", "login")],
+    "pawprint.logout": [("GET", "/logout", None)]
+}
+
+def route_form(kind, i, context):
+    """
+    Returns the form sent to a route for the i-th request
+    context has the uid and a note_id of the timed user and the delete_ids of notes to delete
+    """
+    word = WORDS[i % len(WORDS)]
+    forms = {
+        "update": lambda: {"note_id": context["note_id"], "title": "Updated " + word,
+                           "tags": "bench", "content": "Updated content " * 20},
+        "create": lambda: {"title": "Bench " + word, "tags": "bench",
+                           "content": "Benchmark content " * 20},
+        "delete": lambda: {"note_id": context["delete_ids"][i]},
+        "search": lambda: {"search": word},
+        "filter": lambda: {"fields": ["title", "tags"]},
+        "login": lambda: {"username": "user%05d" % context["uid"], "password": BENCH_PASSWORD},
+        "import": lambda: {"import_file": (io.BytesIO(
+            b'{"title": "Imported", "tags": ["bench"], "content": "Imported note"}\n' * 10),
+                                           "notes.jsonl")}
+    }
+    return forms[kind]()
+
+def bench_routes(app, uid, args, results):
+    """
+    Time each route of the pawprint blueprint through the test client (logged in as uid)
+    """
+    client = app.test_client()
+    login = {"username": "user%05d" % uid, "password": BENCH_PASSWORD}
+    client.post("/login", data=login)
+    with app.app_context():
+        note_id = get_db().execute("SELECT id from notes WHERE uid=? ORDER BY id LIMIT 1",
+                                   (uid,)).fetchone()["id"]
+        context = {"uid": uid, "note_id": note_id,
+                   "delete_ids": [add_note(uid, "Delete me", "bench", "To be deleted")
+                                  for _ in range(args.iterations)]}
+    cursor = client.get("/dashboard").data.split(b"after=")[-1].split(b'"')[0].decode()
+    endpoints = sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                       if rule.endpoint.startswith("pawprint."))
+    for endpoint in endpoints:
+        if endpoint not in ROUTES:
+            print("%-32s (no request defined, skipped)" % endpoint)
+            continue
+        for method, url, form in ROUTES[endpoint]:
+            url = url.format(id=note_id, cursor=cursor)
+            iterations = args.iterations
+            if form == "login":
+                # each login checks the (slow on purpose) password hash
+                iterations = max(1, iterations // 10)
+            def request_route(i, method=method, url=url, form=form):
+                data = route_form(form, i, context) if form else None
+                client.open(url, method=method, data=data, headers={"Referer": "/dashboard"})
+            def login_again(_):
+                client.post("/login", data=login)
+            # e.g., "GET /view?id" (the values are left out of the name)
+            name = "%s %s" % (method, url.split("=")[0])
+            time_calls(name, request_route, iterations, results,
+                       login_again if url == "/logout" else None)
+
+############ Baseline ############
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change of p50/p95 against a baseline
+    returns the names of the results slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms"):
+            before = baseline[name][key]
+            change = (result[key] - before) / before if before else 0.0
+            changes.append("%s %+6.1f%%" % (key[:3], change * 100))
+            if change > tolerance and name not in regressions:
+                regressions.append(name)
+        print("%-32s %s%s" % (name, "  ".join(changes),
+                              "  REGRESSION" if name in regressions else ""))
+    return regressions
+
+def parse_args(argv=None):
+    """
+    Command line options of the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--min-notes", type=int, default=1)
+    parser.add_argument("--max-notes", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=2019)
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="timed calls per function and route")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="write the results (as a new baseline) to this JSON file")
+    parser.add_argument("--compare", default=None,
+                        help="JSON file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown (fraction) of p50/p95 reported as a regression")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    Seed, time, and report; exits with 1 if there are regressions against --compare
+    """
+    args = parse_args(argv)
+    app = create_app()
+    db_fd, app.config["DATABASE"] = tempfile.mkstemp(suffix=".db")
+    app.config["DB_STATS_ENABLED"] = True
+    try:
+        with app.app_context():
+            init_db()
+            started = time.perf_counter()
+            uid = seed_db(get_db(), args)
+            notes = get_db().execute("SELECT count(*) from notes").fetchone()[0]
+        print(">>> INFO: seeded %d users and %d notes in %.1f s (timed user: %d)" % (
+            args.users, notes, time.perf_counter() - started, uid))
+        results = {}
+        bench_functions(app, uid, args, results)
+        bench_routes(app, uid, args, results)
+    finally:
+        close_pools()
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(app.config["DATABASE"] + suffix):
+                os.unlink(app.config["DATABASE"] + suffix)
+    report = {
+        "meta": {"users": args.users, "min_notes": args.min_notes, "max_notes": args.max_notes,
+                 "seed": args.seed, "notes": notes, "iterations": args.iterations,
+                 "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                 "date": datetime.datetime.now().isoformat(timespec="seconds")},
+        "results": results
+    }
+    with open(args.output, "w", encoding="utf8") as output_file:
+        json.dump(report, output_file, indent=1, sort_keys=True)
+    print(">>> INFO: results written to %s" % args.output)
+    if args.compare:
+        with open(args.compare, encoding="utf8") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["meta"]["notes"] != notes:
+            print(">>> WARNING: the baseline was run on a different dataset")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(">>> WARNING: %d regressions: %s" % (len(regressions), ", ".join(regressions)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
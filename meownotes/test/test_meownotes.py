@@ -1,14 +1,32 @@
 #!/usr/bin/env python3
+import gzip
+import io
+import json
 import os
+import re
 import sys
+import sqlite3
 import tempfile
+import threading
+import zipfile
 import pytest
+from werkzeug.security import generate_password_hash
 ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 # add the project directory to the sys.path
 if ROOT not in sys.path:
     sys.path = [ROOT] + sys.path
 from __init__ import create_app
-from dbquery import init_db
+from dbquery import init_db, get_db, prepare_query, get_search_notes, parse_note, \
+    prepare_summary_query, prepare_search_match, SEARCH_NOTES, delete_user_by_id, create_user, \
+    import_notes, GET_NOTE_VERSION, add_note, get_id_by_user, get_tag_counts
+from config import Config, load_deployment_config
+from utils import to_timestamp, read_import_notes
+from migrations import MIGRATIONS
+from dbpool import ConnectionPool, close_pools
+from assets import build_assets
+from cache import FragmentCache
+from suggest import SuggestCache, SuggestIndex
+from writequeue import get_write_queue, close_write_queues
 
 meownotes = create_app()
 
@@ -31,6 +49,12 @@ def client():
     with meownotes.app_context():
         init_db()
     yield client
+    # the cached pages are of this test db
+    meownotes.extensions["meownotes_fragments"].clear()
+    meownotes.extensions["meownotes_suggest"].clear()
+    meownotes.extensions["meownotes_searches"].clear()
+    close_write_queues()
+    close_pools()
     os.close(db_fd)
     os.unlink(meownotes.config["DATABASE"])
 
@@ -59,6 +83,12 @@ def search(client, search_term):
         search=search_term
     ), follow_redirects=True)
 
+def filter_search(client, fields):
+    """Filter the last search"""
+    return client.post("/filter", data=dict(
+        fields=fields
+    ), follow_redirects=True)
+
 def dashboard(client):
     """Go to the dashboard"""
     return client.get("/dashboard", follow_redirects=True)
@@ -107,6 +137,93 @@ def test_login_logout(client):
     # landing page should be shown when the user is NOT logged in
     assert b"create a user or login with an existing one" in result.data
 
+def test_login_stores_uid(client):
+    """
+    The uid should be kept in the session so it is not looked up on every request
+    """
+    login(client, "bublik", TEST_PASSWORD)
+    logout(client)
+    login(client, TEST_USER, TEST_PASSWORD)
+    with client.session_transaction() as user_session:
+        assert user_session["uid"] == 2
+    logout(client)
+    login(client, "bublik", TEST_PASSWORD)
+    with client.session_transaction() as user_session:
+        assert user_session["uid"] == 1
+        # sessions without the uid (from before it was stored) still work
+        del user_session["uid"]
+    result = dashboard(client)
+    assert b"dashboard" in result.data
+    with client.session_transaction() as user_session:
+        assert user_session["uid"] == 1
+
+def test_deleted_user_logged_out(client):
+    """
+    The session of a deleted user should end, even if its uid is given to a new user
+    """
+    result = login(client, TEST_USER, TEST_PASSWORD)
+    assert b"dashboard" in result.data
+    with meownotes.app_context():
+        delete_user_by_id(1)
+        # the next new user gets the uid of the deleted one
+        create_user("bublik", TEST_PASSWORD)
+    result = dashboard(client)
+    assert b"create a user or login with an existing one" in result.data
+    with client.session_transaction() as user_session:
+        assert "uid" not in user_session
+
+def test_shared_session_key(client, monkeypatch, tmp_path):
+    """
+    Workers loading the session key from the environment should accept each other's sessions
+    and production should refuse to start without a key
+    """
+    key_file = tmp_path / "secret_key"
+    key_file.write_text("a key shared by the workers\n")
+    monkeypatch.setenv("MEOWNOTES_SECRET_KEY_FILE", str(key_file))
+    monkeypatch.setenv("MEOWNOTES_DATABASE", meownotes.config["DATABASE"])
+    workers = [create_app(), create_app()]
+    assert workers[0].config["SECRET_KEY"] == "a key shared by the workers"
+    assert workers[1].config["DATABASE"] == meownotes.config["DATABASE"]
+    first, second = workers[0].test_client(), workers[1].test_client()
+    login(first, TEST_USER, TEST_PASSWORD)
+    second.set_cookie("MeowNotes", first.get_cookie("MeowNotes").value)
+    assert b"dashboard" in dashboard(second).data
+    # a random key per process only works with a single worker
+    with pytest.raises(RuntimeError):
+        load_deployment_config({"SECRET_KEY": Config.SECRET_KEY}, {"MEOWNOTES_ENV": "production"})
+    config = {"SECRET_KEY": Config.SECRET_KEY}
+    load_deployment_config(config, {"MEOWNOTES_ENV": "production", "MEOWNOTES_SECRET_KEY": "k"})
+    assert config["SECRET_KEY"] == "k"
+
+def test_password_rehash(client):
+    """
+    A password hashed with another method should be hashed again with the configured one
+    at the next login of its user
+    """
+    with meownotes.app_context():
+        create_user("bublik", generate_password_hash(TEST_PASSWORD, "pbkdf2:sha256:1000"))
+    result = login(client, "bublik", "wrong")
+    assert b"wrong password" in result.data
+    result = login(client, "bublik", TEST_PASSWORD)
+    assert b"dashboard" in result.data
+    with meownotes.app_context():
+        password_hash = get_db().execute("SELECT password from users WHERE username='bublik'")\
+            .fetchone()["password"]
+    assert password_hash.startswith(meownotes.config["PASSWORD_HASH_METHOD"] + "$")
+    logout(client)
+    assert b"dashboard" in login(client, "bublik", TEST_PASSWORD).data
+
+def test_login_hashing_busy(client, monkeypatch):
+    """
+    Logins should be answered with 503 when too many passwords are being hashed
+    """
+    monkeypatch.setitem(meownotes.config, "PASSWORD_HASH_MAX_PENDING", 0)
+    result = login(client, TEST_USER, TEST_PASSWORD)
+    assert result.status_code == 503
+    assert result.headers["Retry-After"] == "1"
+    monkeypatch.setitem(meownotes.config, "PASSWORD_HASH_MAX_PENDING", 16)
+    assert b"dashboard" in login(client, TEST_USER, TEST_PASSWORD).data
+
 def test_login_wrong_password(client):
     """
     Check that login fails when a wrong password is given
@@ -136,6 +253,88 @@ def test_dashboard(client):
     # dashboard page should be shown
     assert b"dashboard" in result.data
 
+def test_dashboard_pages(client, monkeypatch):
+    """
+    Dashboard should show the notes a page at a time, oldest first
+    with links to the next and previous pages
+    """
+    monkeypatch.setitem(meownotes.config, "DASHBOARD_PAGE_SIZE", 2)
+    login(client, TEST_USER, TEST_PASSWORD)
+    for number in range(1, 4):
+        create_note(client, "Paged note %d" % number, "test", "Contents")
+    result = dashboard(client)
+    assert b"Paged note 1" in result.data and b"Paged note 2" in result.data
+    assert b"Paged note 3" not in result.data
+    assert b"dashboard?after=" in result.data and b"dashboard?before=" not in result.data
+    next_page = re.search(rb'href="(/dashboard\?after=[^"]+)"', result.data).group(1)
+    result = client.get(next_page.decode().replace("&amp;", "&"), follow_redirects=True)
+    assert b"Paged note 3" in result.data
+    assert b"Paged note 1" not in result.data
+    assert b"dashboard?after=" not in result.data
+    previous_page = re.search(rb'href="(/dashboard\?before=[^"]+)"', result.data).group(1)
+    result = client.get(previous_page.decode().replace("&amp;", "&"), follow_redirects=True)
+    assert b"Paged note 1" in result.data and b"Paged note 2" in result.data
+    assert b"Paged note 3" not in result.data
+    assert b"dashboard?before=" not in result.data and b"dashboard?after=" in result.data
+
+def test_fragment_cache(client):
+    """
+    The notes of the dashboard and the view of a note should be rendered once
+    until a note of the user changes
+    """
+    fragments = meownotes.extensions["meownotes_fragments"]
+    login(client, TEST_USER, TEST_PASSWORD)
+    # creating the note redirects to the dashboard, which renders the notes again
+    create_note(client, "Cached note", "cat", "Cached content")
+    before = fragments.stats()
+    first = dashboard(client)
+    second = dashboard(client)
+    assert b"Cached note" in second.data
+    view_note(client, "1")
+    result = view_note(client, "1")
+    assert b"Cached content" in result.data
+    stats = fragments.stats()
+    assert (stats["misses"] - before["misses"], stats["hits"] - before["hits"]) == (1, 3)
+    # the welcome message is not part of the cached notes
+    assert first.data.count(b"Kroshka") == second.data.count(b"Kroshka") == 1
+    update_note(client, "1", "Changed note", "cat", "Changed content")
+    assert b"Changed content" in view_note(client, "1").data
+    assert b"Changed note" in dashboard(client).data
+    delete_note(client, "1")
+    assert b"Changed note" not in dashboard(client).data
+    assert b"note not found" in view_note(client, "1").data
+
+def test_fragment_cache_budget():
+    """
+    The least recently used fragments should be removed to stay within the byte budget
+    """
+    fragments = FragmentCache(10)
+    fragments.put("a", "aaaa")
+    fragments.put("b", "bbbb")
+    assert fragments.get("a") == "aaaa"
+    fragments.put("c", "cccc")
+    assert fragments.get("b") is None and fragments.get("a") == "aaaa"
+    fragments.put("too big", "x" * 11)
+    assert fragments.get("too big") is None
+    stats = fragments.stats()
+    assert (stats["bytes"], stats["evictions"], stats["fragments"]) == (8, 1, 2)
+
+def test_note_previews(client, monkeypatch):
+    """
+    Lists of notes only show the start of the content when a preview length is configured
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Note 1", "test", "The original note contents")
+    result = dashboard(client)
+    assert b"The origin" not in result.data
+    monkeypatch.setitem(meownotes.config, "NOTE_PREVIEW_LENGTH", 10)
+    result = dashboard(client)
+    assert b"The origin" in result.data
+    assert b"The original note contents" not in result.data
+    result = search(client, "original")
+    assert b"The origin" in result.data
+    assert b"The original note contents" not in result.data
+
 def test_search_page(client):
     """
     Check that the search page is shown when given a search
@@ -193,3 +392,570 @@ def test_delete_note(client):
     create_note(client, "Note 1", "test", "The original note contents")
     result = delete_note(client, "1")
     assert b"note deleted" in result.data
+
+def test_export_notes(client):
+    """
+    All notes of the user should be exported as text files (and JSONL) in one ZIP
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Export one", "cat,milk", "First note")
+    create_note(client, "Export two", "cat", "Second note")
+    result = client.get("/export?jsonl=1")
+    assert result.mimetype == "application/zip"
+    # the archive is sent while it is written, so its length is not known in advance
+    assert result.is_streamed
+    archive = zipfile.ZipFile(io.BytesIO(result.data))
+    assert archive.namelist() == ["note_1.txt", "note_2.txt", "notes.jsonl"]
+    assert b"Title: Export one" in archive.read("note_1.txt")
+    assert b"Note:\nSecond note" in archive.read("note_2.txt")
+    lines = archive.read("notes.jsonl").decode("utf8").splitlines()
+    assert [json.loads(line)["title"] for line in lines] == ["Export one", "Export two"]
+    assert json.loads(lines[0])["tags"] == ["cat", "milk"]
+    result = client.get("/export")
+    assert zipfile.ZipFile(io.BytesIO(result.data)).namelist() == ["note_1.txt", "note_2.txt"]
+
+def test_import_notes(client):
+    """
+    Notes should be imported from JSONL or an export ZIP, skipping the broken ones
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    jsonl = b'{"title": "Imported", "tags": ["cat"], "content": "Hi", ' \
+            b'"date_created": "2019-05-05T16:15:14.429235"}\n' \
+            b'not json\n' \
+            b'{"tags": "no title"}\n' \
+            b'{"title": "Second import", "content": "Meow"}\n'
+    result = client.post("/import", data={"import_file": (io.BytesIO(jsonl), "notes.jsonl")},
+                         content_type="multipart/form-data", follow_redirects=True)
+    assert b"2 notes imported, 2 skipped (first: line 2" in result.data
+    result = view_note(client, "1")
+    assert b"Imported" in result.data and b"May 05, 16:15" in result.data
+    export = client.get("/export").data
+    # the text files of an export are imported again as new notes
+    with meownotes.app_context():
+        progress = []
+        imported, errors = import_notes(1, read_import_notes(io.BytesIO(export)), 1,
+                                        lambda count, errors: progress.append(count))
+    assert (imported, errors, progress) == (2, [], [1, 2])
+    result = search(client, "imported")
+    assert b"number of results: 2" in result.data
+
+def test_api_notes(client):
+    """
+    The JSON API should create, list, get, update, and delete notes
+    with ETags from the version of the note
+    """
+    assert client.get("/api/v1/notes").status_code == 401
+    login(client, TEST_USER, TEST_PASSWORD)
+    result = client.post("/api/v1/notes", json={"title": "Api note", "tags": ["cat", "api"],
+                                                 "content": "From the API"})
+    assert result.status_code == 201
+    assert result.headers["Location"] == "/api/v1/notes/1"
+    assert result.get_json()["tags"] == ["cat", "api"] and result.get_json()["version"] == 1
+    etag = result.headers["ETag"]
+    assert etag == '"1-1"'
+    assert client.post("/api/v1/notes", json={"tags": "no title"}).status_code == 400
+    result = client.get("/api/v1/notes")
+    assert [note["title"] for note in result.get_json()["notes"]] == ["Api note"]
+    assert "content" not in result.get_json()["notes"][0]
+    # unchanged since the ETag the client has
+    result = client.get("/api/v1/notes/1", headers={"If-None-Match": etag})
+    assert result.status_code == 304 and not result.data
+    with meownotes.app_context():
+        plan = get_db().execute("EXPLAIN QUERY PLAN " + GET_NOTE_VERSION, (1, 1)).fetchall()
+        assert "COVERING INDEX notes_uid_id_version" in plan[0]["detail"]
+    result = client.put("/api/v1/notes/1", headers={"If-Match": etag},
+                        json={"title": "Api note", "tags": "cat", "content": "Changed"})
+    assert result.status_code == 200 and result.headers["ETag"] == '"1-2"'
+    # changes made through the pages also change the version
+    update_note(client, "1", "Api note", "cat", "Changed again")
+    result = client.get("/api/v1/notes/1", headers={"If-None-Match": '"1-2"'})
+    assert result.status_code == 200 and result.get_json()["content"] == "Changed again"
+    result = client.put("/api/v1/notes/1", headers={"If-Match": '"1-2"'},
+                        json={"title": "Stale", "content": "Lost update"})
+    assert result.status_code == 412
+    assert client.delete("/api/v1/notes/1", headers={"If-Match": etag}).status_code == 412
+    assert client.delete("/api/v1/notes/1", headers={"If-Match": '"1-3"'}).status_code == 204
+    assert client.get("/api/v1/notes/1").status_code == 404
+    assert client.put("/api/v1/notes/1", json={"title": "Gone"}).status_code == 404
+
+def test_api_patch_note(client):
+    """
+    Autosave should apply text changes to the version they were made to,
+    answer 409 for an older version, and not write a note that did not change
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    client.post("/api/v1/notes", json={"title": "Cat", "tags": ["cat"],
+                                       "content": "Cats \U0001f431 like fish"})
+    # positions count UTF-16 code units like in the browser, the emoji is two
+    result = client.patch("/api/v1/notes/1", json={
+        "version": 1, "changes": [{"start": 13, "end": 17, "text": "toys"},
+                                  {"start": 0, "end": 4, "text": "Kittens"}]})
+    assert result.status_code == 200 and result.headers["ETag"] == '"1-2"'
+    assert result.get_json() == {"id": 1, "version": 2, "saved": True}
+    assert client.get("/api/v1/notes/1").get_json()["content"] == \
+        "Kittens \U0001f431 like toys"
+    result = client.patch("/api/v1/notes/1", json={"version": 2, "title": "Kitten",
+                                                   "tags": ["cat", "kitten"]})
+    assert result.get_json()["version"] == 3
+    assert client.get("/api/v1/notes/1").get_json()["tags"] == ["cat", "kitten"]
+    # nothing changed, nothing written (the version stays)
+    result = client.patch("/api/v1/notes/1", json={
+        "version": 3, "changes": [{"start": 0, "end": 7, "text": "Kittens"}]})
+    assert result.get_json() == {"id": 1, "version": 3, "saved": False}
+    # made to an older version
+    result = client.patch("/api/v1/notes/1", json={
+        "version": 2, "changes": [{"start": 0, "end": 0, "text": "Lost "}]})
+    assert result.status_code == 409 and result.get_json()["version"] == 3
+    result = client.patch("/api/v1/notes/1", json={
+        "version": 3, "changes": [{"start": 8, "end": 9, "text": ""}]})
+    assert result.status_code == 400
+    assert client.patch("/api/v1/notes/1", json={"changes": []}).status_code == 400
+    assert client.patch("/api/v1/notes/2", json={"version": 1}).status_code == 404
+
+def test_search_notes(client):
+    """
+    Search should match the start of words in the title, tags, and content
+    and only return the notes of the current user
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Uni lecture", "uni,se", "Notes about the lecture")
+    create_note(client, "Groceries", "home", "Milk for the community fridge")
+    result = search(client, "lect")
+    assert b"number of results: 1" in result.data
+    assert b"Uni lecture" in result.data
+    # only whole words starting with the term match, "community" is not a match for "uni"
+    result = search(client, "uni")
+    assert b"number of results: 1" in result.data
+    # searching for quotes or other search syntax should not fail
+    result = search(client, '"milk*')
+    assert b"number of results: 1" in result.data
+    logout(client)
+    login(client, "bublik", TEST_PASSWORD)
+    result = search(client, "lecture")
+    assert b"number of results: 0" in result.data
+    # the match itself is limited to the user, ranked by the index (no sorting afterwards)
+    with meownotes.app_context():
+        query = prepare_summary_query(SEARCH_NOTES)[0]
+        plan = get_db().execute("EXPLAIN QUERY PLAN " + query,
+                                (prepare_search_match(1, "lect"), 1)).fetchall()
+        assert "TEMP B-TREE" not in " ".join(row["detail"] for row in plan)
+
+def test_filter_search(client):
+    """
+    Filtering the last search should limit the matches to the checked fields
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Milk", "home", "Buy it")
+    create_note(client, "Shopping", "home", "Milk and bread")
+    search(client, "milk")
+    result = filter_search(client, ["title"])
+    assert b"number of results: 1" in result.data
+    result = filter_search(client, ["title", "content"])
+    assert b"number of results: 2" in result.data
+    result = filter_search(client, [])
+    assert b"number of results: 0" in result.data
+
+def test_search_cache(client):
+    """
+    Filtering the last search should use the cached result, a change of a note
+    should search again, and every word has to match in one of the checked fields
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Milk", "dairy", "Buy it")
+    create_note(client, "Shopping", "home", "Milk and dairy")
+    searches = meownotes.extensions["meownotes_searches"]
+    before = searches.stats()
+    search(client, "milk dairy")
+    # "milk" in the title and "dairy" in the tags
+    result = filter_search(client, ["title", "tags"])
+    assert b"number of results: 1" in result.data
+    result = filter_search(client, ["title"])
+    assert b"number of results: 0" in result.data
+    result = filter_search(client, ["content"])
+    assert b"number of results: 1" in result.data
+    assert b"Shopping" in result.data
+    assert searches.stats()["misses"] == before["misses"] + 1
+    assert searches.stats()["hits"] == before["hits"] + 3
+    # the filtered results are the same as searching the fields only
+    with meownotes.app_context():
+        assert [note["id"] for note in get_search_notes(1, "milk dairy", ["content"])] == [2]
+    create_note(client, "Dairy milk", "shop", "")
+    result = filter_search(client, ["title"])
+    assert b"number of results: 1" in result.data
+    assert searches.stats()["misses"] == before["misses"] + 2
+
+def test_note_compression(client, monkeypatch):
+    """
+    Long notes should be stored compressed and read, previewed, and searched as text,
+    flask compress-notes should compress the existing notes
+    """
+    monkeypatch.setitem(meownotes.config, "NOTE_COMPRESS_MIN_BYTES", 0)
+    monkeypatch.setitem(meownotes.config, "NOTE_PREVIEW_LENGTH", 12)
+    long_content = "Purring cats " + "meow " * 500
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Long", "cat", long_content)
+    monkeypatch.setitem(meownotes.config, "NOTE_COMPRESS_MIN_BYTES", 1024)
+    create_note(client, "Longer", "cat", long_content + "whiskers")
+    create_note(client, "Short", "cat", "Purring")
+    def stored():
+        with meownotes.app_context():
+            return [(row["codec"], len(row["content"])) for row in get_db().execute(
+                "SELECT codec, content from notes ORDER BY id")]
+    assert [codec for codec, _ in stored()] == [0, 1, 0]
+    assert stored()[1][1] < 100
+    assert long_content + "whiskers" in view_note(client, "2").data.decode()
+    assert b"Purring cats" in dashboard(client).data
+    assert b"number of results: 2" in search(client, "purring cats").data
+    assert b"number of results: 1" in search(client, "whiskers").data
+    result = meownotes.test_cli_runner().invoke(args=["compress-notes"])
+    assert "Stored 1 notes again" in result.output
+    assert [codec for codec, _ in stored()] == [1, 1, 0]
+    # a shorter content is stored as it is again
+    update_note(client, "2", "Longer", "cat", "Purring")
+    assert [codec for codec, _ in stored()] == [1, 0, 0]
+    delete_note(client, "1")
+    assert b"number of results: 2" in search(client, "purring").data
+    assert b"number of results: 0" in search(client, "meow").data
+    with meownotes.app_context():
+        # the search index holds the same text as the notes
+        get_db().execute("INSERT INTO notes_fts (notes_fts) VALUES ('integrity-check')")
+
+def test_shards(client, monkeypatch, tmp_path):
+    """
+    flask shard-db should copy the notes of each user into its shard,
+    with SHARD_COUNT the notes should be read from and written to the shard of the user
+    """
+    monkeypatch.setitem(meownotes.config, "SHARD_DATABASE", str(tmp_path / "shard-%d.db"))
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Purring cat", "cat", "Meow")
+    create_note(client, "Sleepy cat", "cat", "Zzz")
+    result = meownotes.test_cli_runner().invoke(args=["shard-db", "--shards", "2"])
+    assert "Shard 0" in result.output
+    assert "1 users, copied 2 notes." in result.output
+    monkeypatch.setitem(meownotes.config, "SHARD_COUNT", 2)
+    # copied before, the notes are not copied again
+    result = meownotes.test_cli_runner().invoke(args=["shard-db"])
+    assert "1 users, copied 0 notes." in result.output
+    assert b"Sleepy cat" in dashboard(client).data
+    assert b"number of results: 2" in search(client, "cat").data
+    create_note(client, "Hungry cat", "cat", "Food")
+    logout(client)
+    login(client, "bublik", TEST_PASSWORD)
+    create_note(client, "Bublik", "dog", "Woof")
+    assert b"number of results: 0" in search(client, "cat").data
+    def stored(database):
+        connection = sqlite3.connect(database)
+        titles = [row[0] for row in connection.execute("SELECT title from notes ORDER BY id")]
+        connection.close()
+        return titles
+    assert stored(str(tmp_path / "shard-0.db")) == ["Bublik"]
+    assert stored(str(tmp_path / "shard-1.db")) == ["Purring cat", "Sleepy cat", "Hungry cat"]
+    assert stored(meownotes.config["DATABASE"]) == ["Purring cat", "Sleepy cat"]
+
+def test_backup_restore(client, monkeypatch, tmp_path):
+    """
+    flask backup should copy the db in steps (only the changed pages if incremental),
+    flask restore should bring back the notes of the latest backup or of an earlier one
+    """
+    monkeypatch.setitem(meownotes.config, "BACKUP_PAGES", 2)
+    monkeypatch.setitem(meownotes.config, "BACKUP_SLEEP", 0)
+    runner = meownotes.test_cli_runner()
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Before", "cat", "Meow")
+    result = runner.invoke(args=["backup", "--dest", str(tmp_path)])
+    assert "Backed up" in result.output
+    assert "locked for" in result.output
+    manifests = list(tmp_path.glob("*.manifest.json"))
+    assert len(manifests) == 1
+    full_backup = tmp_path / json.loads(manifests[0].read_text())["chain"][0]["file"]
+    assert full_backup.name.endswith(".db.gz")
+    create_note(client, "After", "cat", "Purr " * 2000)
+    result = runner.invoke(args=["backup", "--dest", str(tmp_path), "--incremental"])
+    manifest = json.loads(manifests[0].read_text())
+    assert [entry["file"].split(".", 1)[1] for entry in manifest["chain"]] == ["db.gz",
+                                                                              "pages.gz"]
+    # only the changed pages are written
+    written = int(re.search(r"\((\d+) pages written\)", result.output).group(1))
+    assert 0 < written < len(manifest["hashes"])
+    delete_note(client, "1")
+    delete_note(client, "2")
+    result = runner.invoke(args=["restore", "--dest", str(tmp_path)])
+    assert result.exit_code != 0
+    result = runner.invoke(args=["restore", "--dest", str(tmp_path), "--yes"])
+    assert "Restored" in result.output
+    assert b"Purr Purr" in view_note(client, "2").data
+    result = runner.invoke(args=["restore", "--dest", str(tmp_path), "--yes",
+                                 "--until", manifest["chain"][0]["stamp"]])
+    assert "Restored" in result.output
+    with meownotes.app_context():
+        titles = [row["title"] for row in get_db().execute("SELECT title from notes")]
+        assert titles == ["Before"]
+        assert get_db().execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    with gzip.open(full_backup, "rb") as backup_file:
+        assert backup_file.read(16) == b"SQLite format 3\x00"
+
+def test_connection_pool():
+    """
+    Connections should be reused and configured with the pool settings
+    """
+    db_fd, db_path = tempfile.mkstemp()
+    pool = ConnectionPool(db_path, size=1, timeout=0.01,
+                          pragmas={"journal_mode": "WAL", "busy_timeout": 1234})
+    first = pool.acquire()
+    assert first.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert first.execute("PRAGMA busy_timeout").fetchone()[0] == 1234
+    # the only connection is in use, so the next request has to wait (and times out)
+    with pytest.raises(sqlite3.OperationalError):
+        pool.acquire()
+    pool.release(first)
+    second = pool.acquire()
+    assert second is first
+    pool.release(second)
+    stats = pool.stats()
+    assert (stats["hits"], stats["misses"], stats["waits"], stats["timeouts"]) == (1, 1, 1, 1)
+    pool.close()
+    os.close(db_fd)
+    os.unlink(db_path)
+
+def test_db_stats(client, monkeypatch):
+    """
+    The pool counters should only be served when enabled in the config
+    """
+    assert client.get("/dbstats").status_code == 404
+    monkeypatch.setitem(meownotes.config, "DB_STATS_ENABLED", True)
+    dashboard(client)
+    stats = client.get("/dbstats").get_json()
+    assert stats[0]["database"] == meownotes.config["DATABASE"]
+    assert stats[0]["hits"] + stats[0]["misses"] > 0
+
+def test_tags(client):
+    """
+    The tags should be counted and listed exactly (no partial matches), any case,
+    and follow the changes of the notes
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Lecture", "uni, SE", "Notes of the lecture")
+    create_note(client, "Exam", "Uni,exam,uni", "Date of the exam")
+    create_note(client, "Garden", "community", "Community garden")
+    result = client.get("/tags")
+    assert b"uni (2)" in result.data and b"se (1)" in result.data
+    assert b"community (1)" in result.data
+    result = client.get("/tags/uni")
+    assert b"notes tagged uni: 2" in result.data
+    assert b"Lecture" in result.data and b"Exam" in result.data
+    assert b"Garden" not in result.data
+    assert b"notes tagged UNI: 2" in client.get("/tags/UNI").data
+    with meownotes.app_context():
+        uid = get_id_by_user(TEST_USER)
+        plan = get_db().execute("EXPLAIN QUERY PLAN SELECT tag, count(*) from note_tags "
+                                "WHERE uid=? GROUP BY tag", (uid,)).fetchall()
+        assert "PRIMARY KEY" in " ".join(row["detail"] for row in plan)
+        note_ids = [row["id"] for row in get_db().execute("SELECT id from notes ORDER BY id")]
+    update_note(client, note_ids[1], "Exam", "exam", "Date of the exam")
+    delete_note(client, note_ids[2])
+    with meownotes.app_context():
+        assert get_tag_counts(uid) == [("exam", 1), ("se", 1), ("uni", 1)]
+    assert b"notes tagged uni: 1" in client.get("/tags/uni").data
+
+def test_suggest(client):
+    """
+    Suggestions should come from the titles and tags, follow the changes of the notes
+    made by this worker without a rebuild, and be rebuilt after other changes
+    """
+    assert client.get("/api/v1/suggest?q=ca").status_code == 401
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Cat food", "shop, Home", "Buy some")
+    create_note(client, "Catnip garden", "garden", "Plant it")
+    def suggest(prefix):
+        return client.get("/api/v1/suggest", query_string={"q": prefix}).get_json()["suggestions"]
+    assert suggest("CA") == ["cat", "cat food", "catnip", "catnip garden"]
+    assert suggest("ho") == ["home"]
+    assert suggest(" ") == []
+    suggest_cache = meownotes.extensions["meownotes_suggest"]
+    assert suggest_cache.stats()["builds"] == 1
+    with meownotes.app_context():
+        note_ids = [row["id"] for row in get_db().execute("SELECT id from notes ORDER BY id")]
+    update_note(client, note_ids[0], "Dog food", "shop", "Buy some")
+    assert suggest("ca") == ["catnip", "catnip garden"]
+    assert suggest("ho") == []
+    delete_note(client, note_ids[1])
+    assert suggest("ca") == []
+    assert suggest_cache.stats()["builds"] == 1 and suggest_cache.stats()["updates"] == 2
+    # a change not made through this worker (e.g., another worker) rebuilds the index
+    with meownotes.app_context():
+        get_db().execute("UPDATE notes SET title='Catfish' WHERE id=?", (note_ids[0],))
+        get_db().commit()
+    assert suggest("ca") == ["catfish"]
+    assert suggest_cache.stats()["builds"] == 2
+
+def test_suggest_cache_budget():
+    """
+    The least recently used suggestion indexes should be removed to stay within the budget
+    """
+    indexes = [SuggestIndex(1), SuggestIndex(1)]
+    indexes[0].add_note(1, "Cat food", "shop")
+    indexes[1].load([(2, "Catnip", "garden")])
+    suggest_cache = SuggestCache(indexes[0].size + indexes[1].size - 1)
+    suggest_cache.put(1, indexes[0])
+    suggest_cache.put(2, indexes[1])
+    assert suggest_cache.suggest(1, "ca", 10, 1) is None
+    assert suggest_cache.suggest(2, "ca", 10, 1) == ["catnip"]
+    assert suggest_cache.stats()["evictions"] == 1
+
+def test_metrics(client, monkeypatch, caplog):
+    """
+    Request, query, connection, and rendering times should be served at /metrics
+    (only when enabled) and logged per request as JSON lines
+    """
+    assert client.get("/metrics").status_code == 404
+    monkeypatch.setitem(meownotes.config, "METRICS_ENABLED", True)
+    monkeypatch.setitem(meownotes.config, "METRICS_LOG_REQUESTS", True)
+    login(client, TEST_USER, TEST_PASSWORD)
+    with caplog.at_level("INFO", logger="meownotes.metrics"):
+        dashboard(client)
+    logged = json.loads(caplog.records[-1].getMessage())
+    assert logged["endpoint"] == "pawprint.dashboard" and logged["status"] == 200
+    assert logged["queries"] > 0 and logged["render_ms"] > 0
+    result = client.get("/metrics")
+    assert result.mimetype == "text/plain"
+    text = result.data.decode("utf8")
+    assert "# TYPE meownotes_request_seconds histogram" in text
+    assert 'meownotes_request_seconds_count{endpoint="pawprint.dashboard",method="GET",' \
+        'status="200"}' in text
+    assert re.search(r'meownotes_query_seconds_count\{query="SELECT .*notes.*"\} \d+', text)
+    assert 'meownotes_template_render_seconds_count{template="dashboard.html"}' in text
+    assert "meownotes_db_acquire_seconds_count " in text
+    assert 'meownotes_db_pool_acquires_total{database="%s",result="hits"}' % \
+        meownotes.config["DATABASE"] in text
+    assert "meownotes_fragment_cache_bytes " in text
+
+def test_write_queue(client, monkeypatch):
+    """
+    With the write queue, concurrent writes should be committed together in batches
+    and a failing write should only fail itself, not the others of its batch
+    """
+    monkeypatch.setitem(meownotes.config, "WRITE_QUEUE_ENABLED", True)
+    monkeypatch.setitem(meownotes.config, "WRITE_QUEUE_WINDOW", 0.05)
+    write_queue = get_write_queue(meownotes.config)
+    insert_user = "INSERT INTO users (username, password) VALUES (?, ?)"
+    futures = [write_queue.submit(insert_user, (username, "test"))
+               for username in ("kitten", "tom", "kitten", "felix")]
+    assert isinstance(futures[2].exception(), sqlite3.IntegrityError)
+    assert [future.result().rowcount for future in futures if not future.exception()] == [1] * 3
+    assert write_queue.stats()["batches"] == 1
+    # requests of other threads go through the same queue
+    login(client, TEST_USER, TEST_PASSWORD)
+    with meownotes.app_context():
+        uid = get_id_by_user(TEST_USER)
+    note_ids = []
+    start = threading.Barrier(8)
+    def add(number):
+        with meownotes.app_context():
+            start.wait()
+            note_ids.append(add_note(uid, "Note %d" % number, "", "Written in a batch"))
+    threads = [threading.Thread(target=add, args=(number,)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(note_ids)) == 8
+    stats = write_queue.stats()
+    assert stats["writes"] == 3 + 1 + 8 and stats["failed"] == 1
+    assert stats["largest_batch"] > 1
+    result = dashboard(client)
+    assert result.data.count(b"Note ") == 8
+
+def test_built_assets(client, monkeypatch, tmp_path):
+    """
+    Built assets should have hashed names, only the used fonts,
+    and be served precompressed and cached forever
+    """
+    manifest = build_assets(str(tmp_path), [400])
+    assert manifest["css/main.css"].startswith("css/main.")
+    assert list(name for name in manifest if name.startswith("fonts/")) == \
+        ["fonts/Montserrat-Regular.otf"]
+    with open(tmp_path / manifest["css/fonts.css"], encoding="utf8") as fonts_css:
+        assert "../" + manifest["fonts/Montserrat-Regular.otf"] in fonts_css.read()
+    with open(tmp_path / manifest["js/popper.min.js"], "rb") as popper_js:
+        assert b"sourceMappingURL" not in popper_js.read()
+    monkeypatch.setitem(meownotes.config, "ASSETS_DIST_DIR", str(tmp_path))
+    monkeypatch.setitem(meownotes.extensions, "meownotes_assets", manifest)
+    result = client.get("/")
+    main_css = "/static/dist/" + manifest["css/main.css"]
+    assert main_css.encode() in result.data
+    result = client.get(main_css, headers={"Accept-Encoding": "gzip, deflate"})
+    assert result.headers["Content-Encoding"] == "gzip"
+    assert result.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert result.mimetype == "text/css"
+    assert b"Montserrat" in gzip.decompress(result.data)
+    result = client.get(main_css)
+    assert "Content-Encoding" not in result.headers and b"Montserrat" in result.data
+
+def test_prepare_query():
+    """
+    Queries should use placeholders, so the query string does not depend on the values
+    """
+    first = prepare_query("UPDATE_CONDITIONAL", "notes",
+                          [{"val": "A title", "cols": ["title"], "type": None, "condition": False},
+                           {"val": 1, "cols": ["uid"], "type": "exact", "condition": True},
+                           {"val": "1", "cols": ["id"], "type": "exact", "condition": True}])
+    assert first == ("UPDATE notes SET title=? WHERE uid=? AND id=?", ("A title", 1, "1"))
+    second = prepare_query("UPDATE_CONDITIONAL", "notes",
+                           [{"val": "x' OR '1'='1", "cols": ["title"], "type": None,
+                             "condition": False},
+                            {"val": 2, "cols": ["uid"], "type": "exact", "condition": True},
+                            {"val": "7", "cols": ["id"], "type": "exact", "condition": True}])
+    assert second[0] == first[0]
+    assert second[1][0] == "x' OR '1'='1"
+    contains = prepare_query("GET_CONDITIONAL", "notes",
+                             [{"val": "100%", "cols": ["title"], "type": "contains",
+                               "condition": True}])
+    assert contains[1] == ("%100\\%%",)
+
+def test_note_with_quotes(client):
+    """
+    Notes with quotes in them should be saved as they were written
+    """
+    login(client, TEST_USER, TEST_PASSWORD)
+    create_note(client, "Kroshka's note", "it's", "She said: 'meow'; DROP TABLE notes; --")
+    result = view_note(client, "1")
+    assert b"She said: &#39;meow&#39;; DROP TABLE notes; --" in result.data
+
+def test_migrate_existing_db(client):
+    """
+    flask migrate should upgrade a db created with the original schema
+    without losing its notes
+    """
+    with meownotes.app_context():
+        meownotes_db = get_db()
+        with meownotes.open_resource("meownotes-schema.sql") as schema_file:
+            meownotes_db.executescript(schema_file.read().decode("utf8"))
+        meownotes_db.executescript("""
+            PRAGMA user_version = 0;
+            INSERT INTO users (username, password) VALUES ('kroshka', 'x');
+            INSERT INTO notes (uid, date_created, title, tags, content)
+            VALUES (1, '2019-05-05T16:15:14.429235', 'Old note', 'uni', 'Written before');
+        """)
+    result = meownotes.test_cli_runner().invoke(args=["migrate"])
+    assert "Applied migration 1" in result.output
+    assert "up to date (version %d)" % len(MIGRATIONS) in result.output
+    with meownotes.app_context():
+        meownotes_db = get_db()
+        indexes = meownotes_db.execute("SELECT name from sqlite_master WHERE type='index' "
+                                       "AND tbl_name='notes'").fetchall()
+        assert {"notes_uid_created_ts", "notes_uid_id_version"} <= \
+            {row["name"] for row in indexes}
+        db_note = meownotes_db.execute("SELECT * from notes").fetchone()
+        assert db_note["version"] == 1
+        assert db_note["created_ts"] == to_timestamp("2019-05-05T16:15:14.429235")
+        assert parse_note(db_note)["ui_date"] == "May 05, 16:15"
+        assert len(get_search_notes(1, "before")) == 1
+        assert get_tag_counts(1) == [("uni", 1)]
+    # running it again does nothing
+    result = meownotes.test_cli_runner().invoke(args=["migrate"])
+    assert "Applied migration" not in result.output
+    # rebuilding the search index keeps the notes searchable
+    result = meownotes.test_cli_runner().invoke(args=["buildindex"])
+    assert "(Re)built" in result.output
+    with meownotes.app_context():
+        assert len(get_search_notes(1, "before")) == 1
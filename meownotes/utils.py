@@ -2,21 +2,25 @@
 """
 Generic utils for MeowNotes
 """
+import datetime
+import functools
+import io
+import json
 import random
+import zipfile
 
 ###### Generic utilities
 
-def format_value_for_db(value, cols, paramtype):
+def format_param_for_db(value, paramtype):
     """
-    Format integers for inserting/searching in the DB
+    Format a value to be bound to a query placeholder
+    for "contains" conditions the value is wrapped in LIKE wildcards
+    (wildcards that are part of the value itself are escaped)
     """
-    if isinstance(value, int) or "id" in cols:
-        result = str(value)
-    elif paramtype == "contains":
-        result = "'%" + value + "%'"
-    else:
-        result = "'" + value + "'"
-    return result
+    if paramtype == "contains":
+        escaped = str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return "%" + escaped + "%"
+    return value
 
 def create_input_obj(val, cols_list, input_type=None, condition=False):
     """
@@ -36,6 +40,74 @@ def fix_tags(tags):
         tags = ",".join(tags)
     return tags
 
+def apply_text_changes(text, changes):
+    """
+    Apply a list of changes {"start": ..., "end": ..., "text": ...} to a text, one after the other
+    each replaces the characters from start to end (of the text as changed so far) with its text
+    the positions count UTF-16 code units, like the indexes of a string in the browser
+    raises ValueError if a change does not fit the text
+    Example use: apply_text_changes("cat food", [{"start": 4, "end": 8, "text": "toys"}])
+    Example output: "cat toys"
+    """
+    encoded = text.encode("utf-16-le")
+    for change in changes:
+        if not isinstance(change, dict) or not isinstance(change.get("text", ""), str):
+            raise ValueError("a change needs a start, an end, and a text")
+        start, end = change.get("start"), change.get("end")
+        if not isinstance(start, int) or not isinstance(end, int) \
+                or not 0 <= start <= end <= len(encoded) // 2:
+            raise ValueError("the change from %s to %s is outside of the text" % (start, end))
+        encoded = encoded[:start * 2] + change.get("text", "").encode("utf-16-le") + \
+            encoded[end * 2:]
+    try:
+        return encoded.decode("utf-16-le")
+    except UnicodeDecodeError as expt:
+        raise ValueError("a change splits a character") from expt
+
+def to_timestamp(date_created):
+    """
+    Converts an ISO date (as stored in date_created) into epoch seconds
+    Example use: to_timestamp("2019-05-05T16:15:14.429235")
+    """
+    return int(datetime.datetime.fromisoformat(date_created).timestamp())
+
+@functools.lru_cache(maxsize=4096)
+def format_ui_date(timestamp):
+    """
+    Formats epoch seconds as a date that can be output directly in the ui
+    (memoized, called with the timestamp rounded down to the minute)
+    """
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%b %d, %H:%M')
+
+def get_ui_date(created_ts, date_created):
+    """
+    Returns the ui date of a note from its created_ts
+    or its date_created if created_ts was not filled yet
+    """
+    if created_ts is None:
+        created_ts = to_timestamp(date_created)
+    return format_ui_date(created_ts - created_ts % 60)
+
+def encode_page_cursor(created_ts, note_id):
+    """
+    Creates the cursor (for the url) pointing after the given note
+    Example use: encode_page_cursor(1557065714, 3)
+    Example output: "1557065714_3"
+    """
+    return "%d_%d" % (created_ts, note_id)
+
+def decode_page_cursor(cursor):
+    """
+    Reads a cursor created by encode_page_cursor
+    returns (created_ts, note_id) or None if there is no (valid) cursor
+    """
+    if not cursor or "_" not in cursor:
+        return None
+    created_ts, note_id = cursor.split("_", 1)
+    if not created_ts.isdigit() or not note_id.isdigit():
+        return None
+    return int(created_ts), int(note_id)
+
 def create_welcome_message(username):
     """
     Creates a somewhat random welcome message for the user to be displayed
@@ -65,3 +137,163 @@ def reformat_for_export(parsed_note_data):
     export_string += "================================================================\n"
     export_string += "Note:\n" + parsed_note_data["content"] + "\n"
     return export_string
+
+def export_note_json(parsed_note_data):
+    """
+    Format a parsed note as one line of JSON (for notes.jsonl in the export)
+    Example output: {"title": "Milk", "tags": ["cat"], "content": "...", ...}
+    """
+    return json.dumps({
+        "title": parsed_note_data["title"],
+        "tags": parsed_note_data["tags"],
+        "date_created": parsed_note_data["date_created"],
+        "created_ts": parsed_note_data["created_ts"],
+        "content": parsed_note_data["content"]
+    }, ensure_ascii=False)
+
+class ExportStream():
+    """
+    Write-only file for zipfile that keeps what was written until it is taken
+    so that the archive can be sent while it is still being written
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        """
+        Called by zipfile with the next bytes of the archive
+        """
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        """
+        Nothing to flush, the bytes are taken with take()
+        """
+
+    def take(self):
+        """
+        Returns the bytes written since the last call (as a list of at most one item)
+        """
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return [data] if data else []
+
+def stream_export_zip(notes, jsonl_notes=None):
+    """
+    Yields a ZIP archive a note at a time, with the notes as plain text files
+    (see reformat_for_export) and if jsonl_notes is given also as notes.jsonl
+    only one note is held in memory, notes and jsonl_notes can be generators
+    Example use: stream_export_zip(iter_notes_by_user(1))
+    """
+    export_stream = ExportStream()
+    with zipfile.ZipFile(export_stream, "w", zipfile.ZIP_DEFLATED) as archive:
+        for note in notes:
+            archive.writestr("note_%d.txt" % note["note_id"], reformat_for_export(note))
+            yield from export_stream.take()
+        if jsonl_notes is not None:
+            # the size is not known in advance, allow it to go past 2 GiB
+            with archive.open("notes.jsonl", "w", force_zip64=True) as jsonl_file:
+                for note in jsonl_notes:
+                    jsonl_file.write((export_note_json(note) + "\n").encode("utf8"))
+                    yield from export_stream.take()
+    # the central directory (list of files) is written when the archive is closed
+    yield from export_stream.take()
+
+EXPORT_RULE = "================================================================"
+
+def parse_export_text(export_string):
+    """
+    Reads back a note formatted by reformat_for_export
+    (the export only has the ui date, so the note gets no date)
+    returns a dict with the title, tags and content or raises ValueError
+    """
+    lines = export_string.split("\n")
+    if len(lines) < 8 or lines[0] != EXPORT_RULE or not lines[1].startswith("Title: ") \
+            or not lines[4].startswith("Tags: ") or lines[6] != "Note:":
+        raise ValueError("not a MeowNotes export file")
+    tags = [tag.strip() for tag in lines[4][len("Tags: "):].split(",")]
+    return {
+        "title": lines[1][len("Title: "):],
+        "tags": [tag for tag in tags if tag],
+        # reformat_for_export ends the content with a newline
+        "content": "\n".join(lines[7:])[:-1]
+    }
+
+def check_import_note(entry):
+    """
+    Checks a note read from an import file and fills in the values that are missing
+    returns a dict with the title, tags (as a comma-separated string), content,
+    date_created and created_ts of the note or raises ValueError
+    """
+    if not isinstance(entry, dict):
+        raise ValueError("a note must be a JSON object")
+    title = entry.get("title")
+    content = entry.get("content", "")
+    if not isinstance(title, str) or not title:
+        raise ValueError("the note has no title")
+    if not isinstance(content, str):
+        raise ValueError("the content of the note must be text")
+    tags = entry.get("tags") or ""
+    if isinstance(tags, list):
+        tags = ",".join(str(tag) for tag in tags)
+    date_created = entry.get("date_created")
+    created_ts = entry.get("created_ts")
+    try:
+        if date_created is None:
+            if created_ts is None:
+                date_created = datetime.datetime.now().isoformat()
+            else:
+                date_created = datetime.datetime.fromtimestamp(created_ts).isoformat()
+        if created_ts is None:
+            created_ts = to_timestamp(date_created)
+    except (TypeError, ValueError, OverflowError, OSError) as expt:
+        raise ValueError("the date of the note is not valid") from expt
+    return {"title": title, "tags": str(tags), "content": content,
+            "date_created": date_created, "created_ts": int(created_ts)}
+
+def read_import_notes(import_file):
+    """
+    Yields (source, note, error) for each note of an import file (opened in binary mode):
+    JSONL with one note per line (as notes.jsonl of the export) or a ZIP from the export
+    (its notes.jsonl if there is one, otherwise its text files)
+    source names the line or file of the note, note is None if it could not be read
+    Example use: for source, note, error in read_import_notes(open("notes.zip", "rb")): ...
+    """
+    if zipfile.is_zipfile(import_file):
+        import_file.seek(0)
+        with zipfile.ZipFile(import_file) as archive:
+            names = archive.namelist()
+            if "notes.jsonl" in names:
+                with archive.open("notes.jsonl") as jsonl_file:
+                    yield from read_import_jsonl(jsonl_file, "notes.jsonl:")
+                return
+            for name in names:
+                if not name.endswith(".txt"):
+                    continue
+                try:
+                    note = check_import_note(parse_export_text(
+                        archive.read(name).decode("utf8")))
+                except (ValueError, UnicodeDecodeError) as expt:
+                    yield name, None, str(expt)
+                    continue
+                yield name, note, None
+        return
+    import_file.seek(0)
+    yield from read_import_jsonl(import_file, "line ")
+
+def read_import_jsonl(jsonl_file, source_prefix):
+    """
+    Yields (source, note, error) for each (non-empty) line of a JSONL file
+    """
+    lines = io.TextIOWrapper(jsonl_file, encoding="utf8", errors="replace")
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        source = source_prefix + str(line_number)
+        try:
+            note = check_import_note(json.loads(line))
+        except ValueError as expt:
+            yield source, None, str(expt)
+            continue
+        yield source, note, None
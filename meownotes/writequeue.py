@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+MeowNotes group commit of the writes to the db (optional, WRITE_QUEUE_ENABLED)
+the writes of all requests (threads) of a worker process are handed to one writer thread
+that commits the writes arriving within a few milliseconds together in one transaction,
+so concurrent writes share one commit (fsync) instead of waiting for each other's lock
+"""
+import collections
+import concurrent.futures
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# add the project directory to the sys.path
+if ROOT not in sys.path:
+    sys.path = [ROOT] + sys.path
+from dbpool import get_pool
+
+# what a queued write returns, like the cursor of a write executed directly
+WriteResult = collections.namedtuple("WriteResult", ["lastrowid", "rowcount"])
+
+class WriteQueue():
+    """
+    One writer thread with its own connection, committing the queued writes in batches
+    a batch is the writes queued within window seconds of the first one, at most max_batch
+    Example use:
+    writes = WriteQueue(get_pool(config).connect, window=0.002, max_batch=64)
+    future = writes.submit("DELETE from notes WHERE uid=? AND id=?", (1, 2))
+    future.result().rowcount
+    writes.close()
+    """
+    def __init__(self, connect, window=0.002, max_batch=64):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        # writes: writes committed, failed: writes rolled back (their error was raised)
+        # batches: transactions, largest_batch: most writes committed in one transaction
+        self.counters = {"writes": 0, "failed": 0, "batches": 0, "largest_batch": 0}
+        self._thread = threading.Thread(target=self.run, args=(connect,),
+                                        name="meownotes-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, query, params=()):
+        """
+        Queue a write, returns a future of its WriteResult
+        (the future raises the sqlite3 error instead if the write failed)
+        """
+        future = concurrent.futures.Future()
+        self._pending.put((query, params, future))
+        return future
+
+    def write(self, query, params=(), timeout=10.0):
+        """
+        Queue a write and wait until it is committed, returns its WriteResult
+        """
+        try:
+            return self.submit(query, params).result(timeout)
+        except concurrent.futures.TimeoutError as expt:
+            raise sqlite3.OperationalError("timed out waiting for the write to be committed") \
+                from expt
+
+    def run(self, connect):
+        """
+        Writer thread: take the queued writes in batches and commit each batch
+        """
+        connection = connect()
+        try:
+            while True:
+                batch, stop = self.next_batch()
+                if batch:
+                    self.commit_batch(connection, batch)
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def next_batch(self):
+        """
+        Wait for a write, then take the writes queued within the window after it
+        returns the batch and whether the queue was closed
+        """
+        item = self._pending.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                item = self._pending.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def commit_batch(self, connection, batch):
+        """
+        Execute a batch of writes in one transaction, each in a savepoint
+        so that a failing write (e.g., a taken username) is rolled back on its own
+        the futures are only resolved once the transaction is committed
+        """
+        results = []
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for query, params, future in batch:
+                connection.execute("SAVEPOINT queued_write")
+                try:
+                    cursor = connection.execute(query, params)
+                    results.append((future, WriteResult(cursor.lastrowid, cursor.rowcount), None))
+                except sqlite3.Error as expt:
+                    connection.execute("ROLLBACK TO queued_write")
+                    results.append((future, None, expt))
+                connection.execute("RELEASE queued_write")
+            connection.commit()
+        except sqlite3.Error as expt:
+            if connection.in_transaction:
+                connection.rollback()
+            results = [(future, None, expt) for _, _, future in batch]
+        failed = 0
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                failed += 1
+                future.set_exception(error)
+        with self._lock:
+            self.counters["writes"] += len(batch) - failed
+            self.counters["failed"] += failed
+            self.counters["batches"] += 1
+            self.counters["largest_batch"] = max(self.counters["largest_batch"], len(batch))
+
+    def close(self):
+        """
+        Commit the writes queued so far and stop the writer thread
+        """
+        self._pending.put(None)
+        self._thread.join()
+
+    def stats(self):
+        """
+        Returns the queue counters as a dict
+        """
+        with self._lock:
+            stats = {"pending": self._pending.qsize()}
+            stats.update(self.counters)
+        return stats
+
+############ One write queue per db file and worker process ############
+
+class WriteQueueRegistry():
+    """
+    The write queues of one worker process, one per db file
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.queues = {}
+
+    def get(self, config, database=None):
+        """
+        Returns the write queue for the db configured in the given (Flask app) config
+        (or another db file, e.g., a shard) starting its writer thread on first use
+        """
+        database = database or config["DATABASE"]
+        with self.lock:
+            # the writer threads are not copied into a forked worker process (e.g., uWSGI)
+            if os.getpid() != self.pid:
+                self.queues = {}
+                self.pid = os.getpid()
+            write_queue = self.queues.get(database)
+            if write_queue is None:
+                write_queue = WriteQueue(get_pool(config, database).connect,
+                                         window=config["WRITE_QUEUE_WINDOW"],
+                                         max_batch=config["WRITE_QUEUE_MAX_BATCH"])
+                self.queues[database] = write_queue
+        return write_queue
+
+    def clear(self):
+        """
+        Forget all write queues, returns them (e.g., to be closed)
+        """
+        with self.lock:
+            write_queues = list(self.queues.values())
+            self.queues = {}
+        return write_queues
+
+QUEUES = WriteQueueRegistry()
+
+def get_write_queue(config, database=None):
+    """
+    Returns the write queue of this worker for the db configured in the given (Flask app) config
+    or for the given db file (writes to different files are committed in parallel)
+    """
+    return QUEUES.get(config, database)
+
+def write_queue_stats():
+    """
+    Returns the counters of the write queues of this worker process by db file
+    """
+    with QUEUES.lock:
+        write_queues = dict(QUEUES.queues)
+    return {database: write_queue.stats() for database, write_queue in write_queues.items()}
+
+def close_write_queues():
+    """
+    Commit the queued writes and stop the writer threads of this worker process
+    e.g., before removing a (test) db file
+    """
+    for write_queue in QUEUES.clear():
+        write_queue.close()
@@ -20,4 +20,8 @@ if project_home not in sys.path:
 
 # needs to be called "application" for pythonanywhere WSGI to work
 from __init__ import *
+from dbpool import close_pools
 application = create_app()
+# with a preforking server (uwsgi.ini) the app is created once and the workers are forked
+# from it, so no db connection opened here (e.g., by the migrations) is shared by them
+close_pools()